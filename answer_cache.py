@@ -0,0 +1,123 @@
+# answer_cache.py (Q&Aモードの意味的な回答キャッシュ)
+#
+# 質問の埋め込みが過去の質問と十分に近ければ、検索とGeminiの回答生成を丸ごと省いて前回の回答を返す。
+# エントリはcompany-docsのインデックスのバージョンごとにRedisのハッシュへ保存するので、
+# 資料を再インデックスしてバージョンが変われば古い回答は自動的に使われなくなる。
+# 「第12条」と「第13条」、「有給」と「無給」のように用語だけが違う質問は埋め込みがほぼ同じになるので、
+# 質問の用語（lexical_index.extract_key_terms）も一致したときだけヒットにする。
+
+import json
+import threading
+import time
+import uuid
+from typing import Optional
+
+import numpy as np
+
+from embedding_cache import pack_vector, unpack_vector
+from lexical_index import extract_key_terms
+
+
+class SemanticAnswerCache:
+    """質問ベクトルのコサイン類似度で引く回答キャッシュ（Redis + インプロセスのミラー）"""
+
+    def __init__(self, redis_client, threshold: float = 0.95, ttl_seconds: int = 24 * 3600,
+                 max_entries: int = 500, refresh_seconds: float = 30.0, prefix: str = "qa_answer_cache"):
+        self.redis_client = redis_client
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.refresh_seconds = refresh_seconds
+        self.prefix = prefix
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "errors": 0, "saved_seconds": 0.0}
+        self._lock = threading.Lock()
+        self._mirror = {"version": None, "loaded_at": 0.0, "entries": [], "matrix": None}
+
+    def _key(self, version: str) -> str:
+        return f"{self.prefix}:{version}"
+
+    def lookup(self, question: str, vector: list[float], version: str) -> Optional[dict]:
+        """類似度がしきい値以上で、質問の用語（条番号など）が同じ期限内のエントリのうち、最も近いものを返す"""
+        entries, matrix = self._load(version)
+        if not entries:
+            self._incr("misses"); return None
+        query = np.asarray(vector, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        scores = matrix @ query
+        candidates = np.flatnonzero(scores >= self.threshold)
+        terms, now = sorted(extract_key_terms(question)), time.time()
+        for i in candidates[np.argsort(-scores[candidates])]:
+            entry = entries[i]
+            if entry["terms"] != terms or now - entry["created_at"] > self.ttl_seconds: continue
+            with self._lock:
+                self.stats["hits"] += 1
+                self.stats["saved_seconds"] += entry.get("elapsed", 0.0)
+            return dict(entry, similarity=float(scores[i]))
+        self._incr("misses"); return None
+
+    def store(self, question: str, vector: list[float], reply: str, sources: list[str], elapsed: float, version: str):
+        entry = {"question": question, "terms": sorted(extract_key_terms(question)), "vector": pack_vector(vector), "reply": reply,
+                 "sources": sources, "elapsed": round(elapsed, 3), "created_at": time.time()}
+        key, field = self._key(version), uuid.uuid4().hex
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.hset(key, field, json.dumps(entry, ensure_ascii=False))
+            pipe.expire(key, self.ttl_seconds)
+            pipe.execute()
+            self._incr("stores")
+        except Exception as e:
+            print(f"回答キャッシュの保存でエラー: {e}"); self._incr("errors")
+            return
+        # ハッシュ全体を読み直さず、同じバージョンのミラーの先頭（新しい順）に足す。他プロセスの分はrefresh_secondsごとの読み直しで拾う
+        row = np.asarray(vector, dtype=np.float32)
+        row /= max(float(np.linalg.norm(row)), 1e-12)
+        with self._lock:
+            mirror = self._mirror
+            if mirror["version"] != version or mirror["matrix"] is None and mirror["entries"]: return
+            entries = [dict(entry, field=field)] + mirror["entries"][:self.max_entries - 1]
+            matrix = row[None, :] if mirror["matrix"] is None else np.vstack([row, mirror["matrix"][:len(entries) - 1]])
+            self._mirror = dict(mirror, entries=entries, matrix=matrix)
+
+    def metrics(self) -> dict:
+        with self._lock: stats = dict(self.stats); stats["entries"] = len(self._mirror["entries"])
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["saved_seconds"] = round(stats["saved_seconds"], 3)
+        return stats
+
+    def _load(self, version: str) -> tuple[list[dict], Optional[np.ndarray]]:
+        """Redisのエントリをrefresh_seconds間隔で読み直し、期限切れ・上限超過分を掃除する"""
+        with self._lock:
+            mirror = self._mirror
+            if mirror["version"] == version and time.time() - mirror["loaded_at"] < self.refresh_seconds:
+                return mirror["entries"], mirror["matrix"]
+        key = self._key(version)
+        try:
+            raw = self.redis_client.hgetall(key)
+        except Exception as e:
+            print(f"回答キャッシュの読み込みでエラー: {e}"); self._incr("errors")
+            return [], None
+
+        now, entries, expired = time.time(), [], []
+        for field, value in raw.items():
+            entry = json.loads(value)
+            if now - entry["created_at"] > self.ttl_seconds: expired.append(field); continue
+            if "terms" not in entry: entry["terms"] = sorted(extract_key_terms(entry["question"]))  # 用語を保存する前のエントリ
+            entry["field"] = field; entries.append(entry)
+        entries.sort(key=lambda e: e["created_at"], reverse=True)
+        expired += [e["field"] for e in entries[self.max_entries:]]
+        entries = entries[:self.max_entries]
+        if expired:
+            try: self.redis_client.hdel(key, *expired)
+            except Exception as e: print(f"回答キャッシュの掃除でエラー: {e}")
+
+        matrix = None
+        if entries:
+            matrix = np.asarray([unpack_vector(e["vector"]) for e in entries], dtype=np.float32)
+            matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            self._mirror = {"version": version, "loaded_at": time.time(), "entries": entries, "matrix": matrix}
+        return entries, matrix
+
+    def _incr(self, key: str, n: int = 1):
+        with self._lock: self.stats[key] += n
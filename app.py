@@ -11,26 +11,43 @@ import requests
 import time
 import textwrap
 import uuid
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
+from functools import lru_cache
+from typing import Callable, Optional
 
 from flask import Flask, request
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage,
     ImageSendMessage, ImageMessage, StickerMessage
 )
 
 # --- AI & Cloud Libraries ---
-import google.generativeai as genai
-from google.oauth2 import service_account
-from google.auth.transport.requests import Request
-import redis
-import pinecone
+# google.generativeai / google.oauth2 / redis / pinecone / numpy はimportが重いので、
+# コールドスタートを速くするため各クライアントを最初に使うときにimportする（lazy_client.py）
 from dotenv import load_dotenv
 
 # --- 他のPythonファイルからインポート ---
-from character_makot import MAKOT, build_system_prompt, apply_expression_style
+from character_makot import PERSONA_PREFIX, build_chat_prompt, apply_expression_style
+from event_queue import EventQueue, RedisEventQueue
+from event_dedup import EventDeduplicator
+from memory_worker import MemoryConsolidator
+from embedding_client import VertexEmbeddingClient
+from gcp_auth import GcpTokenProvider
+from embedding_cache import EmbeddingCache
+from lazy_client import LazyClient
+from chat_history import ChatHistoryStore
+from http_client import get_upstream, upstream_metrics
+from tracing import span, traced_handler, submit_with_context, metrics, format_sample, format_histogram, format_stats
+from image_jobs import ImageJobQueue
+from room_coalescer import RoomCoalescer
+from image_pipeline import ReactionCache, ImageTooLargeError, read_stream, prepare_image
+from prompt_builder import CachedPrefixModel, PromptBudget, estimate_tokens
+from gemini_scheduler import GeminiScheduler, GeminiOverloadedError, OPTIONAL, BACKGROUND
+from triggers import TRIGGER_KEYWORDS, matcher as triggers_matcher, classify, IMAGE, QA, HOBBY, WORK, EMOTION_HIGH, EMOTION_LOW, NICKNAME, UNCERTAIN
+from lexical_index import can_skip_expansion, extract_key_terms, fuse_vector_and_lexical, is_context_match
 
 # ------------------------------------------------------------
 # 初期化処理
@@ -49,62 +66,203 @@ GCP_CREDENTIALS_JSON_STR  = os.getenv("GCP_CREDENTIALS_JSON")
 REDIS_URL                 = os.getenv("REDIS_URL")
 PINECONE_API_KEY          = os.getenv("PINECONE_API_KEY")
 PINECONE_INDEX_NAME       = os.getenv("PINECONE_INDEX_NAME")
+# --- 接続先（ベンチマークなどでローカルの偽サーバーに向けるときだけ上書きする） ---
+VERTEX_API_BASE           = os.getenv("VERTEX_API_BASE", f"https://{GCP_LOCATION}-aiplatform.googleapis.com")
+IMGUR_API_BASE            = os.getenv("IMGUR_API_BASE", "https://api.imgur.com")
+LINE_API_ENDPOINT         = os.getenv("LINE_API_ENDPOINT", LineBotApi.DEFAULT_API_ENDPOINT)
+LINE_API_DATA_ENDPOINT    = os.getenv("LINE_API_DATA_ENDPOINT", LineBotApi.DEFAULT_API_DATA_ENDPOINT)
 # ★★★ モデル名を環境変数から読み込むように変更 ★★★
 TEXT_MODEL_NAME           = os.getenv("TEXT_MODEL_NAME", "gemini-2.5-flash-preview-05-20")
 VERTEX_EMBEDDING_MODEL    = os.getenv("VERTEX_EMBEDDING_MODEL", "text-multilingual-embedding-002")
 RAG_SCORE_THRESHOLD       = float(os.getenv("RAG_SCORE_THRESHOLD", 0.55))
+LOCAL_DOCS_INDEX          = os.getenv("LOCAL_DOCS_INDEX")  # 例: "company_docs_index"（設定時はPineconeの代わりにローカルスナップショットで検索）
+LEXICAL_DOCS_INDEX        = os.getenv("LEXICAL_DOCS_INDEX")  # 例: "company_docs_lexical.json"（設定時はBM25の語彙検索を併用する）
+LEXICAL_TOP_K             = int(os.getenv("LEXICAL_TOP_K", 5))
+ANSWER_CACHE_ENABLED      = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD    = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_TTL          = int(os.getenv("ANSWER_CACHE_TTL", 24 * 3600))
+DOCS_VERSION_KEY          = "company_docs:version"  # index_documents.py が再インデックスのたびに更新する
+EMBEDDING_CACHE_SIZE      = int(os.getenv("EMBEDDING_CACHE_SIZE", 2048))
+EMBEDDING_CACHE_TTL       = int(os.getenv("EMBEDDING_CACHE_TTL", 30 * 24 * 3600))
+# --- Webhook非同期処理の設定 ---
+ASYNC_WEBHOOK             = os.getenv("ASYNC_WEBHOOK", "false").lower() == "true"
+EVENT_QUEUE_BACKEND       = os.getenv("EVENT_QUEUE_BACKEND", "redis" if REDIS_URL else "memory")
+EVENT_QUEUE_SIZE          = int(os.getenv("EVENT_QUEUE_SIZE", 100))
+EVENT_WORKERS             = int(os.getenv("EVENT_WORKERS", 4))
+EVENT_QUEUE_PUT_TIMEOUT   = float(os.getenv("EVENT_QUEUE_PUT_TIMEOUT", 1.0))
+EVENT_DEDUP_TTL           = int(os.getenv("EVENT_DEDUP_TTL", 24 * 3600))  # 同じwebhookEventIdを重複とみなす期間（秒）
+EVENT_PROCESSING_TTL      = int(os.getenv("EVENT_PROCESSING_TTL", 60))  # 処理中の記録の期限（秒）。関数の最大実行時間に合わせる
+# --- 返信の時間予算（超えたら先に受付メッセージを返し、回答はpush_messageで送る） ---
+REPLY_TIME_BUDGET         = float(os.getenv("REPLY_TIME_BUDGET", 5.0))
+REPLY_WORKERS             = int(os.getenv("REPLY_WORKERS", 16))
+# --- 長期記憶の統合（N行たまるか、一定時間発言が無ければバックグラウンドで要約・保存） ---
+MEMORY_TURNS_THRESHOLD    = int(os.getenv("MEMORY_TURNS_THRESHOLD", 4))
+MEMORY_IDLE_SECONDS       = float(os.getenv("MEMORY_IDLE_SECONDS", 300))
+# 応答後もスレッドが動き続ける常駐プロセスでだけtrueにする（既定はASYNC_WEBHOOKと同じ。falseなら返信を送った後、同じリクエストの中で要約・保存する）
+MEMORY_BACKGROUND         = os.getenv("MEMORY_BACKGROUND", str(ASYNC_WEBHOOK)).lower() == "true"
+MEMORY_MAX_TURNS          = 12
+MEMORY_MIN_CHARS          = 50  # これより短い会話は要約せず、続きの発言がたまるのを待つ
+# --- 会話履歴（ユーザーごとのRedisリスト。プロンプトには直近HISTORY_CONTEXT_TURNS行だけ読む） ---
+HISTORY_MAX_ENTRIES       = int(os.getenv("HISTORY_MAX_ENTRIES", 50))
+HISTORY_TTL_SECONDS       = int(os.getenv("HISTORY_TTL_SECONDS", 30 * 24 * 3600))
+HISTORY_CONTEXT_TURNS     = 12
+# --- 画像生成のジョブキュー（ユーザーごとのレート制限と、お題 → ImgurのURLのキャッシュ） ---
+IMAGE_WORKERS             = int(os.getenv("IMAGE_WORKERS", 2))
+IMAGE_QUEUE_SIZE          = int(os.getenv("IMAGE_QUEUE_SIZE", 10))
+IMAGE_RATE_LIMIT          = int(os.getenv("IMAGE_RATE_LIMIT", 3))  # IMAGE_RATE_WINDOW秒あたりの回数（0で無制限）
+IMAGE_RATE_WINDOW         = int(os.getenv("IMAGE_RATE_WINDOW", 600))
+IMAGE_CACHE_TTL           = int(os.getenv("IMAGE_CACHE_TTL", 7 * 24 * 3600))
+# 応答後もスレッドが動き続ける常駐プロセスでだけtrueにする（既定はASYNC_WEBHOOKと同じ。falseならリクエストの中で生成して届ける）
+IMAGE_JOBS_BACKGROUND     = os.getenv("IMAGE_JOBS_BACKGROUND", str(ASYNC_WEBHOOK)).lower() == "true"
+# --- 画像メッセージへのリアクション（縮小してからGeminiに送り、同じ画像へのリアクションはキャッシュする） ---
+IMAGE_MAX_SIDE            = int(os.getenv("IMAGE_MAX_SIDE", 768))
+IMAGE_JPEG_QUALITY        = int(os.getenv("IMAGE_JPEG_QUALITY", 85))
+IMAGE_MAX_DOWNLOAD_BYTES  = int(os.getenv("IMAGE_MAX_DOWNLOAD_BYTES", 10 * 1024 * 1024))
+IMAGE_REACTION_CACHE_TTL  = int(os.getenv("IMAGE_REACTION_CACHE_TTL", 7 * 24 * 3600))
+# --- グループ・トークルームでの呼びかけ（短い窓の間の呼びかけをまとめて1回で返事し、ルームごとに回数を制限する） ---
+# 秒。0ならまとめずに1件ずつ返事する。返事は応答後のタイマースレッドから送るので、常駐プロセス（ASYNC_WEBHOOK=true）でだけ既定で有効にする
+ROOM_COALESCE_WINDOW      = float(os.getenv("ROOM_COALESCE_WINDOW", 2.0 if ASYNC_WEBHOOK else 0))
+ROOM_RATE_PER_MINUTE      = float(os.getenv("ROOM_RATE_PER_MINUTE", 6))
+ROOM_BURST                = int(os.getenv("ROOM_BURST", 3))
+ROOM_MAX_WAIT             = float(os.getenv("ROOM_MAX_WAIT", 20.0))  # 枠が空くのを待つ上限（超えたらLLMを使わずに返事する）
+# --- Gemini呼び出しの流量制御（返信 > クエリ拡張 > 要約・翻訳 の優先度で順番待ちさせる） ---
+GEMINI_RPM                = float(os.getenv("GEMINI_RPM", 60))
+GEMINI_BURST              = int(os.getenv("GEMINI_BURST", 10))
+GEMINI_MAX_WAIT           = float(os.getenv("GEMINI_MAX_WAIT", 10.0))  # 返信の呼び出しが枠を待つ上限（秒）
+GEMINI_COOLDOWN_SECONDS   = float(os.getenv("GEMINI_COOLDOWN_SECONDS", 10.0))  # 429を受けたら止める秒数
+# --- プロンプトの組み立て（静的な接頭辞はsystem_instruction / コンテキストキャッシュ、会話ごとの部分はトークン予算内に収める） ---
+PROMPT_CACHE_TTL          = int(os.getenv("PROMPT_CACHE_TTL", 0))  # 秒。0ならコンテキストキャッシュを使わない
+CHAT_PROMPT_TOKEN_BUDGET  = int(os.getenv("CHAT_PROMPT_TOKEN_BUDGET", 2000))
+QA_PROMPT_TOKEN_BUDGET    = int(os.getenv("QA_PROMPT_TOKEN_BUDGET", 6000))
+# --- Q&A検索の並列化設定 ---
+QA_SEARCH_WORKERS         = int(os.getenv("QA_SEARCH_WORKERS", 8))
+QA_EMBED_TIMEOUT          = float(os.getenv("QA_EMBED_TIMEOUT", 5.0))
+QA_QUERY_TIMEOUT          = float(os.getenv("QA_QUERY_TIMEOUT", 5.0))
 
 
 # --- 各種クライアントの初期化 ---
-genai.configure(api_key=GEMINI_API_KEY, transport="rest")
-text_model = genai.GenerativeModel(TEXT_MODEL_NAME)
-line_bot_api    = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-webhook_handler = WebhookHandler(LINE_CHANNEL_SECRET)
-if not REDIS_URL: raise ValueError("REDIS_URL 環境変数が設定されていません。")
-redis_client = redis.from_url(REDIS_URL, decode_responses=True)
-gcp_token_cache = {"token": None, "expires_at": 0}
+def _configure_gemini():
+    import google.generativeai as genai
+    genai.configure(api_key=GEMINI_API_KEY, transport="rest")
+    return genai
+
+def _create_text_model():
+    return _configure_gemini().GenerativeModel(TEXT_MODEL_NAME)
+
+def _create_chat_model():
+    _configure_gemini()
+    return CachedPrefixModel(TEXT_MODEL_NAME, PERSONA_PREFIX, cache_ttl_seconds=PROMPT_CACHE_TTL, display_name="makot-persona")
+
+def _create_qa_model():
+    _configure_gemini()
+    return CachedPrefixModel(TEXT_MODEL_NAME, QA_SYSTEM_INSTRUCTION, cache_ttl_seconds=PROMPT_CACHE_TTL, display_name="makot-qa")
+
+def _create_redis_client():
+    if not REDIS_URL: raise ValueError("REDIS_URL 環境変数が設定されていません。")
+    import redis
+    return redis.from_url(REDIS_URL, decode_responses=True)
+
+def _create_pinecone_index():
+    if not PINECONE_API_KEY or not PINECONE_INDEX_NAME:
+        raise ValueError("Pineconeの環境変数(API_KEY, INDEX_NAME)が設定されていません。")
+    import pinecone
+    return pinecone.Pinecone(api_key=PINECONE_API_KEY).Index(PINECONE_INDEX_NAME)
+
+text_model     = LazyClient(_create_text_model, "Gemini")
+chat_model     = LazyClient(_create_chat_model, "Gemini（通常会話）")
+qa_model       = LazyClient(_create_qa_model, "Gemini（Q&A）")
+gemini         = GeminiScheduler(GEMINI_RPM, GEMINI_BURST, max_wait=GEMINI_MAX_WAIT, cooldown_seconds=GEMINI_COOLDOWN_SECONDS)
+redis_client   = LazyClient(_create_redis_client, "Redis")
+pinecone_index = LazyClient(_create_pinecone_index, "Pinecone")
+
+class PooledLineHttpClient(RequestsHttpClient):
+    """line-bot-sdk のHTTP通信を共通レイヤー（http_client.py）のコネクションプール経由にする
+
+    reply tokenは1回しか使えず、pushも再送すると二重に届くので、POSTは再試行せずGET（画像の取得など）だけ再試行する。
+    """
+    def __init__(self, timeout=RequestsHttpClient.DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.upstream = get_upstream("line", read_timeout=10.0, retry_methods={"GET"})
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return RequestsHttpResponse(self.upstream.get(url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout))
+    def post(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.upstream.post(url, headers=headers, data=data, timeout=timeout or self.timeout))
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.upstream.request("DELETE", url, headers=headers, data=data, timeout=timeout or self.timeout))
+    def put(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.upstream.request("PUT", url, headers=headers, data=data, timeout=timeout or self.timeout))
+
+def _create_line_bot_api():
+    if not LINE_CHANNEL_ACCESS_TOKEN: raise ValueError("LINE_CHANNEL_ACCESS_TOKEN 環境変数が設定されていません。")
+    return LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, endpoint=LINE_API_ENDPOINT, data_endpoint=LINE_API_DATA_ENDPOINT, http_client=PooledLineHttpClient)
+
+line_bot_api    = LazyClient(_create_line_bot_api, "LINE Messaging API")
+imgur_http      = get_upstream("imgur", read_timeout=30.0, retry_methods={"GET"})  # アップロードは冪等でない
+vertex_image_http = get_upstream("vertex_image", read_timeout=60.0, max_retries=1)
+webhook_handler = WebhookHandler(LINE_CHANNEL_SECRET or "")  # 未設定なら署名検証がすべて失敗して400を返す（ヘルスチェックは通す）
+get_gcp_token   = GcpTokenProvider(GCP_CREDENTIALS_JSON_STR)  # ウォームなコンテナでは次のリクエストでもトークンを使い回す
+image_reactions = ReactionCache(redis_client, ttl_seconds=IMAGE_REACTION_CACHE_TTL)
+chat_history = ChatHistoryStore(redis_client, max_entries=HISTORY_MAX_ENTRIES, entry_ttl_seconds=HISTORY_TTL_SECONDS)
+
+@lru_cache(maxsize=None)
+def get_local_docs_index():
+    """company-docsのローカルスナップショットを読み込む。無効・読み込み失敗時はNone（Pineconeで検索する）"""
+    if not LOCAL_DOCS_INDEX: return None
+    try:
+        from local_index import LocalVectorIndex
+        index = LocalVectorIndex.load(LOCAL_DOCS_INDEX)
+        print(f"ローカル検索インデックスを読み込みました: {len(index)}件 (version: {index.version})")
+        return index
+    except Exception as e:
+        print(f"ローカル検索インデックスの読み込みに失敗したためPineconeを使います: {e}")
+        return None
+
+@lru_cache(maxsize=None)
+def get_lexical_docs_index():
+    """company-docsの語彙検索インデックスを読み込む。無効・読み込み失敗時はNone（ベクトル検索のみ）"""
+    if not LEXICAL_DOCS_INDEX: return None
+    try:
+        from lexical_index import BigramBM25Index
+        index = BigramBM25Index.load(LEXICAL_DOCS_INDEX)
+        print(f"語彙検索インデックスを読み込みました: {len(index)}件 (version: {index.version})")
+        return index
+    except Exception as e:
+        print(f"語彙検索インデックスの読み込みに失敗したためベクトル検索のみで回答します: {e}")
+        return None
 
-if not PINECONE_API_KEY or not PINECONE_INDEX_NAME:
-    raise ValueError("Pineconeの環境変数(API_KEY, INDEX_NAME)が設定されていません。")
-pc = pinecone.Pinecone(api_key=PINECONE_API_KEY)
-pinecone_index = pc.Index(PINECONE_INDEX_NAME)
+@lru_cache(maxsize=None)
+def get_answer_cache():
+    if not ANSWER_CACHE_ENABLED: return None
+    from answer_cache import SemanticAnswerCache
+    return SemanticAnswerCache(redis_client, threshold=ANSWER_CACHE_THRESHOLD, ttl_seconds=ANSWER_CACHE_TTL)
+
+def get_docs_index_version() -> str:
+    """company-docsのインデックスのバージョン（Redis → ローカルのスナップショットの順に参照）"""
+    try:
+        version = redis_client.get(DOCS_VERSION_KEY)
+        if version: return version
+    except Exception as e: print(f"インデックスのバージョン取得でエラー: {e}")
+    for index in (get_local_docs_index(), get_lexical_docs_index()):
+        if index is not None and index.version: return index.version
+    return "unversioned"
+event_dedup = EventDeduplicator(redis_client, ttl_seconds=EVENT_DEDUP_TTL, processing_ttl_seconds=EVENT_PROCESSING_TTL)
+event_executor = ThreadPoolExecutor(max_workers=EVENT_WORKERS, thread_name_prefix="event")
+qa_executor = ThreadPoolExecutor(max_workers=QA_SEARCH_WORKERS, thread_name_prefix="qa-search")
+reply_executor = ThreadPoolExecutor(max_workers=REPLY_WORKERS, thread_name_prefix="reply")
 
 
 # ------------------------------------------------------------
 # ベクトル化 & RAG関連関数
 # ------------------------------------------------------------
-def get_gcp_token() -> str:
-    if gcp_token_cache["token"] and time.time() < gcp_token_cache["expires_at"]: return gcp_token_cache["token"]
-    if not GCP_CREDENTIALS_JSON_STR: raise ValueError("GCP_CREDENTIALS_JSON 環境変数が設定されていません。")
-    try:
-        credentials_info = json.loads(GCP_CREDENTIALS_JSON_STR); creds = service_account.Credentials.from_service_account_info(credentials_info, scopes=["https://www.googleapis.com/auth/cloud-platform"])
-        creds.refresh(Request());
-        if not creds.token: raise ValueError("トークンの取得に失敗しました。")
-        gcp_token_cache["token"] = creds.token; gcp_token_cache["expires_at"] = time.time() + 3300
-        return creds.token
-    except Exception as e: print(f"get_gcp_tokenでエラー: {e}"); raise
+embedding_cache = EmbeddingCache(redis_client, max_local_entries=EMBEDDING_CACHE_SIZE, ttl_seconds=EMBEDDING_CACHE_TTL)
+embedding_client = VertexEmbeddingClient(GCP_PROJECT_ID, GCP_LOCATION, VERTEX_EMBEDDING_MODEL, token_provider=get_gcp_token, cache=embedding_cache,
+                                         api_base=VERTEX_API_BASE)
 
 def _get_vertex_embedding(text: str, task_type: str) -> list[float]:
     """Vertex AIのEmbeddingモデルを呼び出す共通関数"""
     if not text:
         return []
-    try:
-        token = get_gcp_token()
-        endpoint_url = (f"https://{GCP_LOCATION}-aiplatform.googleapis.com/v1/projects/{GCP_PROJECT_ID}"
-                        f"/locations/{GCP_LOCATION}/publishers/google/models/{VERTEX_EMBEDDING_MODEL}:predict")
-        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json; charset=utf-8"}
-        data = {"instances": [{"content": text, "task_type": task_type}]}
-        response = requests.post(endpoint_url, headers=headers, json=data)
-        response.raise_for_status()
-        response_data = response.json()
-        if "predictions" not in response_data or not response_data["predictions"]:
-             print(f"Vertex AIからembeddingが返されませんでした: {response_data}")
-             return []
-        embedding = response_data["predictions"][0]["embeddings"]["values"]
-        return embedding
-    except Exception as e:
-        print(f"Vertex AI ベクトル化エラー: {e}")
-        return []
+    return embedding_client.embed([text], task_type)[0]
 
 def get_embedding(text: str) -> list[float]:
     """テキストをベクトルに変換する（通常会話の記憶検索用）"""
@@ -114,10 +272,14 @@ def get_qa_embedding(text: str, task_type="RETRIEVAL_QUERY") -> list[float]:
     """Q&A検索用のテキストをベクトルに変換する"""
     return _get_vertex_embedding(text, task_type=task_type)
 
-def summarize_and_store_memory(user_id: str, history: list[str]):
-    """会話を要約し、ベクトル化してPineconeに長期記憶として保存する"""
-    recent_talk = "\n".join(history[-4:])
-    if len(recent_talk) < 50: return
+def get_qa_embeddings(texts: list[str], task_type="RETRIEVAL_QUERY") -> list[list[float]]:
+    """Q&A検索用の複数テキストを1回のリクエストでまとめてベクトル化する"""
+    return embedding_client.embed(texts, task_type, timeout=QA_EMBED_TIMEOUT)
+
+def summarize_memory(turns: list[str]) -> Optional[str]:
+    """会話を要約して長期記憶にするメモを返す（重要な情報が無ければNone）"""
+    recent_talk = "\n".join(turns[-MEMORY_MAX_TURNS:])
+    if len(recent_talk) < MEMORY_MIN_CHARS: return None
 
     summary_prompt = textwrap.dedent(f"""
         あなたはユーザーとの会話の要約担当です。以下の会話から、ユーザーの個人的な情報（名前、好み、最近の出来事、ペット、悩み、計画など）を抽出し、簡潔な箇条書きのメモとして1～2行で要約してください。重要な情報が含まれていない場合は、必ず「特になし」とだけ出力してください。
@@ -126,25 +288,46 @@ def summarize_and_store_memory(user_id: str, history: list[str]):
         {recent_talk}
         ---
         要約:""")
-    try:
-        summary_response = text_model.generate_content(summary_prompt)
-        summary = summary_response.text.strip()
-
-        if summary and "特になし" not in summary:
-            vector = get_embedding(summary)
-            if not vector: return
-
-            memory_id = str(uuid.uuid4())
-            metadata = { "user_id": user_id, "text": summary, "created_at": time.time() }
-            pinecone_index.upsert(vectors=[(memory_id, vector, metadata)], namespace="conversation-memory")
-            print(f"[{user_id}] の新しい記憶をベクトルDBに保存しました: {summary}")
-    except Exception as e:
-        print(f"記憶の保存処理でエラー: {e}")
+    summary_response = gemini.generate(text_model, summary_prompt, priority=BACKGROUND)
+    summary = summary_response.text.strip()
+    return summary if summary and "特になし" not in summary else None
+
+def store_memories(items: list[tuple[str, str]]):
+    """(user_id, 要約) をまとめてベクトル化し、1回のupsertでPineconeに長期記憶として保存する"""
+    vectors = embedding_client.embed([summary for _, summary in items], "RETRIEVAL_DOCUMENT")
+    records = [(str(uuid.uuid4()), vector, {"user_id": user_id, "text": summary, "created_at": time.time()})
+               for (user_id, summary), vector in zip(items, vectors) if vector]
+    if not records: return
+    pinecone_index.upsert(vectors=records, namespace="conversation-memory")
+    for _, _, metadata in records: print(f"[{metadata['user_id']}] の新しい記憶をベクトルDBに保存しました: {metadata['text']}")
+
+memory_consolidator = MemoryConsolidator(summarize_memory, store_memories, turns_threshold=MEMORY_TURNS_THRESHOLD, idle_seconds=MEMORY_IDLE_SECONDS,
+                                         min_chars=MEMORY_MIN_CHARS, background=MEMORY_BACKGROUND)
+
+MARKDOWN_RE = re.compile(r'[\*`＊∗]+')
+SENTENCE_END_RE = re.compile(r'[。！？]')
+MAX_REPLY_SENTENCES = 2  # post_process は文末記号が3つ以上あると先頭2文に切り詰める
+
+def stream_generate(prompt, stop_after_sentences: Optional[int] = None, model=None) -> str:
+    """Geminiの応答をストリーミングで受け取り、Markdown記号を逐次取り除きながら連結する
+
+    stop_after_sentences 個の文末記号が揃った時点で受信を打ち切る（どうせ切り詰められる続きを待たない）。
+    """
+    parts, sentence_ends = [], 0
+    for chunk in gemini.generate(model or text_model, prompt, stream=True):
+        try: piece = chunk.text
+        except ValueError: continue  # 安全性フィルタなどでテキストの無いチャンク
+        piece = MARKDOWN_RE.sub('', piece)
+        parts.append(piece)
+        if stop_after_sentences:
+            sentence_ends += len(SENTENCE_END_RE.findall(piece))
+            if sentence_ends >= stop_after_sentences: break
+    return "".join(parts).strip()
 
 # ------------------------------------------------------------
 # Q&Aモードと通常会話モードの処理
 # ------------------------------------------------------------
-QA_SYSTEM_PROMPT = textwrap.dedent("""
+QA_SYSTEM_INSTRUCTION = textwrap.dedent("""
     あなたは、後輩女子『まこT』として、提供された参考情報に【基づいてのみ】ユーザーの質問に回答するアシスタントです。
     あなたの役割は、参考情報の内容を分かりやすく、親しみやすい口調で要約して伝えることです。
 
@@ -152,7 +335,9 @@ QA_SYSTEM_PROMPT = textwrap.dedent("""
     - 必ず参考情報に含まれる事実だけを使って回答してください。
     - 参考情報に答えがない場合や、関連性が低い場合は、絶対に推測で答えてはいけません。代わりに「うーん、その情報は見当たらないですね…！ごめんなさい🥺」と正直に回答してください。
     - 回答の最後に見つかった出典（source）をすべて、 `(参考: ファイル名1, ファイル名2)` のようにカンマ区切りで付け加えてください。
+""").strip()
 
+QA_PROMPT_TEMPLATE = textwrap.dedent("""
     【参考情報】
     {context}
 
@@ -160,7 +345,9 @@ QA_SYSTEM_PROMPT = textwrap.dedent("""
     {question}
 
     以上のルールを厳格に守り、『まこT』として回答してください：
-""")
+""").strip()
+
+BUSY_REPLY = "ごめんなさい、いまちょっと混み合ってて頭が回らないです…🥺 少ししてからもう一度話しかけてください！"
 
 def expand_query(question: str) -> list[str]:
     """LLMを使って質問を複数の表現に拡張する"""
@@ -171,130 +358,191 @@ def expand_query(question: str) -> list[str]:
         書き換え:
     """)
     try:
-        response = text_model.generate_content(prompt)
+        response = gemini.generate(text_model, prompt, priority=OPTIONAL)
         queries = [line.strip().lstrip('- ') for line in response.text.strip().split('\n') if line.strip()]
         return list(set(queries)) # 重複を削除
+    except GeminiOverloadedError as e:
+        print(f"クエリ拡張を省略して元の質問だけで検索します: {e}")
+        return [question]
     except Exception as e:
         print(f"クエリ拡張エラー: {e}")
         return [question]
 
-def _handle_qa_request(user_input: str, user_id: str) -> str:
-    """Q&Aモードの処理を担当する"""
+def _run_parallel(func: Callable, items: list, timeout: float, stage: str) -> list[tuple]:
+    """itemsをスレッドプールで並列に処理し、timeout内に終わった (item, 結果) だけを入力順で返す"""
+    futures = [submit_with_context(qa_executor, func, item) for item in items]
+    _, not_done = wait(futures, timeout=timeout)
+    results = []
+    for i, (item, future) in enumerate(zip(items, futures)):
+        if future in not_done:
+            future.cancel(); print(f"  [{stage}] {i+1}件目がタイムアウトしたため除外します。")
+            continue
+        try: results.append((item, future.result()))
+        except Exception as e: print(f"  [{stage}] {i+1}件目がエラーのため除外します: {e}")
+    return results
+
+def _query_company_docs(query_vector: list[float]):
+    return pinecone_index.query(vector=query_vector, top_k=3, namespace="company-docs", include_metadata=True)
+
+def _handle_qa_request(user_input: str, user_id: str, remember: bool = True) -> str:
+    """Q&Aモードの処理を担当する（remember=Falseなら回答キャッシュに保存しない）"""
     print(f"[{user_id}] Q&Aモードで実行します。")
+    answer_cache, local_docs_index, lexical_docs_index = get_answer_cache(), get_local_docs_index(), get_lexical_docs_index()
     try:
-        expanded_queries = expand_query(user_input)
-        print(f"  [クエリ拡張] 元の質問: '{user_input}' -> 拡張後: {expanded_queries}")
-
-        all_matches = {}
-        for query in expanded_queries:
-            query_vector = get_qa_embedding(query)
-            if not query_vector: continue
-
-            query_response = pinecone_index.query(
-                vector=query_vector, top_k=3, namespace="company-docs", include_metadata=True
-            )
-            for match in query_response['matches']:
-                if match.id not in all_matches or match.score > all_matches[match.id].score:
-                    all_matches[match.id] = match
-
-        sorted_matches = sorted(all_matches.values(), key=lambda x: x.score, reverse=True)
-        context_chunks, sources = [], set()
-        
+        started_at = time.time()
+        question_vector, docs_version = [], None
+        if answer_cache is not None:
+            with span("qa.answer_cache") as sp:
+                # 検索でも元の質問そのままをベクトル化する場合（拡張を省いた・見送った、または拡張結果に元の質問が残った）は
+                # Embeddingキャッシュに当たる。拡張結果が元の質問を言い換えただけなら、この1回分は余計にかかる
+                question_vector = get_qa_embeddings([user_input])[0]
+                docs_version = get_docs_index_version()
+                cached = answer_cache.lookup(user_input, question_vector, docs_version) if question_vector else None
+                sp["hit"] = bool(cached)
+            if cached:
+                print(f"  [回答キャッシュ] ヒット (類似度: {cached['similarity']:.4f}, 元の質問: '{cached['question']}', 節約: {cached['elapsed']:.2f}秒) {answer_cache.metrics()}")
+                return cached["reply"]
+
+        lexical_hits, strong_lexical, key_terms = [], set(), []
+        if lexical_docs_index is not None:
+            with span("qa.lexical") as sp:
+                key_terms = extract_key_terms(user_input)
+                lexical_hits = lexical_docs_index.search(user_input, top_k=LEXICAL_TOP_K)
+                strong_lexical = {m.id for m in lexical_hits if lexical_docs_index.contains_all(m.id, key_terms)}
+                sp.update(hits=len(lexical_hits), strong=len(strong_lexical))
+
+        # 条番号や専門用語がそのまま含まれるチャンクが見つかったら、一番遅いLLMのクエリ拡張を省く
+        if can_skip_expansion(user_input, key_terms, lexical_hits, strong_lexical):
+            expanded_queries = [user_input]
+            print(f"  [語彙検索] 用語 {key_terms} が完全一致したためクエリ拡張を省略します。")
+        else:
+            with span("qa.expand_query") as sp:
+                expanded_queries = expand_query(user_input); sp["queries"] = len(expanded_queries)
+            print(f"  [クエリ拡張] 元の質問: '{user_input}' -> 拡張後: {expanded_queries}")
+
+        # 拡張クエリはまとめて1回でベクトル化し、検索はローカルなら行列積1回、Pineconeなら並列実行して間に合った分だけで回答する
+        with span("qa.embed", texts=len(expanded_queries)):
+            query_vectors = [v for v in get_qa_embeddings(expanded_queries) if v]
+        with span("qa.search", backend="local" if local_docs_index is not None else "pinecone") as sp:
+            if local_docs_index is not None:
+                responses = local_docs_index.query_many(query_vectors, top_k=3)
+            else:
+                responses = [r for _, r in _run_parallel(_query_company_docs, query_vectors, QA_QUERY_TIMEOUT, "Pinecone検索")]
+            sp["responses"] = len(responses)
+
+        # ベクトル検索と語彙検索の順位をRRFで統合する（語彙検索が無効なら従来どおりスコア順）
+        context_chunks, chunk_sources = [], []
+
         print("\n--- 統合後の検索結果 ---")
-        for match in sorted_matches[:5]:
-            print(f"  [検索結果] Score: {match.score:.4f}, Source: {match.metadata['source']}, Chapter: {match.metadata.get('chapter', 'N/A')}")
-            if match.score > RAG_SCORE_THRESHOLD:
+        for match, vector_score, fused_score in fuse_vector_and_lexical(responses, lexical_hits, limit=5):
+            print(f"  [検索結果] Score: {vector_score:.4f}, RRF: {fused_score:.4f}, 語彙一致: {'○' if match.id in strong_lexical else '-'}, Source: {match.metadata['source']}, Chapter: {match.metadata.get('chapter', 'N/A')}")
+            if is_context_match(match, vector_score, strong_lexical, RAG_SCORE_THRESHOLD):
                  context_chunks.append(f"【出典: {match.metadata['source']} / 章: {match.metadata.get('chapter', 'N/A')}】\n{match.metadata['text']}")
-                 sources.add(match.metadata['source'])
+                 chunk_sources.append(match.metadata['source'])
 
         if not context_chunks: return "うーん、その情報は見当たらないですね…！ごめんなさい🥺"
 
+        # チャンクは順位の高い順に予算内に入るだけ使い、出典も実際に渡したチャンクの分だけにする
+        budget = PromptBudget(QA_PROMPT_TOKEN_BUDGET)
+        budget.add("template", QA_PROMPT_TEMPLATE, required=True); budget.add("question", user_input, required=True)
+        context_chunks = budget.add_items("chunks", context_chunks, truncate_first=True)
+        sources = set(chunk_sources[:len(context_chunks)])
+        budget.log("qa", prefix_tokens=estimate_tokens(QA_SYSTEM_INSTRUCTION))
         context_str = "\n---\n".join(context_chunks)
         source_str = f"(参考: {', '.join(sorted(list(sources)))})"
-        prompt = QA_SYSTEM_PROMPT.format(context=context_str, question=user_input)
-        response = text_model.generate_content(prompt)
-        reply = response.text.strip()
-        
+        prompt = QA_PROMPT_TEMPLATE.format(context=context_str, question=user_input)
+        with span("qa.generate", chunks=len(context_chunks)):
+            reply = stream_generate(prompt, model=qa_model)
+
         if "ごめんなさい" not in reply and "参考:" not in reply: reply += f" {source_str}"
         reply = re.sub(r'[\*`＊∗]+', '', reply)
+        if remember and answer_cache is not None and question_vector:
+            answer_cache.store(user_input, question_vector, reply, sorted(sources), time.time() - started_at, docs_version)
         return reply
+    except GeminiOverloadedError as e:
+        print(f"Q&Aの回答生成を見送りました: {e}")
+        return BUSY_REPLY
     except Exception as e:
         print(f"Q&A処理エラー: {e}")
         return "ごめんなさい、なんだかシステムが不調みたいです…。もう一度試してみてください！"
 
-def _handle_normal_chat(user_input: str, user_id: str) -> str:
-    """通常会話モードの処理を担当する"""
+def _handle_normal_chat(user_input: str, user_id: str, remember: bool = True) -> str:
+    """通常会話モードの処理を担当する（remember=Falseなら長期記憶の統合に回さない）"""
     print(f"[{user_id}] 通常会話モードで実行します。")
-    history_key = f"chat_history:{user_id}"
-    history_json = redis_client.get(history_key)
-    history: list[str] = json.loads(history_json) if history_json else []
+    with span("chat.history_read"):
+        history = chat_history.recent(user_id, HISTORY_CONTEXT_TURNS - 1)  # 今回の発言と合わせて直近12行
 
     long_term_memory = None
     try:
-        input_vector = get_embedding(user_input)
+        with span("chat.memory_embed"):
+            input_vector = get_embedding(user_input)
         if input_vector:
-            query_response = pinecone_index.query(
-                vector=input_vector, top_k=3, namespace="conversation-memory",
-                filter={"user_id": user_id}, include_metadata=True
-            )
+            with span("chat.memory_search"):
+                query_response = pinecone_index.query(
+                    vector=input_vector, top_k=3, namespace="conversation-memory",
+                    filter={"user_id": user_id}, include_metadata=True
+                )
             relevant_memories = [m['metadata']['text'] for m in query_response['matches'] if m['score'] > 0.7]
             if relevant_memories:
                 long_term_memory = "\n".join(f"- {mem}" for mem in relevant_memories)
                 print(f"[{user_id}] の関連記憶を検索: {long_term_memory}")
     except Exception as e: print(f"記憶の検索エラー: {e}")
 
-    history.append(f"ユーザー: {user_input}")
-    context = "\n".join(history[-12:])
+    user_line = f"ユーザー: {user_input}"
     topic = guess_topic(user_input)
-    system_prompt = build_system_prompt(context, topic, user_id, long_term_memory)
+    prompt = build_chat_prompt(history + [user_line], topic, long_term_memory, token_budget=CHAT_PROMPT_TOKEN_BUDGET)
     
     try:
-        response = text_model.generate_content(system_prompt)
-        reply = response.text.strip()
+        with span("chat.generate"):
+            reply = stream_generate(prompt, stop_after_sentences=MAX_REPLY_SENTENCES + 1, model=chat_model)
+    except GeminiOverloadedError as e: print(f"返信の生成を見送りました: {e}"); reply = BUSY_REPLY
     except Exception as e: reply = f"エラーが発生しました: {e}"
 
     reply = post_process(reply, user_input)
     pronoun = decide_pronoun(user_input)
     reply = inject_pronoun(reply, pronoun)
-    history.append(f"アシスタント: {reply}")
-    redis_client.set(history_key, json.dumps(history[-50:]))
-    summarize_and_store_memory(user_id, history)
+    assistant_line = f"アシスタント: {reply}"
+    with span("chat.history_write"):
+        chat_history.append(user_id, user_line, assistant_line)
+    if remember: memory_consolidator.add_turns(user_id, [user_line, assistant_line])  # 要約・保存は返信を送った後に行う
     return reply
 
-def chat_with_makot(user_input: str, user_id: str) -> str:
-    """ユーザー入力に応じてQ&Aモードか通常会話モードかを振り分ける"""
-    QA_TRIGGERS = ["教えて", "説明して", "規定", "ルール", "方法", "って何", "とは", "について", "の条件"]
-    is_qa_mode = any(trigger in user_input for trigger in QA_TRIGGERS)
-    return _handle_qa_request(user_input, user_id) if is_qa_mode else _handle_normal_chat(user_input, user_id)
+def chat_with_makot(user_input: str, user_id: str, remember: bool = True) -> str:
+    """ユーザー入力に応じてQ&Aモードか通常会話モードかを振り分ける
+
+    remember=False なら長期記憶・回答キャッシュに書き込まない（グループでまとめた呼びかけのように、本人の発言そのものではない入力用）。
+    """
+    is_qa_mode = QA in classify(user_input)
+    return _handle_qa_request(user_input, user_id, remember) if is_qa_mode else _handle_normal_chat(user_input, user_id, remember)
 
 # ------------------------------------------------------------
 # ユーティリティ & Webhookハンドラ
 # ------------------------------------------------------------
-def is_bot_mentioned(text: str) -> bool: return any(nick in text for nick in [MAKOT["name"]] + MAKOT["nicknames"])
+def is_bot_mentioned(text: str) -> bool: return NICKNAME in classify(text)
 def guess_topic(text: str):
-    hobby_keys = ["趣味", "休日", "ハマって", "コストコ", "ポケポケ"]; work_keys  = ["仕事", "業務", "残業", "請求書", "統計"]
-    if any(k in text for k in hobby_keys): return "hobby"
-    if any(k in text for k in work_keys): return "work"
+    categories = classify(text)
+    if HOBBY in categories: return "hobby"
+    if WORK in categories: return "work"
     return None
 def decide_pronoun(user_text: str) -> str:
-    return "マコ" if random.random() < 0.10 else "おに" if any(k in user_text for k in MAKOT["emotion_triggers"]["high"]) else "私"
+    return "マコ" if random.random() < 0.10 else "おに" if EMOTION_HIGH in classify(user_text) else "私"
 def inject_pronoun(reply: str, pronoun: str) -> str: return re.sub(r"^(私|おに|マコ)", pronoun, reply, count=1)
-UNCERTAIN = ["かも", "かもしれ", "たぶん", "多分", "かな", "と思う", "気がする"]
 def post_process(reply: str, user_input: str) -> str:
-    if any(t in user_input for t in MAKOT["emotion_triggers"]["high"]): reply = apply_expression_style(reply, mood="high")
-    elif any(t in user_input for t in MAKOT["emotion_triggers"]["low"]): reply += " 🥺"
+    input_categories = classify(user_input)
+    if EMOTION_HIGH in input_categories: reply = apply_expression_style(reply, mood="high")
+    elif EMOTION_LOW in input_categories: reply += " 🥺"
     reply = re.sub(r'[\*`＊∗]+', '', reply)
-    if any(w in reply for w in UNCERTAIN) and random.random() < 0.4: reply += " しらんけど"
+    if UNCERTAIN in triggers_matcher.classify(reply) and random.random() < 0.4: reply += " しらんけど"
     reply_sentences = re.split(r'([。！？])', reply)
-    if len(reply_sentences) > 5:
-        processed_reply = "".join(reply_sentences[:4])
+    if len(reply_sentences) > 2 * MAX_REPLY_SENTENCES + 1:
+        processed_reply = "".join(reply_sentences[:2 * MAX_REPLY_SENTENCES])
         reply = processed_reply
     return reply
 def upload_to_imgur(image_bytes: bytes, client_id: str) -> str:
     if not client_id: raise Exception("Imgur Client IDが設定されていません。")
-    url = "https://api.imgur.com/3/image"; headers = {"Authorization": f"Client-ID {client_id}"}
+    url = f"{IMGUR_API_BASE}/3/image"; headers = {"Authorization": f"Client-ID {client_id}"}
     try:
-        response = requests.post(url, headers=headers, data={"image": base64.b64encode(image_bytes)}); response.raise_for_status(); data = response.json()
+        response = imgur_http.post(url, headers=headers, data={"image": base64.b64encode(image_bytes)}); response.raise_for_status(); data = response.json()
         if data.get("success"): return data["data"]["link"]
         else: raise Exception(f"Imgurへのアップロードに失敗しました: {data.get('data', {}).get('error', 'Unknown error')}")
     except requests.exceptions.RequestException as e: raise Exception(f"Imgur APIへのリクエストに失敗しました: {e}")
@@ -302,64 +550,173 @@ def translate_to_english(text: str) -> str:
     if not text: return "a cute girl"
     try:
         prompt = f"Translate the following Japanese into a simple English phrase for an image generation AI. Just the translated phrase.\nJapanese: {text}\nEnglish:"
-        response = text_model.generate_content(prompt); return response.text.strip().replace('"', '')
+        response = gemini.generate(text_model, prompt, priority=BACKGROUND); return response.text.strip().replace('"', '')
     except Exception as e: print(f"翻訳でエラーが発生: {e}"); return text
 def generate_image_with_rest_api(prompt: str) -> str:
-    token = get_gcp_token(); endpoint_url = (f"https://{GCP_LOCATION}-aiplatform.googleapis.com/v1/projects/{GCP_PROJECT_ID}/locations/{GCP_LOCATION}/publishers/google/models/imagegeneration@006:predict")
+    token = get_gcp_token(); endpoint_url = (f"{VERTEX_API_BASE}/v1/projects/{GCP_PROJECT_ID}/locations/{GCP_LOCATION}/publishers/google/models/imagegeneration@006:predict")
     headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json; charset=utf-8"}
     trigger_words = ["画像", "イラスト", "描いて", "絵を"]; clean_prompt = re.sub("|".join(trigger_words), "", prompt).strip()
-    english_prompt = translate_to_english(clean_prompt); final_prompt = f"anime style illustration, masterpiece, best quality, {english_prompt}"
+    with span("image_gen.translate"):
+        english_prompt = translate_to_english(clean_prompt)
+    final_prompt = f"anime style illustration, masterpiece, best quality, {english_prompt}"
     data = {"instances": [{"prompt": final_prompt}], "parameters": {"sampleCount": 1, "aspectRatio": "1:1", "negativePrompt": "low quality, bad hands, text, watermark, signature"}}
-    response = requests.post(endpoint_url, headers=headers, json=data); response.raise_for_status(); response_data = response.json()
+    with span("image_gen.vertex"):
+        response = vertex_image_http.post(endpoint_url, headers=headers, json=data); response.raise_for_status(); response_data = response.json()
     if "predictions" not in response_data or not response_data["predictions"]:
         error_info = response_data.get("error", {}).get("message", json.dumps(response_data)); raise Exception(f"APIから画像データが返されませんでした。サーバーの応答: {error_info}")
     b64_image = response_data["predictions"][0]["bytesBase64Encoded"]; image_bytes = base64.b64decode(b64_image)
-    return upload_to_imgur(image_bytes, IMGUR_CLIENT_ID)
+    with span("image_gen.imgur", bytes=len(image_bytes)):
+        return upload_to_imgur(image_bytes, IMGUR_CLIENT_ID)
 
 @app.route("/line_webhook", methods=["POST"])
 def line_webhook():
     signature = request.headers.get("X-Line-Signature"); body = request.get_data(as_text=True)
-    try: webhook_handler.handle(body, signature)
+    try:
+        events = [event for event in webhook_handler.parser.parse(body, signature) if event_dedup.claim(event)]  # 再送などの重複はここで捨てる
     except InvalidSignatureError: return "Invalid signature", 400
+    if event_queue is None:
+        dispatch_concurrently(events)
+    else:
+        # 重い処理はワーカーに任せてすぐ200を返す
+        for event in events:
+            if not event_queue.submit(event): dispatch_event(event)  # キュー満杯時はインラインで処理（バックプレッシャー）
     return "OK", 200
 
+def event_source_key(event) -> Optional[str]:
+    """順序を守るべきイベントのまとまり（同じユーザーの発言）。ユーザーIDが無ければグループ・トークルーム単位"""
+    source = getattr(event, "source", None)
+    if source is None: return None
+    return getattr(source, "user_id", None) or getattr(source, "group_id", None) or getattr(source, "room_id", None)
+
+def dispatch_concurrently(events: list):
+    """1つのWebhookに含まれるイベントを、ユーザーごとには順番に、ユーザー同士は並行して処理する"""
+    groups: dict[Optional[str], list] = {}
+    for event in events: groups.setdefault(event_source_key(event), []).append(event)
+    if len(groups) <= 1:
+        for event in events: dispatch_event(event)
+        return
+    futures = [submit_with_context(event_executor, lambda group=group: [dispatch_event(e) for e in group]) for group in groups.values()]
+    for future in futures:
+        try: future.result()
+        except Exception as e: print(f"イベント処理でエラー: {e}")
+
 @webhook_handler.add(MessageEvent, message=TextMessage)
+@traced_handler("text")
 def handle_text_message(event):
     user_id = event.source.user_id; user_text = event.message.text
     if event.source.type in ["group", "room"] and not is_bot_mentioned(user_text): return
     
-    if any(key in user_text for key in ["画像", "イラスト", "描いて", "絵を"]):
-        try:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="おっけーです！ちょっと待っててくださいね…🥰"))
-            img_url = generate_image_with_rest_api(user_text)
-            msg = ImageSendMessage(original_content_url=img_url, preview_image_url=img_url)
-            line_bot_api.push_message(user_id, msg)
-        except Exception as e:
-            print(f"画像生成でエラーが発生: {e}")
-            line_bot_api.push_message(user_id, TextSendMessage(text=f"ごめんなさい、画像生成の調子が悪いみたいです…\n理由: {e}"))
+    if IMAGE in classify(user_text):
+        img_url = image_jobs.cached_url(user_text)
+        if img_url:
+            line_bot_api.reply_message(event.reply_token, ImageSendMessage(original_content_url=img_url, preview_image_url=img_url))
+            return
+        image_jobs.submit(user_id, push_target(event), user_text,
+                          acknowledge=lambda status: line_bot_api.reply_message(event.reply_token, TextSendMessage(text=IMAGE_JOB_MESSAGES[status])))
+        return
+    if event.source.type in ["group", "room"] and room_coalescer is not None:
+        room_coalescer.add(push_target(event), event)  # 窓が閉じたら respond_to_room でまとめて返事する
+        return
+    reply_within_budget(event, lambda: chat_with_makot(user_text, user_id=user_id))
+
+ROOM_BUSY_REPLY = "みんなから呼ばれすぎて追いつかないです…🥺 ちょっとだけ待っててください！"
+
+def respond_to_room(room_id: str, events: list, throttled: bool):
+    """窓の間にまとめた呼びかけに1回だけ返事する（reply tokenは最新の呼びかけのものを使う）"""
+    latest = events[-1]
+    if throttled:
+        line_bot_api.reply_message(latest.reply_token, TextSendMessage(text=ROOM_BUSY_REPLY))
+        return
+    if len(events) == 1:
+        reply_within_budget(latest, lambda: chat_with_makot(latest.message.text, user_id=latest.source.user_id))
+        return
+    print(f"[{room_id}] {len(events)}件の呼びかけをまとめて返事します。")
+    lines = "\n".join(f"{i}. {e.message.text}" for i, e in enumerate(events, 1))
+    user_input = f"グループで続けて{len(events)}件呼びかけられました。全員に1つの返事で答えてください。\n{lines}"
+
+    def generate() -> str:
+        # まとめた入力は誰か1人の発言ではないので、ルーム単位の履歴で返事を作り、長期記憶・回答キャッシュには残さない
+        reply = chat_with_makot(user_input, user_id=f"room:{room_id}", remember=False)
+        for e in events:  # 各ユーザーの履歴には本人の発言と返事だけを残す
+            if e.source.user_id: chat_history.append(e.source.user_id, f"ユーザー: {e.message.text}", f"アシスタント: {reply}")
+        return reply
+    reply_within_budget(latest, generate)
+
+room_coalescer = RoomCoalescer(respond_to_room, window_seconds=ROOM_COALESCE_WINDOW, rate_per_minute=ROOM_RATE_PER_MINUTE,
+                               burst=ROOM_BURST, max_wait=ROOM_MAX_WAIT) if ROOM_COALESCE_WINDOW > 0 else None
+
+IMAGE_JOB_MESSAGES = {
+    "queued": "おっけーです！ちょっと待っててくださいね…🥰",
+    "joined": "ちょうど同じ絵を描いてるところです！できたら一緒に送りますね🥰",
+    "rate_limited": "ちょっと描きすぎて手が疲れちゃいました…🥺 少し時間をおいてからまたお願いします！",
+    "busy": "いまお絵かきの依頼がいっぱいで手が回らないです…🥺 少ししてからもう一度お願いします！",
+}
+
+def deliver_image(target: str, img_url: Optional[str], error: Optional[Exception]):
+    """画像生成ジョブの結果をpush_messageで届ける"""
+    if error is not None:
+        line_bot_api.push_message(target, TextSendMessage(text=f"ごめんなさい、画像生成の調子が悪いみたいです…\n理由: {error}"))
+        return
+    line_bot_api.push_message(target, ImageSendMessage(original_content_url=img_url, preview_image_url=img_url))
+
+image_jobs = ImageJobQueue(generate_image_with_rest_api, deliver_image, redis_client, workers=IMAGE_WORKERS, max_pending=IMAGE_QUEUE_SIZE,
+                           rate_limit=IMAGE_RATE_LIMIT, rate_window_seconds=IMAGE_RATE_WINDOW, cache_ttl_seconds=IMAGE_CACHE_TTL,
+                           strip_words=tuple(TRIGGER_KEYWORDS[IMAGE]), background=IMAGE_JOBS_BACKGROUND)
+
+ACK_MESSAGES = ["ちょっと調べてきます！少々お待ちを…🙇‍♀️", "いま考え中です…！ちょっと待っててくださいね🥺"]
+
+def push_target(event) -> str:
+    """push_messageの宛先（グループ・トークルームならその場に、1対1ならユーザーに送る）"""
+    source = event.source
+    return getattr(source, "group_id", None) or getattr(source, "room_id", None) or source.user_id
+
+def reply_within_budget(event, generate: Callable[[], str]):
+    """REPLY_TIME_BUDGET秒以内に返信が作れなければ、reply tokenで受付メッセージを返して本文は後からpushする"""
+    future = submit_with_context(reply_executor, generate)
+    try:
+        reply_text = future.result(timeout=REPLY_TIME_BUDGET)
+    except FutureTimeout:
+        print(f"返信が{REPLY_TIME_BUDGET}秒以内に作れなかったため、受付メッセージを先に返します。")
+        metrics.incr("reply_ack_first")
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=random.choice(ACK_MESSAGES)))
+        line_bot_api.push_message(push_target(event), TextSendMessage(text=future.result()))
         return
-    reply_text = chat_with_makot(user_text, user_id=user_id)
     line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
 
 @webhook_handler.add(MessageEvent, message=ImageMessage)
+@traced_handler("image")
 def handle_image_message(event):
     try:
-        message_content = line_bot_api.get_message_content(event.message.id)
-        image_bytes = message_content.content
-        makot_prompt = "あなたは後輩女子の『まこT』です。ユーザーから送られてきたこの画像を見て、最高のリアクションを1～2文で返してください！食べ物なら「おいしそう！」、動物なら「かわいい！」など、見たままの感情をテンション高めに表現してください。"
-        response = text_model.generate_content([makot_prompt, {"mime_type": "image/jpeg", "data": image_bytes}])
-        reply_text = response.text.strip()
+        with span("image.download") as sp:
+            message_content = line_bot_api.get_message_content(event.message.id)
+            image_bytes = read_stream(message_content.iter_content(64 * 1024), IMAGE_MAX_DOWNLOAD_BYTES); sp["bytes"] = len(image_bytes)
+        with span("image.prepare") as sp:
+            image = prepare_image(image_bytes, max_side=IMAGE_MAX_SIDE, quality=IMAGE_JPEG_QUALITY,
+                                  fallback_mime_type=message_content.content_type or "image/jpeg")
+            sp.update(mime_type=image.mime_type, bytes=len(image.data), original_bytes=image.original_bytes)
+        reply_text = image_reactions.get(image.phash)
+        if reply_text:
+            print(f"  [画像リアクション] キャッシュにヒットしました (dHash: {image.phash})")
+        else:
+            makot_prompt = "あなたは後輩女子の『まこT』です。ユーザーから送られてきたこの画像を見て、最高のリアクションを1～2文で返してください！食べ物なら「おいしそう！」、動物なら「かわいい！」など、見たままの感情をテンション高めに表現してください。"
+            with span("image.generate"):
+                response = gemini.generate(text_model, [makot_prompt, {"mime_type": image.mime_type, "data": image.data}])
+                reply_text = response.text.strip()
+            image_reactions.put(image.phash, reply_text)
         reply_text = post_process(reply_text, "テンション上がる")
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
     except Exception as e:
         print(f"画像認識でエラーが発生: {e}")
-        if "support image" in str(e).lower() or "image format" in str(e).lower():
+        if isinstance(e, ImageTooLargeError):
+             reply_text = "ごめんなさい、画像が大きすぎて見れなかったです…🥺 もう少し小さい画像でお願いします！"
+        elif "support image" in str(e).lower() or "image format" in str(e).lower():
              reply_text = "ごめんなさい、今ちょっと目が悪くて画像が見れないみたいです…🥺 また今度見せてください！"
         else:
              reply_text = "ごめんなさい、画像がうまく見れなかったです…🥺"
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
 
 @webhook_handler.add(MessageEvent, message=StickerMessage)
+@traced_handler("sticker")
 def handle_sticker_message(event):
     sticker_map = { "11537": {"52002734": "ありがとうございます！うれしいです🥰", "52002748": "おつかれさまです！🙇‍♀️"}, "11538": {"51626494": "ひえっ…！なにかありましたか！？🥺", "51626501": "ふぁーーーーーーーーーーーｗｗｗｗｗｗｗ"} }
     package_id = event.message.package_id; sticker_id = event.message.sticker_id
@@ -367,6 +724,73 @@ def handle_sticker_message(event):
     if not reply_text: reply_text = random.choice(["スタンプありがとうございます！🥰", "そのスタンプかわいいですね！", "お、いいスタンプ！私もほしいです！"])
     line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
 
+# ------------------------------------------------------------
+# 非同期Webhook用のイベントキュー
+# ------------------------------------------------------------
+MESSAGE_HANDLERS = {TextMessage: handle_text_message, ImageMessage: handle_image_message, StickerMessage: handle_sticker_message}
+
+def dispatch_event(event):
+    """イベントを対応するハンドラに振り分ける。終わったら重複の記録をEVENT_DEDUP_TTLまで延ばし、
+    失敗したら記録を消してLINEの再送で処理し直せるようにする"""
+    handler = MESSAGE_HANDLERS.get(type(event.message)) if isinstance(event, MessageEvent) else None
+    try:
+        if handler: handler(event)
+    except Exception:
+        event_dedup.release(event)
+        raise
+    event_dedup.complete(event)
+    if not MEMORY_BACKGROUND: memory_consolidator.flush()  # 返信を送り終えてから、このリクエストの中で要約・保存する
+
+def create_event_queue() -> Optional[EventQueue]:
+    if not ASYNC_WEBHOOK: return None
+    if EVENT_QUEUE_BACKEND == "redis":
+        return RedisEventQueue(dispatch_event, redis_client,
+                               encode=lambda e: e.as_json_string(),
+                               decode=lambda s: MessageEvent.new_from_json_dict(json.loads(s)),
+                               max_size=EVENT_QUEUE_SIZE, workers=EVENT_WORKERS, put_timeout=EVENT_QUEUE_PUT_TIMEOUT, shard_key=event_source_key)
+    return EventQueue(dispatch_event, max_size=EVENT_QUEUE_SIZE, workers=EVENT_WORKERS, put_timeout=EVENT_QUEUE_PUT_TIMEOUT,
+                      shard_key=event_source_key)
+
+event_queue = create_event_queue()
+
+@app.route("/queue_stats")
+def queue_stats():
+    if event_queue is None: return {"async_webhook": False, "dedup": event_dedup.metrics()}
+    return {"async_webhook": True, "backend": EVENT_QUEUE_BACKEND, **event_queue.metrics(), "dedup": event_dedup.metrics()}
+
+@app.route("/cache_stats")
+def cache_stats():
+    answer_cache = get_answer_cache()
+    return {"embedding": embedding_cache.metrics(), "qa_answer": answer_cache.metrics() if answer_cache else None,
+            "image_reaction": image_reactions.metrics()}
+
+@app.route("/upstream_stats")
+def upstream_stats():
+    return upstream_metrics()
+
+CIRCUIT_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """段階ごとのレイテンシ・エラー数、キャッシュ・キュー・長期記憶・外部API呼び出しの統計をPrometheusのテキスト形式で返す"""
+    lines = metrics.render()
+    lines += format_stats("embedding_cache", embedding_cache.metrics())
+    answer_cache = get_answer_cache()
+    if answer_cache is not None: lines += format_stats("answer_cache", answer_cache.metrics())
+    if event_queue is not None: lines += format_stats("event_queue", event_queue.metrics(), {"backend": EVENT_QUEUE_BACKEND})
+    lines += format_stats("memory", memory_consolidator.metrics())
+    lines += format_stats("event_dedup", event_dedup.metrics())
+    if room_coalescer is not None: lines += format_stats("room_coalescer", room_coalescer.metrics())
+    lines += format_stats("image_jobs", image_jobs.metrics())
+    lines += format_stats("image_reaction_cache", image_reactions.metrics())
+    lines += format_stats("gemini_scheduler", gemini.metrics())
+    for name, stats in upstream_metrics().items():
+        labels = {"upstream": name}
+        lines += format_stats("upstream", {k: v for k, v in stats.items() if k != "latency"}, labels)
+        lines.append(format_sample("upstream_circuit_state", CIRCUIT_STATES.get(stats["circuit_state"], -1), labels))
+        lines += format_histogram("upstream_request_duration_seconds", stats["latency"], labels)
+    return "\n".join(lines) + "\n", 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 @app.route("/")
 def home():
     return "まこT LINE Bot is running!"
@@ -0,0 +1,81 @@
+# bench_chunking.py (PDF抽出・チャンク化パイプラインのベンチマーク)
+#
+# 使い方: python bench_chunking.py [--workers N] [--repeat R]
+# documents/ の同梱PDFに対して、旧実装（逐次・毎回re.sub）と新実装（逐次/プロセス並列）の
+# 処理時間を比較し、生成されるチャンクが完全に一致することも確認する。
+
+import argparse
+import os
+import re
+import time
+
+import fitz  # PyMuPDF
+
+import document_chunker
+from document_chunker import iter_document_chunks, list_pdfs
+
+
+# --- 比較用: 旧 index_documents.py のままの実装 ---
+def legacy_preprocess_text(text: str) -> str:
+    text = re.sub(r'－\s*\d+\s*－', '', text)
+    text = re.sub(r'^\s*\d+\s*$', '', text, flags=re.MULTILINE)
+    text = re.sub(r'(?<!\n)\n(?!\n)', ' ', text)
+    text = re.sub(r'\s+', ' ', text)
+    return text.strip()
+
+def legacy_load_and_chunk(directory: str) -> list[dict]:
+    original = document_chunker.preprocess_text
+    document_chunker.preprocess_text = legacy_preprocess_text
+    try:
+        all_chunks = []
+        for filename, path in list_pdfs(directory):
+            with fitz.open(path) as doc:
+                full_text = "".join(page.get_text("text", sort=True) for page in doc)
+            section_pattern = r'((?:^第\s*[\d一二三四五六七八九十百]+章.*?$)|(?:^附\s*則.*?$)|(?:^別\s*表.*?$)|(?:^Ⅰ\s+総\s*則)|(?:^Ⅱ\s+.*?要件)|(?:^Ⅲ\s+.*?要件)|(?:^Ⅳ\s+.*?基準))'
+            sections = re.split(section_pattern, full_text, flags=re.MULTILINE)
+            if sections and sections[0].strip():
+                document_chunker.process_section(sections[0], "序文", filename, all_chunks)
+            for i in range(1, len(sections), 2):
+                document_chunker.process_section(sections[i+1], sections[i].strip().replace('\n', ' '), filename, all_chunks)
+        return all_chunks
+    finally:
+        document_chunker.preprocess_text = original
+
+def measure(label: str, func, repeat: int):
+    best, result, first_chunk = float("inf"), None, None
+    for _ in range(repeat):
+        start, first = time.perf_counter(), None
+        result = []
+        for chunk in func():
+            if first is None: first = time.perf_counter() - start
+            result.append(chunk)
+        elapsed = time.perf_counter() - start
+        if elapsed < best: best, first_chunk = elapsed, first
+    print(f"{label:<28} {best:8.3f}s  (最初のチャンクまで {first_chunk:.3f}s, {len(result)}チャンク)")
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", default="documents")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pdfs = list_pdfs(args.dir)
+    pages = 0
+    for _, path in pdfs:
+        with fitz.open(path) as doc: pages += doc.page_count
+    print(f"対象: {len(pdfs)}ファイル / {pages}ページ, workers={args.workers}\n")
+
+    legacy_time, legacy_chunks = measure("旧実装（逐次）", lambda: legacy_load_and_chunk(args.dir), args.repeat)
+    seq_time, seq_chunks = measure("新実装（逐次, workers=1）", lambda: iter_document_chunks(args.dir, workers=1), args.repeat)
+    par_time, par_chunks = measure(f"新実装（並列, workers={args.workers}）", lambda: iter_document_chunks(args.dir, workers=args.workers), args.repeat)
+
+    key = lambda c: (c["source"], c["chapter"], c["title"], c["text"])
+    same = sorted(map(key, legacy_chunks)) == sorted(map(key, seq_chunks)) == sorted(map(key, par_chunks))
+    print(f"\nチャンクの一致: {'OK' if same else 'NG'}")
+    print(f"高速化: 逐次 {legacy_time / seq_time:.2f}倍 / 並列 {legacy_time / par_time:.2f}倍")
+    if not same: raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
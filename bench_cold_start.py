@@ -0,0 +1,59 @@
+# bench_cold_start.py (Vercelのコールドスタートを想定した import / 最初のリクエストの時間計測)
+#
+# 使い方: python bench_cold_start.py [--runs N] [--budget-ms MS]
+# 毎回新しいPythonプロセスで app.py をimportし、ヘルスチェック（/）と空のWebhook（署名付き）を1回ずつ処理するまでの時間を測る。
+# 中央値が予算を超えるか、ヘルスチェックの時点で重いライブラリ（Gemini / Pinecone / Redis / numpy）が読み込まれていたら失敗にする。
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ["google.generativeai", "google.oauth2", "pinecone", "redis", "numpy"]
+
+CHILD_SCRIPT = r"""
+import base64, hashlib, hmac, json, os, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+assert client.get("/").status_code == 200
+health = time.perf_counter()
+heavy = [m for m in json.loads(sys.argv[1]) if m in sys.modules]
+body = json.dumps({"destination": "bench", "events": []})
+signature = base64.b64encode(hmac.new(os.environ["LINE_CHANNEL_SECRET"].encode(), body.encode(), hashlib.sha256).digest()).decode()
+assert client.post("/line_webhook", data=body, headers={"X-Line-Signature": signature, "Content-Type": "application/json"}).status_code == 200
+webhook = time.perf_counter()
+print(json.dumps({"import": imported - started, "health": health - imported, "webhook": webhook - health, "heavy": heavy}))
+"""
+
+def run_once(env: dict) -> dict:
+    result = subprocess.run([sys.executable, "-c", CHILD_SCRIPT, json.dumps(HEAVY_MODULES)], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("COLD_START_BUDGET_MS", 800)), help="import + 最初のリクエストの中央値の上限")
+    args = parser.parse_args()
+
+    env = dict(os.environ, ASYNC_WEBHOOK="false")
+    env.setdefault("LINE_CHANNEL_SECRET", "bench-secret")
+    runs = [run_once(env) for _ in range(args.runs)]
+
+    print(f"{'':<16} {'中央値':>8} {'最大':>8}")
+    for key, label in [("import", "import app"), ("health", "最初の /"), ("webhook", "最初のWebhook")]:
+        values = [r[key] * 1000 for r in runs]
+        print(f"{label:<16} {statistics.median(values):7.1f}ms {max(values):7.1f}ms")
+    totals = [(r["import"] + r["health"]) * 1000 for r in runs]
+    total = statistics.median(totals)
+    heavy = sorted({m for r in runs for m in r["heavy"]})
+    print(f"\nimport + 最初の / : {total:.1f}ms (予算 {args.budget_ms:.0f}ms) → {'OK' if total <= args.budget_ms else 'NG'}")
+    print(f"ヘルスチェック時点で読み込まれた重いライブラリ: {', '.join(heavy) if heavy else 'なし'}")
+    if total > args.budget_ms or heavy: raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# bench_image.py (画像メッセージのリアクション処理の前処理・キャッシュのベンチマーク)
+#
+# 使い方: python bench_image.py [--max-side 768] [--uplink-mbps 20] [--model-ms 1500] [--repeat 3]
+# 依存パッケージ: pip install -r requirements_dev.txt（requirements.txt + fakeredis）
+# 合成した画像（スマホの写真・スクリーンショット・ミーム・透過PNG・転送で再圧縮されたミーム）について、
+# 旧実装（元のバイト列をそのまま image/jpeg として送る）と image_pipeline.py（形式判定 → 縮小 → dHashでキャッシュ）の
+# Geminiに送るペイロードのサイズと、前処理・RESTのbase64エンコード・アップロード（--uplink-mbps で見積もり）・
+# モデル呼び出し（--model-ms、キャッシュにヒットしたら省略）を合わせたレイテンシを比較する。
+
+import argparse
+import base64
+import io
+import json
+import statistics
+import time
+
+import fakeredis
+import numpy as np
+from PIL import Image
+
+from image_pipeline import ReactionCache, prepare_image
+
+
+def make_images(seed: int = 0) -> list[tuple[str, bytes]]:
+    """(名前, バイト列) のリスト。最後の1枚は3枚目のミームを転送したもの（縮小・再圧縮済み）"""
+    rng = np.random.default_rng(seed)
+    def encode(image: Image.Image, fmt: str, **kwargs) -> bytes:
+        buffer = io.BytesIO(); image.save(buffer, format=fmt, **kwargs); return buffer.getvalue()
+
+    y, x = np.mgrid[0:3024, 0:4032]
+    photo = np.stack([(x / 16) % 256, (y / 12) % 256, ((x + y) / 28) % 256], axis=-1) + rng.normal(0, 18, (3024, 4032, 3))
+    photo = Image.fromarray(np.clip(photo, 0, 255).astype(np.uint8))
+    screenshot = np.full((2532, 1170, 3), 245, dtype=np.uint8)
+    for top in range(120, 2400, 96):  # チャットの吹き出しと文字っぽい模様
+        screenshot[top:top + 64, 60:60 + int(rng.integers(300, 1000))] = (200, 230, 200)
+        screenshot[top + 20:top + 44, 80:80 + int(rng.integers(200, 900))] = rng.integers(0, 80, (24, 1, 3))
+    meme = np.zeros((1080, 1080, 3), dtype=np.uint8)
+    meme[:, :] = rng.integers(0, 255, (1, 1, 3)); meme[200:880, 200:880] = rng.integers(0, 255, (680, 680, 3)) // 4 + 128
+    meme = Image.fromarray(meme)
+    sticker = Image.new("RGBA", (512, 512), (0, 0, 0, 0))
+    sticker.paste(Image.fromarray(rng.integers(0, 255, (320, 320, 3), dtype=np.uint8)), (96, 96))
+    forwarded = meme.resize((800, 800), Image.Resampling.BILINEAR)
+    return [("写真 4032x3024 JPEG", encode(photo, "JPEG", quality=92)),
+            ("スクショ 1170x2532 PNG", encode(Image.fromarray(screenshot), "PNG")),
+            ("ミーム 1080x1080 JPEG", encode(meme, "JPEG", quality=90)),
+            ("透過 512x512 PNG", encode(sticker, "PNG")),
+            ("転送されたミーム 800x800", encode(forwarded, "JPEG", quality=70))]
+
+def rest_payload_seconds(data: bytes, mime_type: str) -> tuple[int, float]:
+    """google-generativeai のRESTトランスポートと同じく、base64にしてJSONに詰めるまでの時間とサイズ"""
+    started = time.perf_counter()
+    body = json.dumps({"contents": [{"parts": [{"text": "prompt"}, {"inline_data": {"mime_type": mime_type, "data": base64.b64encode(data).decode()}}]}]})
+    return len(body), time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-side", type=int, default=768)
+    parser.add_argument("--quality", type=int, default=85)
+    parser.add_argument("--uplink-mbps", type=float, default=20.0, help="Geminiへのアップロード帯域の見積もり")
+    parser.add_argument("--model-ms", type=float, default=1500.0, help="マルチモーダル呼び出し1回の処理時間の見積もり")
+    parser.add_argument("--repeat", type=int, default=3, help="前処理の計測回数（中央値を使う）")
+    args = parser.parse_args()
+
+    images = make_images()
+    upload = lambda size: size * 8 / (args.uplink_mbps * 1_000_000)
+    cache = ReactionCache(fakeredis.FakeRedis(decode_responses=True))
+    print(f"{'画像':<22} {'旧: 送信量':>11} {'旧: 合計':>9} {'新: 送信量':>11} {'前処理':>8} {'新: 合計':>9}  キャッシュ")
+    totals = {"before_bytes": 0, "after_bytes": 0, "before_s": 0.0, "after_s": 0.0}
+    for name, data in images:
+        before_bytes, before_encode = rest_payload_seconds(data, "image/jpeg")
+        before_s = before_encode + upload(before_bytes) + args.model_ms / 1000
+
+        prepare_times = []
+        for _ in range(args.repeat):
+            started = time.perf_counter(); prepared = prepare_image(data, max_side=args.max_side, quality=args.quality)
+            prepare_times.append(time.perf_counter() - started)
+        prepare_s = statistics.median(prepare_times)
+        after_bytes, after_encode = rest_payload_seconds(prepared.data, prepared.mime_type)
+        hit = cache.get(prepared.phash) is not None
+        after_s = prepare_s + (0.0 if hit else after_encode + upload(after_bytes) + args.model_ms / 1000)
+        if not hit: cache.put(prepared.phash, "おいしそう！")
+
+        totals["before_bytes"] += before_bytes; totals["before_s"] += before_s
+        totals["after_bytes"] += 0 if hit else after_bytes; totals["after_s"] += after_s
+        print(f"{name:<22} {before_bytes / 1024:9.0f}KB {before_s * 1000:7.0f}ms {0 if hit else after_bytes / 1024:9.0f}KB "
+              f"{prepare_s * 1000:6.0f}ms {after_s * 1000:7.0f}ms  {'ヒット' if hit else '-'} ({prepared.mime_type}, {prepared.size}, dHash {prepared.phash})")
+
+    print(f"\n合計 送信量: {totals['before_bytes'] / 1024:.0f}KB → {totals['after_bytes'] / 1024:.0f}KB, "
+          f"レイテンシ: {totals['before_s'] * 1000:.0f}ms → {totals['after_s'] * 1000:.0f}ms "
+          f"(帯域 {args.uplink_mbps:.0f}Mbps・モデル {args.model_ms:.0f}ms の見積もり)")
+    print(f"リアクションのキャッシュ: {cache.metrics()}")
+
+if __name__ == "__main__":
+    main()
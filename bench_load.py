@@ -0,0 +1,289 @@
+# bench_load.py (ネットワークなしで /line_webhook の負荷試験を行うベンチマーク)
+#
+# 使い方: python bench_load.py [--concurrency 1,4,16] [--requests 200] [--gemini-ms 400] [--redis-url redis://localhost:6379/15]
+# 依存パッケージ: pip install -r requirements_dev.txt（requirements.txt + fakeredis）
+#
+# app.py をこのプロセス内でWSGIサーバーとして起動し、署名付きの合成LINEイベント（通常会話・Q&A・スタンプ・画像・
+# グループでの呼びかけ・画像生成）を同時接続数ごとに送って、ハンドラ別のp50/p95/p99と1秒あたりの処理件数を表示する。
+# 外部サービスはすべて手元の代役に置き換える:
+#   - Vertex AI（Embedding・画像生成）/ Imgur / LINE Messaging API: ローカルの偽HTTPサーバー（VERTEX_API_BASE などで向き先を変える）
+#   - Gemini / Pinecone: 遅延を入れたプロセス内の偽クライアント（app.py のLazyClientに差し込む）
+#   - Redis: --redis-url を指定すればそのRedis（専用DBを使うこと）、無ければ fakeredis
+
+import argparse
+import base64
+import contextlib
+import hashlib
+import hmac
+import http.server
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+CHANNEL_SECRET = "bench-channel-secret"
+EMBEDDING_DIM = 768
+# 1x1の透明PNG（画像生成・画像メッセージの中身）
+TINY_PNG = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==")
+
+TEXT_MESSAGES = ["今日は残業でつかれた…", "週末コストコ行ってきた！", "ボーナス出たよ！", "明日のスケジュールどうだっけ", "最近ポケポケにハマってる"]
+QA_MESSAGES = ["有給休暇の規定について教えて", "出力抑制のルールを説明して", "第12条とは", "系統連系の条件について教えて", "託送の手続き方法を教えて"]
+GROUP_MESSAGES = ["まこち、今日のランチどうする？", "おに、旅行の写真見た？"]
+IMAGE_GEN_MESSAGES = ["猫の絵を描いて", "富士山のイラストお願い"]
+
+
+# ------------------------------------------------------------
+# 外部サービスの代役
+# ------------------------------------------------------------
+def fake_vector(text: str) -> list[float]:
+    """同じテキストには同じベクトルを返す（回答キャッシュ・Embeddingキャッシュが本番と同じように効く）"""
+    seed = hashlib.sha256(text.encode("utf-8")).digest()
+    rng = random.Random(seed)
+    return [rng.uniform(-1, 1) for _ in range(EMBEDDING_DIM)]
+
+class FakeUpstreamHandler(http.server.BaseHTTPRequestHandler):
+    """Vertex AI / Imgur / LINE のエンドポイントをまとめて受ける偽サーバー"""
+    protocol_version = "HTTP/1.1"  # keep-aliveでコネクションプールが効くようにする
+    latency: dict[str, float] = {}
+    calls: dict[str, int] = defaultdict(int)
+    lock = threading.Lock()
+
+    def _send_json(self, upstream: str, payload: dict, status: int = 200):
+        self._send(upstream, json.dumps(payload).encode("utf-8"), "application/json", status)
+
+    def _send(self, upstream: str, body: bytes, content_type: str, status: int = 200):
+        time.sleep(self.latency.get(upstream, 0.0))
+        with self.lock: self.calls[upstream] += 1
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path.endswith(":predict") and "imagegeneration" in self.path:
+            self._send_json("vertex_image", {"predictions": [{"bytesBase64Encoded": base64.b64encode(TINY_PNG).decode()}]})
+        elif self.path.endswith(":predict"):
+            instances = json.loads(body)["instances"]
+            self._send_json("vertex", {"predictions": [{"embeddings": {"values": fake_vector(i["content"])}} for i in instances]})
+        elif self.path == "/3/image":
+            self._send_json("imgur", {"success": True, "data": {"link": f"https://i.imgur.example/{uuid.uuid4().hex[:8]}.png"}})
+        elif self.path.startswith("/v2/bot/message/"):
+            self._send_json("line", {})
+        else:
+            self._send_json("unknown", {"error": self.path}, status=404)
+
+    def do_GET(self):
+        if self.path.startswith("/v2/bot/message/") and self.path.endswith("/content"):
+            self._send("line_data", TINY_PNG, "image/png")
+        else:
+            self._send_json("unknown", {"error": self.path}, status=404)
+
+    def log_message(self, *args): pass
+
+
+class FakeChunk:
+    def __init__(self, text: str): self.text = text
+
+class FakeGenerativeModel:
+    """google.generativeai.GenerativeModel の代役（generate_content のみ）"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt, stream: bool = False):
+        with self._lock: self.calls += 1
+        text = self._reply(prompt)
+        if not stream:
+            time.sleep(self.latency); return FakeChunk(text)
+        return self._stream(text)
+
+    def _stream(self, text: str):
+        pieces = [text[i:i + 8] for i in range(0, len(text), 8)]
+        for piece in pieces:
+            time.sleep(self.latency / len(pieces)); yield FakeChunk(piece)
+
+    @staticmethod
+    def _reply(prompt) -> str:
+        if isinstance(prompt, list): return "わー！おいしそうです！！"
+        if "書き換え:" in prompt: return "- 元の質問\n- 言い換えた質問\n- 検索キーワード"
+        if "要約:" in prompt: return "特になし"
+        if "English:" in prompt: return "a cute cat"
+        return "そうなんですね！私もそう思います。ちなみに明日はどうしますか？"
+
+class FakePineconeIndex:
+    """pinecone.Index の代役（query / upsert / delete）。company-docs には固定のチャンクを返す"""
+
+    def __init__(self, latency: float):
+        from local_index import Match
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._docs = [Match(f"doc-{i}", 0.9 - i * 0.05, {"source": "規程集.pdf", "chapter": f"第{i + 1}章", "title": "", "text": f"第{i + 1}条 これは規程のダミー本文です。" * 5})
+                      for i in range(3)]
+        self._memories = [Match("mem-0", 0.8, {"user_id": "", "text": "コストコが好き"})]
+
+    def query(self, vector=None, top_k=3, namespace=None, filter=None, include_metadata=True, **kwargs):
+        with self._lock: self.calls += 1
+        time.sleep(self.latency)
+        return {"matches": (self._docs if namespace == "company-docs" else self._memories)[:top_k]}
+
+    def upsert(self, vectors, namespace=None, **kwargs):
+        with self._lock: self.calls += 1
+        time.sleep(self.latency)
+
+    def delete(self, **kwargs): pass
+
+
+# ------------------------------------------------------------
+# 合成LINEイベント
+# ------------------------------------------------------------
+def make_event(kind: str, n: int, unique_qa: bool = False) -> dict:
+    user_id = f"Ubench{n % 50:04d}"
+    source = {"type": "user", "userId": user_id}
+    if kind == "text": message = {"type": "text", "id": str(n), "text": random.choice(TEXT_MESSAGES)}
+    elif kind == "qa":
+        text = random.choice(QA_MESSAGES) + (f"（{n}件目）" if unique_qa else "")  # unique_qa なら回答キャッシュに当たらない
+        message = {"type": "text", "id": str(n), "text": text}
+    elif kind == "sticker": message = {"type": "sticker", "id": str(n), "packageId": "11537", "stickerId": "52002734"}
+    elif kind == "image": message = {"type": "image", "id": str(n), "contentProvider": {"type": "line"}}
+    elif kind == "group":
+        source = {"type": "group", "groupId": "Cbenchgroup", "userId": user_id}
+        message = {"type": "text", "id": str(n), "text": random.choice(GROUP_MESSAGES)}
+    elif kind == "image_gen": message = {"type": "text", "id": str(n), "text": random.choice(IMAGE_GEN_MESSAGES)}
+    else: raise ValueError(kind)
+    return {"type": "message", "mode": "active", "timestamp": int(time.time() * 1000), "source": source,
+            "webhookEventId": uuid.uuid4().hex.upper(), "deliveryContext": {"isRedelivery": False},
+            "replyToken": uuid.uuid4().hex, "message": message}
+
+def signed_body(event: dict) -> tuple[str, str]:
+    body = json.dumps({"destination": "Ubenchbot", "events": [event]}, ensure_ascii=False)
+    signature = base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body.encode("utf-8"), hashlib.sha256).digest()).decode()
+    return body, signature
+
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def parse_mix(spec: str) -> list[tuple[str, int]]:
+    return [(kind, int(weight)) for kind, weight in (item.split("=") for item in spec.split(","))]
+
+
+# ------------------------------------------------------------
+# 負荷試験
+# ------------------------------------------------------------
+def setup_app(args, upstream_url: str):
+    """偽サーバーに向けた環境変数でapp.pyをimportし、Gemini / Pinecone / Redis の代役を差し込む"""
+    os.environ.update({
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET, "LINE_CHANNEL_ACCESS_TOKEN": "bench-token", "IMGUR_CLIENT_ID": "bench",
+        "GCP_PROJECT_ID": "bench-project", "GEMINI_API_KEY": "bench", "PINECONE_API_KEY": "bench", "PINECONE_INDEX_NAME": "bench",
+        "VERTEX_API_BASE": upstream_url, "IMGUR_API_BASE": upstream_url, "LINE_API_ENDPOINT": upstream_url, "LINE_API_DATA_ENDPOINT": upstream_url,
+        "REDIS_URL": args.redis_url or "redis://fake", "ASYNC_WEBHOOK": "false",
+        "ROOM_COALESCE_WINDOW": "2.0",  # ベンチは常駐プロセスなので、グループの呼びかけをまとめる窓も有効にして測る
+        "GEMINI_RPM": str(args.gemini_rpm), "GEMINI_BURST": str(args.gemini_burst),
+    })
+    import app
+    if args.redis_url is None:
+        import fakeredis
+        app.redis_client._client = fakeredis.FakeRedis(decode_responses=True)
+    else:
+        app.redis_client.flushdb()
+    app.text_model._client = FakeGenerativeModel(args.gemini_ms / 1000)
+    app.chat_model._client = app.qa_model._client = app.text_model._client  # 呼び出し回数はまとめて数える
+    app.pinecone_index._client = FakePineconeIndex(args.pinecone_ms / 1000)
+    app.get_gcp_token.token, app.get_gcp_token.expires_at = "bench-token", float("inf")
+    return app
+
+def run_level(base_url: str, kinds: list[str], concurrency: int, total: int, unique_qa: bool = False) -> tuple[dict[str, list[float]], float, int]:
+    latencies: dict[str, list[float]] = defaultdict(list)
+    errors, lock, local = 0, threading.Lock(), threading.local()
+
+    def send(n: int):
+        nonlocal errors
+        session = getattr(local, "session", None) or requests.Session(); local.session = session
+        kind = kinds[n % len(kinds)]
+        body, signature = signed_body(make_event(kind, n, unique_qa))
+        started = time.perf_counter()
+        response = session.post(f"{base_url}/line_webhook", data=body.encode("utf-8"),
+                                headers={"X-Line-Signature": signature, "Content-Type": "application/json"}, timeout=120)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies[kind].append(elapsed)
+            if response.status_code != 200: errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool: list(pool.map(send, range(total)))
+    return latencies, time.perf_counter() - started, errors
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", default="1,4,16", help="同時接続数（カンマ区切り）")
+    parser.add_argument("--requests", type=int, default=200, help="同時接続数ごとのリクエスト数")
+    parser.add_argument("--mix", default="text=3,qa=3,sticker=1,image=1,group=1,image_gen=1", help="イベント種別の比率")
+    parser.add_argument("--gemini-ms", type=float, default=400)
+    parser.add_argument("--gemini-rpm", type=float, default=6000, help="Geminiの呼び出し枠（毎分）。本番のクォータに合わせると間引きの様子が見られる")
+    parser.add_argument("--gemini-burst", type=int, default=100)
+    parser.add_argument("--pinecone-ms", type=float, default=30)
+    parser.add_argument("--vertex-ms", type=float, default=60)
+    parser.add_argument("--imgur-ms", type=float, default=150)
+    parser.add_argument("--line-ms", type=float, default=20)
+    parser.add_argument("--redis-url", default=None, help="実際のRedisを使う場合のURL（flushdbするので専用DBを指定）")
+    parser.add_argument("--unique-qa", action="store_true", help="Q&Aの質問を毎回変えて回答キャッシュを効かせない")
+    parser.add_argument("--log", default=os.devnull, help="app.py のログの出力先")
+    args = parser.parse_args()
+
+    FakeUpstreamHandler.latency = {"vertex": args.vertex_ms / 1000, "vertex_image": args.vertex_ms * 5 / 1000, "imgur": args.imgur_ms / 1000,
+                                   "line": args.line_ms / 1000, "line_data": args.line_ms / 1000}
+    upstream = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeUpstreamHandler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # アクセスログを出さない
+    with open(args.log, "a", encoding="utf-8") as log, contextlib.redirect_stdout(log):
+        app = setup_app(args, f"http://127.0.0.1:{upstream.server_address[1]}")
+        server = make_server("127.0.0.1", 0, app.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        kinds = [kind for kind, weight in parse_mix(args.mix) for _ in range(weight)]
+        run_level(base_url, kinds, 2, len(kinds) * 2)  # ウォームアップ（遅延初期化・コネクション確立）
+
+        results = []
+        for concurrency in [int(c) for c in args.concurrency.split(",")]:
+            results.append((concurrency, *run_level(base_url, kinds, concurrency, args.requests, args.unique_qa)))
+        deadline = time.time() + app.ROOM_COALESCE_WINDOW + app.ROOM_MAX_WAIT + 5
+        while app.room_coalescer is not None and app.room_coalescer.pending_rooms() and time.time() < deadline:
+            time.sleep(0.1)  # グループの呼びかけは窓が閉じてから返事するので、その分のGemini呼び出しも数える
+        time.sleep(app.ROOM_COALESCE_WINDOW)
+        cache_stats = app.app.test_client().get("/cache_stats").json
+        scheduler_stats = app.gemini.metrics()
+
+    print(f"遅延設定: Gemini {args.gemini_ms:.0f}ms / Pinecone {args.pinecone_ms:.0f}ms / Vertex {args.vertex_ms:.0f}ms / "
+          f"Imgur {args.imgur_ms:.0f}ms / LINE {args.line_ms:.0f}ms, Redis: {args.redis_url or 'fakeredis'}")
+    for concurrency, latencies, elapsed, errors in results:
+        total = sum(len(v) for v in latencies.values())
+        print(f"\n同時接続数 {concurrency}: {total}件 / {elapsed:.2f}秒 = {total / elapsed:.1f} req/s, エラー {errors}件")
+        print(f"  {'ハンドラ':<12} {'件数':>5} {'p50':>9} {'p95':>9} {'p99':>9}")
+        for kind in sorted(latencies):
+            values = [v * 1000 for v in latencies[kind]]
+            print(f"  {kind:<12} {len(values):>5} {percentile(values, 50):8.1f}ms {percentile(values, 95):8.1f}ms {percentile(values, 99):8.1f}ms")
+    print(f"\n外部呼び出し: {dict(FakeUpstreamHandler.calls)}, Gemini {app.text_model.calls}回, Pinecone {app.pinecone_index.calls}回")
+    print(f"キャッシュ: Embedding ヒット率 {cache_stats['embedding'].get('hit_rate')}, "
+          f"回答 ヒット率 {(cache_stats['qa_answer'] or {}).get('hit_rate')}")
+    print("Geminiの枠: " + ", ".join(f"{k} {v}" for k, v in scheduler_stats.items() if k.startswith(("granted_", "shed_", "wait_"))))
+    if app.room_coalescer is not None:
+        room_stats = app.room_coalescer.metrics()
+        print(f"グループの呼びかけ: {room_stats['mentions']}件 → 返事 {room_stats['batches']}回 (まとめた {room_stats['coalesced']}件, 制限 {room_stats['throttled']}回)")
+    if any(errors for *_, errors in results): raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
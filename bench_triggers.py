@@ -0,0 +1,127 @@
+# bench_triggers.py (メッセージ振り分けのキーワード判定のベンチマーク)
+#
+# 使い方: python bench_triggers.py [--messages N] [--repeat R] [--check]
+# キーワードとふつうの文を組み合わせた合成メッセージで、旧実装（毎回リストを作って any() で走査）と
+# triggers.py のマッチャーの処理時間を比較し、すべてのメッセージで振り分け結果が一致することも確認する。
+# 重なったキーワード・接頭辞になっているキーワードなどの決まったケースも毎回確認する（--check ならそれだけを時間を測らずに行う）。
+
+import argparse
+import random
+import time
+
+from character_makot import MAKOT
+from triggers import TRIGGER_KEYWORDS, matcher, IMAGE, QA, HOBBY, WORK, EMOTION_HIGH, EMOTION_LOW, NICKNAME, UNCERTAIN
+
+
+# --- 比較用: 旧 app.py のままの判定 ---
+def legacy_is_image(text): return any(key in text for key in ["画像", "イラスト", "描いて", "絵を"])
+def legacy_is_qa(text):
+    QA_TRIGGERS = ["教えて", "説明して", "規定", "ルール", "方法", "って何", "とは", "について", "の条件"]
+    return any(trigger in text for trigger in QA_TRIGGERS)
+def legacy_is_bot_mentioned(text): return any(nick in text for nick in [MAKOT["name"]] + MAKOT["nicknames"])
+def legacy_guess_topic(text):
+    hobby_keys = ["趣味", "休日", "ハマって", "コストコ", "ポケポケ"]; work_keys  = ["仕事", "業務", "残業", "請求書", "統計"]
+    if any(k in text for k in hobby_keys): return "hobby"
+    if any(k in text for k in work_keys): return "work"
+    return None
+def legacy_mood(text):
+    if any(t in text for t in MAKOT["emotion_triggers"]["high"]): return "high"
+    if any(t in text for t in MAKOT["emotion_triggers"]["low"]): return "low"
+    return None
+def legacy_is_uncertain(text):
+    UNCERTAIN_WORDS = ["かも", "かもしれ", "たぶん", "多分", "かな", "と思う", "気がする"]
+    return any(w in text for w in UNCERTAIN_WORDS)
+
+def legacy_route(text):
+    return (legacy_is_image(text), legacy_is_qa(text), legacy_is_bot_mentioned(text),
+            legacy_guess_topic(text), legacy_mood(text), legacy_is_uncertain(text))
+
+def new_route(text):
+    c = matcher.classify(text)
+    topic = "hobby" if HOBBY in c else "work" if WORK in c else None
+    mood = "high" if EMOTION_HIGH in c else "low" if EMOTION_LOW in c else None
+    return (IMAGE in c, QA in c, NICKNAME in c, topic, mood, UNCERTAIN in c)
+
+
+# (メッセージ, 期待するカテゴリ)。合成メッセージでは出にくい、キーワード同士が重なる・含まれる組み合わせを並べる
+CHECK_CASES = [
+    ("", set()),
+    ("今日はいい天気", set()),
+    ("厚切り牛タン食べた", {EMOTION_HIGH}),                # 「牛タン」を含む長いキーワード（同じカテゴリ）
+    ("統計分析の締切", {WORK, EMOTION_HIGH}),              # 接頭辞「統計」(仕事) と「統計分析」(感情) でカテゴリが違う
+    ("統計だけ見た", {WORK}),
+    ("雨かもしれない", {UNCERTAIN}),                       # 接頭辞「かも」と「かもしれ」
+    ("雨かも", {UNCERTAIN}),
+    ("雨かもし", {UNCERTAIN}),                             # 途中で切れた「かもしれ」
+    ("ハマって何？", {HOBBY, QA}),                         # 「ハマって」と「って何」が「って」で重なる
+    ("残業務", {WORK}),                                    # 「残業」と「業務」が「業」で重なる
+    ("半休日", {EMOTION_HIGH, HOBBY}),                     # 「半休」と「休日」が「休」で重なる
+    ("急遽の午後休日出勤", {EMOTION_HIGH, HOBBY}),
+    ("おについて", {NICKNAME, QA}),                        # 「おに」と「について」が「に」で重なる
+    ("ボーナススケジューラー", {EMOTION_HIGH}),
+    ("コストコ行きたい", {HOBBY, EMOTION_HIGH}),           # 1つのキーワードが複数のカテゴリに属する
+    ("まこTにイラスト描いてほしい", {NICKNAME, IMAGE}),
+    ("有給の規定について教えて", {QA}),
+]
+
+def check_cases() -> list[str]:
+    """CHECK_CASESごとにカテゴリが期待どおりで、旧実装と振り分けが一致するかを確かめ、失敗の説明を返す"""
+    failures = []
+    for text, expected in CHECK_CASES:
+        got = matcher.classify(text)
+        if got != expected: failures.append(f"{text!r}: 期待 {sorted(expected)} / 新 {sorted(got)}")
+        if legacy_route(text) != new_route(text): failures.append(f"{text!r}: 旧 {legacy_route(text)} / 新 {new_route(text)}")
+    return failures
+
+
+FILLERS = ["今日は", "ねえ", "さっき", "ほんとに", "それで", "明日の", "みんなで", "ちょっと", "。", "！", "？", "w", "あ", "お"]
+
+def make_messages(n: int, seed: int = 0) -> list[str]:
+    """キーワードを0～3個、フィラーと混ぜたメッセージを作る（キーワードの一部だけ・連結で別のキーワードになる場合も含む）"""
+    rng = random.Random(seed)
+    keywords = [w for words in TRIGGER_KEYWORDS.values() for w in words]
+    messages = []
+    for _ in range(n):
+        parts = [rng.choice(FILLERS) for _ in range(rng.randint(2, 8))]
+        for _ in range(rng.randint(0, 3)):
+            word = rng.choice(keywords)
+            if rng.random() < 0.2: word = word[:max(1, len(word) - 1)]  # 途中で切れたキーワード
+            parts.insert(rng.randint(0, len(parts)), word)
+        messages.append("".join(parts))
+    return messages
+
+def measure(label: str, func, messages: list[str], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in messages: func(text)
+        best = min(best, time.perf_counter() - start)
+    print(f"{label:<24} {best * 1000:8.2f}ms  ({best / len(messages) * 1e6:.2f}µs/メッセージ)")
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--check", action="store_true", help="決まったケースの振り分けだけを確認する（時間は測らない）")
+    args = parser.parse_args()
+
+    failures = check_cases()
+    print(f"決まったケースの振り分け: {'OK' if not failures else 'NG'} ({len(CHECK_CASES)}件)")
+    for failure in failures: print(f"  {failure}")
+    if failures: raise SystemExit(1)
+    if args.check: return
+
+    messages = make_messages(args.messages)
+    print(f"\n対象: {len(messages)}メッセージ, キーワード {sum(len(w) for w in TRIGGER_KEYWORDS.values())}個\n")
+    legacy_time = measure("旧実装（any() × 6）", legacy_route, messages, args.repeat)
+    new_time = measure("新実装（1回の走査）", new_route, messages, args.repeat)
+
+    mismatches = [m for m in messages if legacy_route(m) != new_route(m)]
+    print(f"\n振り分けの一致: {'OK' if not mismatches else 'NG'} ({len(messages) - len(mismatches)}/{len(messages)})")
+    for m in mismatches[:10]: print(f"  {m!r}: 旧 {legacy_route(m)} / 新 {new_route(m)}")
+    print(f"高速化: {legacy_time / new_time:.2f}倍")
+    if mismatches: raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,8 @@ import random
 import textwrap
 from typing import Optional
 
+from prompt_builder import PromptBudget, estimate_tokens
+
 # ---------------------------------------------------------------------------
 # ベースデータ辞書
 # ---------------------------------------------------------------------------
@@ -56,39 +58,46 @@ def apply_expression_style(text: str, mood: str = "normal") -> str:
     if mood != "low" and random.random() < 0.15: text += " " + random.choice(rules["face_emojis"])
     return text
 
-# ---------------------------------------------------------------------------
-# Few‑shot サンプルを組み立て
-# ---------------------------------------------------------------------------
-def sample_examples(k: int = 3) -> str:
-    k = min(k, len(MAKOT["example_conversation"]))
-    ex = random.sample(MAKOT["example_conversation"], k=k)
-    return "\n".join(f"ユーザー: {e['user']}\nアシスタント: {e['assistant']}" for e in ex)
-
 # ---------------------------------------------------------------------------
 # プロンプトビルダー
 # ---------------------------------------------------------------------------
-def build_system_prompt(context: str, topic: Optional[str] = None, user_id: Optional[str] = None, long_term_memory: Optional[str] = None) -> str:
-    """通常会話用のプロンプトを構築する"""
+# 毎回同じ部分（設定・ルール・語録・参考対話）は静的な接頭辞にまとめ、system_instruction / コンテキストキャッシュとして使い回す。
+# 以前は参考対話と語録を毎回ランダムに選んでいたが、それでは接頭辞が毎回変わってキャッシュが効かないので全件を固定で載せる。
+def build_persona_prefix() -> str:
+    hb = MAKOT["hobbies"]
     parts = [
-        ("【参考対話】", sample_examples(k=5)),
         ("【キャラクター設定】", MAKOT["persona"]),
-    ]
-    
-    if long_term_memory:
-        parts.insert(0, ("【あなたとユーザーの過去の記憶（最重要）】", long_term_memory))
-
-    parts.extend([
         ("【振る舞いルール】", "\n".join(f"・{r}" for r in MAKOT["behavior_rules"])),
-        ("【まこT 語録】", " / ".join(random.sample(MAKOT["catch_phrases"], k=4))),
+        ("【まこT 語録】", " / ".join(MAKOT["catch_phrases"])),
         ("【タブー語句】", " / ".join(MAKOT["taboo_phrases"])),
-    ])
-    
-    if topic == "work":
-        parts.append(("【仕事関連】", f"得意: {', '.join(MAKOT['work_likes'])}\n苦手: {', '.join(MAKOT['work_dislikes'])}"))
-    elif topic == "hobby":
-        hb = MAKOT["hobbies"]
-        parts.append(("【趣味】", f"週末: {', '.join(hb['weekend'])}\n最近: {hb['current']}"))
-    
+        ("【仕事関連】", f"得意: {', '.join(MAKOT['work_likes'])}\n苦手: {', '.join(MAKOT['work_dislikes'])}"),
+        ("【趣味】", f"週末: {', '.join(hb['weekend'])}\n最近: {hb['current']}"),
+        ("【参考対話】", "\n".join(f"ユーザー: {e['user']}\nアシスタント: {e['assistant']}" for e in MAKOT["example_conversation"])),
+    ]
     prompt = "\n\n".join(f"{h}\n{v}" for h, v in parts)
-    prompt += f"\n\n【会話履歴】\n{context}\n\n以上の設定と履歴を完璧に理解し、後輩女子『まこT』として、ユーザーの発言に1～2行で自然に返答してください："
-    return textwrap.dedent(prompt)
\ No newline at end of file
+    return prompt + "\n\n以上の設定を完璧に理解し、後輩女子『まこT』として、ユーザーの発言に1～2行で自然に返答してください。"
+PERSONA_PREFIX = build_persona_prefix()
+
+TOPIC_HINTS = {"work": "仕事の話題です。【仕事関連】の得意・苦手を踏まえて返答してください。",
+               "hobby": "趣味の話題です。【趣味】の内容を踏まえて返答してください。"}
+CHAT_CLOSING = "以上の記憶と履歴を踏まえ、後輩女子『まこT』として、ユーザーの最後の発言に1～2行で自然に返答してください："
+
+def build_chat_prompt(history: list[str], topic: Optional[str] = None, long_term_memory: Optional[str] = None,
+                      token_budget: int = 2000) -> str:
+    """会話ごとに変わる部分（記憶・話題・会話履歴）を予算内で組み立てる（PERSONA_PREFIXの後ろに続ける）
+
+    予算の優先度は 最後の発言 > 過去の記憶 > 新しい履歴から順 > 話題のヒント。
+    """
+    budget = PromptBudget(token_budget)
+    budget.add("closing", CHAT_CLOSING, required=True)
+    latest = [budget.add("latest", history[-1], required=True)] if history else []
+    memory = budget.add("memory", long_term_memory) if long_term_memory else ""
+    earlier = budget.add_items("history", history[:-1], newest_last=True)
+    hint = budget.add("topic", TOPIC_HINTS[topic], truncate=False) if topic in TOPIC_HINTS else ""
+    budget.log("chat", prefix_tokens=estimate_tokens(PERSONA_PREFIX))
+
+    parts = []
+    if memory: parts.append(("【あなたとユーザーの過去の記憶（最重要）】", memory))
+    if hint: parts.append(("【今の話題】", hint))
+    parts.append(("【会話履歴】", "\n".join(earlier + latest)))
+    return "\n\n".join(f"{h}\n{v}" for h, v in parts) + f"\n\n{CHAT_CLOSING}"
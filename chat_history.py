@@ -0,0 +1,79 @@
+# chat_history.py (Redisのリストを使った会話履歴ストア)
+
+import json
+import time
+
+
+class ChatHistoryStore:
+    """ユーザーごとの会話履歴を上限付きのRedisリストで持つ
+
+    追記は RPUSH + LTRIM + EXPIRE を1つのパイプラインで送るので、同じユーザーのメッセージが同時に来ても
+    取りこぼしが起きない。読み込みはプロンプトに必要な末尾の数件だけをLRANGEで取る。
+    """
+
+    def __init__(self, redis_client, max_entries: int = 50, entry_ttl_seconds: int = 30 * 24 * 3600,
+                 key_prefix: str = "chat_history:list", legacy_key_prefix: str = "chat_history"):
+        self.redis_client = redis_client
+        self.max_entries = max_entries
+        self.entry_ttl_seconds = entry_ttl_seconds
+        self.key_prefix = key_prefix
+        self.legacy_key_prefix = legacy_key_prefix
+
+    def _key(self, user_id: str) -> str:
+        return f"{self.key_prefix}:{user_id}"
+
+    def recent(self, user_id: str, n: int) -> list[str]:
+        """直近n件の発言を古い順に返す。期限切れの発言は除き、リストの先頭からも取り除く"""
+        key = self._key(user_id)
+        raw = self.redis_client.lrange(key, -n, -1)
+        if not raw:
+            if not self._migrate_legacy(user_id): return []
+            raw = self.redis_client.lrange(key, -n, -1)
+
+        entries = [json.loads(item) for item in raw]
+        cutoff = time.time() - self.entry_ttl_seconds
+        expired = 0
+        for entry in entries:
+            if entry["t"] >= cutoff: break
+            expired += 1
+        if expired and len(entries) < n:
+            # 取得した範囲がリスト全体なら、先頭の期限切れ分はそのまま捨てられる
+            self.redis_client.ltrim(key, expired, -1)
+        return [entry["m"] for entry in entries if entry["t"] >= cutoff]
+
+    def append(self, user_id: str, *messages: str):
+        now = time.time()
+        key = self._key(user_id)
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.rpush(key, *[json.dumps({"t": now, "m": m}, ensure_ascii=False) for m in messages])
+        pipe.ltrim(key, -self.max_entries, -1)
+        pipe.expire(key, self.entry_ttl_seconds)
+        pipe.execute()
+
+    def _migrate_legacy(self, user_id: str) -> bool:
+        """旧形式（JSON配列を丸ごとSETしたキー）があればリストに移し替える
+
+        同じユーザーの最初の読み込みが同時に来ても二重にコピーしないよう、旧キーをWATCHしたトランザクションで
+        コピーと削除を行う。先に他の読み込みが移行を済ませていたらWatchErrorになるので、その結果をそのまま使う。
+        """
+        from redis.exceptions import WatchError  # 起動時にredisを読み込まないよう、使うときに読み込む
+        legacy_key, key = f"{self.legacy_key_prefix}:{user_id}", self._key(user_id)
+        with self.redis_client.pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(legacy_key)
+                legacy_json = pipe.get(legacy_key)
+                if not legacy_json: return False
+                history = json.loads(legacy_json)[-self.max_entries:]
+                now = time.time()
+                pipe.multi()
+                if history:
+                    # 移行の前に追記された発言があっても、旧履歴がその前に来るように先頭へ積む
+                    pipe.lpush(key, *[json.dumps({"t": now, "m": m}, ensure_ascii=False) for m in reversed(history)])
+                    pipe.ltrim(key, -self.max_entries, -1)
+                    pipe.expire(key, self.entry_ttl_seconds)
+                pipe.delete(legacy_key)
+                pipe.execute()
+            except WatchError:
+                return True  # 他のリクエストが先に移行した
+        print(f"[{user_id}] の会話履歴をリスト形式に移行しました: {len(history)}件")
+        return bool(history)
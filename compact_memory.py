@@ -0,0 +1,182 @@
+# compact_memory.py (長期記憶 conversation-memory 名前空間の重複統合・整理ジョブ)
+#
+# 記憶は要約のたびに新しいIDで追加されるため、同じユーザーについてのほぼ同じ内容のメモが溜まっていく。
+# このスクリプトをオフライン（cronなど）で実行し、ユーザーごとに
+#   1. created_at が MAX_AGE_DAYS より古い記憶を削除
+#   2. ベクトルのコサイン類似度が閾値以上の記憶をクラスタにまとめ、Geminiで1つの事実に統合して元の記憶を削除
+#   3. それでも上限件数を超える分は古いものから削除
+# を行う。
+
+import os
+import argparse
+import textwrap
+import time
+import uuid
+from typing import Optional
+
+import numpy as np
+import google.generativeai as genai
+import pinecone
+from dotenv import load_dotenv
+
+from embedding_client import VertexEmbeddingClient
+from gcp_auth import GcpTokenProvider
+from gemini_scheduler import GeminiScheduler, BACKGROUND
+
+load_dotenv('.env.development.local')
+
+# --- 初期設定 ---
+GEMINI_API_KEY           = os.getenv("GEMINI_API_KEY")
+PINECONE_API_KEY         = os.getenv("PINECONE_API_KEY")
+PINECONE_INDEX_NAME      = os.getenv("PINECONE_INDEX_NAME")
+GCP_PROJECT_ID           = os.getenv("GCP_PROJECT_ID")
+GCP_LOCATION             = os.getenv("GCP_LOCATION", "us-central1")
+GCP_CREDENTIALS_JSON_STR = os.getenv("GCP_CREDENTIALS_JSON")
+TEXT_MODEL_NAME          = os.getenv("TEXT_MODEL_NAME", "gemini-2.5-flash-preview-05-20")
+VERTEX_EMBEDDING_MODEL   = os.getenv("VERTEX_EMBEDDING_MODEL", "text-multilingual-embedding-002")
+GEMINI_RPM               = float(os.getenv("GEMINI_RPM", 60))  # 別プロセスなのでBotのスケジューラとは枠を共有しない。同じAPIキーのクォータを使うなら、Botが使わない分の流量を指定する
+GEMINI_BURST             = int(os.getenv("GEMINI_BURST", 10))
+
+if not all([GEMINI_API_KEY, PINECONE_API_KEY, PINECONE_INDEX_NAME, GCP_PROJECT_ID, GCP_CREDENTIALS_JSON_STR]):
+    raise ValueError("必要な環境変数(GEMINI, PINECONE, GCP)が設定されていません。")
+
+genai.configure(api_key=GEMINI_API_KEY, transport="rest")
+text_model = genai.GenerativeModel(TEXT_MODEL_NAME)
+gemini = GeminiScheduler(GEMINI_RPM, GEMINI_BURST)
+pc = pinecone.Pinecone(api_key=PINECONE_API_KEY)
+pinecone_index = pc.Index(PINECONE_INDEX_NAME)
+
+# --- 定数設定 ---
+NAMESPACE = "conversation-memory"
+FETCH_BATCH_SIZE = 100
+DELETE_BATCH_SIZE = 500
+DUPLICATE_THRESHOLD = float(os.getenv("MEMORY_DUPLICATE_THRESHOLD", 0.9))
+MAX_MEMORIES_PER_USER = int(os.getenv("MAX_MEMORIES_PER_USER", 50))
+MAX_AGE_DAYS = float(os.getenv("MEMORY_MAX_AGE_DAYS", 180))
+
+get_gcp_token = GcpTokenProvider(GCP_CREDENTIALS_JSON_STR)
+embedding_client = VertexEmbeddingClient(GCP_PROJECT_ID, GCP_LOCATION, VERTEX_EMBEDDING_MODEL, token_provider=get_gcp_token)
+
+def load_memories(user_id: Optional[str] = None) -> dict[str, list[dict]]:
+    """名前空間の全IDを列挙してベクトルとメタデータを取得し、user_idごとにまとめる"""
+    memories: dict[str, list[dict]] = {}
+    for ids in pinecone_index.list(namespace=NAMESPACE):
+        for start in range(0, len(ids), FETCH_BATCH_SIZE):
+            response = pinecone_index.fetch(ids=ids[start:start + FETCH_BATCH_SIZE], namespace=NAMESPACE)
+            for vector_id, vector in response.vectors.items():
+                metadata = vector.metadata or {}
+                owner = metadata.get("user_id")
+                if not owner or (user_id and owner != user_id): continue
+                memories.setdefault(owner, []).append({
+                    "id": vector_id, "values": list(vector.values), "text": metadata.get("text", ""),
+                    "created_at": float(metadata.get("created_at", 0) or 0),
+                })
+    return memories
+
+def find_clusters(records: list[dict], threshold: float) -> list[list[dict]]:
+    """新しい順に見ていき、まだどのクラスタにも入っていない記憶で類似度が閾値以上のものを同じクラスタにまとめる"""
+    if not records: return []
+    records = sorted(records, key=lambda r: r["created_at"], reverse=True)
+    matrix = np.asarray([r["values"] for r in records], dtype=np.float32)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    similarities = matrix @ matrix.T
+    assigned = np.zeros(len(records), dtype=bool)
+    clusters = []
+    for i in range(len(records)):
+        if assigned[i]: continue
+        members = np.flatnonzero((similarities[i] >= threshold) & ~assigned)
+        assigned[members] = True
+        clusters.append([records[j] for j in members])
+    return clusters
+
+def merge_texts(texts: list[str]) -> Optional[str]:
+    """同じユーザーについての重複したメモを、Geminiで1つの事実にまとめる（失敗時はNone）"""
+    notes = "\n".join(f"- {t}" for t in texts)
+    merge_prompt = textwrap.dedent(f"""
+        以下は同じユーザーについての記憶メモです（上ほど新しい）。内容が重複しているので、1～2行の簡潔なメモ1つにまとめてください。
+        情報が食い違う場合は新しい方を優先し、メモに書かれていないことは付け足さないでください。メモ本文だけを出力してください。
+        ---
+        {notes}
+        ---
+        統合したメモ:""")
+    try:
+        merged = gemini.generate(text_model, merge_prompt, priority=BACKGROUND).text.strip()
+    except Exception as e:
+        print(f"記憶の統合でエラー: {e}")
+        return None
+    return merged.lstrip("-・ ").strip() or None
+
+def compact_user(user_id: str, records: list[dict], threshold: float, max_memories: int, max_age_days: float,
+                 dry_run: bool) -> dict:
+    """1ユーザー分の記憶を整理し、削除・追加したIDを返す"""
+    cutoff = time.time() - max_age_days * 24 * 3600
+    expired = [r for r in records if r["created_at"] and r["created_at"] < cutoff]
+    expired_ids = {r["id"] for r in expired}
+    remaining = [r for r in records if r["id"] not in expired_ids]
+
+    to_delete, to_upsert, kept = [r["id"] for r in expired], [], []
+    for cluster in find_clusters(remaining, threshold):
+        if len(cluster) == 1:
+            kept.append(cluster[0]); continue
+        print(f"  [{user_id}] {len(cluster)}件の重複を統合: " + " / ".join(r["text"] for r in cluster))
+        if dry_run:
+            kept.append(cluster[0]); to_delete += [r["id"] for r in cluster[1:]]
+            continue
+        merged = merge_texts([r["text"] for r in cluster])
+        vector = embedding_client.embed([merged], "RETRIEVAL_DOCUMENT")[0] if merged else []
+        if not vector:
+            kept += cluster; continue  # 統合に失敗したクラスタは元の記憶を残す
+        print(f"    → {merged}")
+        record = {"id": str(uuid.uuid4()), "values": vector, "text": merged, "created_at": cluster[0]["created_at"]}
+        to_upsert.append(record); kept.append(record)
+        to_delete += [r["id"] for r in cluster]
+
+    kept.sort(key=lambda r: r["created_at"], reverse=True)
+    upsert_ids = {r["id"] for r in to_upsert}
+    dropped_upserts = set()
+    for record in kept[max_memories:]:
+        if record["id"] in upsert_ids: dropped_upserts.add(record["id"])
+        else: to_delete.append(record["id"])
+    to_upsert = [r for r in to_upsert if r["id"] not in dropped_upserts]
+
+    return {"before": len(records), "after": len(records) - len(to_delete) + len(to_upsert),
+            "expired": len(expired), "delete": to_delete, "upsert": to_upsert}
+
+def apply_changes(user_id: str, result: dict):
+    """統合後の記憶を先に保存してから元の記憶を削除する（途中で失敗しても記憶が消えるだけにはならない）"""
+    if result["upsert"]:
+        pinecone_index.upsert(vectors=[
+            (r["id"], r["values"], {"user_id": user_id, "text": r["text"], "created_at": r["created_at"]})
+            for r in result["upsert"]], namespace=NAMESPACE)
+    for start in range(0, len(result["delete"]), DELETE_BATCH_SIZE):
+        pinecone_index.delete(ids=result["delete"][start:start + DELETE_BATCH_SIZE], namespace=NAMESPACE)
+
+def main():
+    parser = argparse.ArgumentParser(description=f"名前空間 '{NAMESPACE}' の長期記憶を重複統合・整理します。")
+    parser.add_argument("--dry-run", action="store_true", help="削除・統合の対象を表示するだけでPineconeは更新しない")
+    parser.add_argument("--user", default=None, help="指定したuser_idの記憶だけを整理する")
+    parser.add_argument("--threshold", type=float, default=DUPLICATE_THRESHOLD, help="重複とみなすコサイン類似度")
+    parser.add_argument("--max-per-user", type=int, default=MAX_MEMORIES_PER_USER, help="ユーザーごとの記憶の上限件数")
+    parser.add_argument("--max-age-days", type=float, default=MAX_AGE_DAYS, help="これより古い記憶は削除する")
+    args = parser.parse_args()
+
+    memories = load_memories(args.user)
+    print(f"{len(memories)}ユーザー / {sum(len(r) for r in memories.values())}件の記憶を読み込みました。")
+
+    total_removed, total_expired = 0, 0
+    for user_id, records in sorted(memories.items()):
+        result = compact_user(user_id, records, args.threshold, args.max_per_user, args.max_age_days, args.dry_run)
+        removed = result["before"] - result["after"]
+        if not result["delete"]: continue
+        print(f"[{user_id}] {result['before']}件 → {result['after']}件（期限切れ {result['expired']}件）")
+        if not args.dry_run:
+            try: apply_changes(user_id, result)
+            except Exception as e: print(f"[{user_id}] の記憶の更新でエラー: {e}"); continue
+        total_removed += removed; total_expired += result["expired"]
+
+    print(f"\n削除したベクトル: {total_removed}件（うち期限切れ {total_expired}件）")
+    if args.dry_run:
+        print("--dry-run のためPineconeは更新していません。")
+
+if __name__ == "__main__":
+    main()
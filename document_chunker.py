@@ -0,0 +1,153 @@
+# document_chunker.py (PDFのテキスト抽出とチャンク分割 - 副作用なしでワーカープロセスから読み込める)
+
+import hashlib
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Optional
+
+import fitz  # PyMuPDF
+
+CHUNK_SIZE = 800       # チャンクの最大文字数
+PAGES_PER_TASK = 40    # 大きなPDFはこのページ数ごとに分けて並列に抽出する
+
+# --- 正規表現はモジュール読み込み時に一度だけコンパイルする ---
+HEADER_FOOTER_RE = re.compile(r'－\s*\d+\s*－')
+PAGE_NUMBER_RE   = re.compile(r'^\s*\d+\s*$', flags=re.MULTILINE)
+WHITESPACE_RE    = re.compile(r'\s+')
+# 章、附則、別表などで文書を大きなセクションに分割（PDFの構造に合わせて調整）
+SECTION_RE = re.compile(r'((?:^第\s*[\d一二三四五六七八九十百]+章.*?$)|(?:^附\s*則.*?$)|(?:^別\s*表.*?$)|(?:^Ⅰ\s+総\s*則)|(?:^Ⅱ\s+.*?要件)|(?:^Ⅲ\s+.*?要件)|(?:^Ⅳ\s+.*?基準))', flags=re.MULTILINE)
+# 条文で分割。「第X条 (...)」または「(...)」形式の見出しをキャプチャ
+ARTICLE_RE = re.compile(r'((?:^第\s*[\d百数十]+条.*?$)|(?:^（.*?）$))', flags=re.MULTILINE)
+
+
+def preprocess_text(text: str) -> str:
+    """OCRテキストからノイズを除去し、整形する関数"""
+    text = HEADER_FOOTER_RE.sub('', text) # ヘッダー/フッター除去
+    text = PAGE_NUMBER_RE.sub('', text) # ページ番号除去
+    # 文中の改行も含め、連続する空白を一つのスペースに（改行→スペースの置換はこの1パスに含まれる）
+    text = WHITESPACE_RE.sub(' ', text)
+    return text.strip()
+
+def chunk_and_append(content: str, title: str, chapter: str, filename: str, all_chunks: list):
+    """テキストを前処理し、チャンク化してリストに追加するヘルパー関数"""
+    cleaned_content = preprocess_text(content)
+    if len(cleaned_content) < 30: return
+
+    if len(cleaned_content) > CHUNK_SIZE:
+        parts = cleaned_content.split('。')
+        current_chunk = ""
+        for part in parts:
+            if not part: continue
+            # チャンクサイズを超える場合は現在のチャンクを確定し、新しいチャンクを開始
+            if len(current_chunk) + len(part) + 1 > CHUNK_SIZE:
+                if current_chunk:
+                    all_chunks.append({"text": current_chunk.strip() + "。", "source": filename, "title": title, "chapter": chapter})
+                current_chunk = part.strip()
+            else:
+                current_chunk += ("" if not current_chunk else " ") + part.strip() + "。"
+        # 最後のチャンクを追加
+        if current_chunk:
+             all_chunks.append({"text": current_chunk, "source": filename, "title": title, "chapter": chapter})
+    else:
+        all_chunks.append({"text": cleaned_content, "source": filename, "title": title, "chapter": chapter})
+
+def process_section(section_text: str, chapter: str, filename: str, all_chunks: list):
+    """章の内容を条文ごとに分割してチャンク化する"""
+    articles = ARTICLE_RE.split(section_text)
+
+    # 条文がない部分（章の導入部など）を処理
+    if articles and articles[0].strip():
+        chunk_and_append(articles[0], chapter, chapter, filename, all_chunks)
+
+    # 条文ごとの処理
+    for i in range(1, len(articles), 2):
+        article_title = articles[i].strip().replace('\n', ' ')
+        article_content = articles[i+1]
+        chunk_and_append(article_content, article_title, chapter, filename, all_chunks)
+
+def chunk_document(full_text: str, filename: str) -> list[dict]:
+    """1文書の全文を章・条を考慮してチャンクに分割する"""
+    chunks = []
+    sections = SECTION_RE.split(full_text)
+
+    # 最初のセクション（序文など）を処理
+    if sections and sections[0].strip():
+        process_section(sections[0], "序文", filename, chunks)
+
+    # 章ごとの処理
+    for i in range(1, len(sections), 2):
+        chapter_title = sections[i].strip().replace('\n', ' ')
+        chapter_text = sections[i+1]
+        process_section(chapter_text, chapter_title, filename, chunks)
+    return chunks
+
+def chunk_id(chunk: dict) -> str:
+    """(source, chapter, title, 本文ハッシュ) から決定的なチャンクIDを作る"""
+    text_hash = hashlib.sha256(chunk['text'].encode("utf-8")).hexdigest()
+    key = "\x00".join([chunk['source'], chunk['chapter'], chunk['title'], text_hash])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+def embedding_text(chunk: dict) -> str:
+    """検索時の関連性を高めるため、階層的なメタデータもテキストに含めてベクトル化する"""
+    return f"文書: {chunk['source']}, 章: {chunk['chapter']}, 見出し: {chunk['title']}\n内容: {chunk['text']}"
+
+def extract_page_range(path: str, start: int, end: int) -> str:
+    """PDFの[start, end)ページのテキストを抽出する（ワーカープロセスで実行される）"""
+    with fitz.open(path) as doc:
+        return "".join(doc[i].get_text("text", sort=True) for i in range(start, end))
+
+def list_pdfs(directory: str) -> list[tuple[str, str]]:
+    if not os.path.exists(directory):
+        print(f"エラー: '{directory}' フォルダが見つかりません。")
+        return []
+    return [(filename, os.path.join(directory, filename)) for filename in os.listdir(directory)
+            if filename.endswith(".pdf") and os.path.isfile(os.path.join(directory, filename))]
+
+def iter_document_chunks(directory: str, workers: Optional[int] = None, pages_per_task: int = PAGES_PER_TASK,
+                         failed: Optional[set] = None, skip: Optional[set] = None) -> Iterator[dict]:
+    """PDFのテキスト抽出をページ範囲単位でプロセスプールに並列で投げ、抽出が揃った文書から順にチャンクをyieldする
+
+    処理時間の大半はPyMuPDFの抽出なので、チャンク化（正規表現）は後続文書の抽出と並行してこのプロセスで行う。
+    workers（既定はCPU数）が1以下のときはプールを使わずに逐次処理する。読み込めなかったPDFのファイル名は failed に追加する。
+    skip に含まれるファイル名（前回から変わっていないPDFなど）は抽出しない。
+    """
+    print(f"'{directory}'フォルダ内のドキュメントを読み込みます...")
+    pdfs = [(filename, path) for filename, path in list_pdfs(directory) if not skip or filename not in skip]
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        for filename, path in pdfs:
+            print(f"\n--- ファイル '{filename}' を処理中... ---")
+            try:
+                with fitz.open(path) as doc:
+                    full_text = "".join(page.get_text("text", sort=True) for page in doc)
+            except Exception as e:
+                print(f"  PDF読み込みエラー: {e}")
+                if failed is not None: failed.add(filename)
+                continue
+            yield from chunk_document(full_text, filename)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # 1) 全文書のページ範囲ごとの抽出を先にまとめて投入する
+        extract_jobs = []
+        for filename, path in pdfs:
+            try:
+                with fitz.open(path) as doc: page_count = doc.page_count
+            except Exception as e:
+                print(f"  PDF読み込みエラー ({filename}): {e}")
+                if failed is not None: failed.add(filename)
+                continue
+            ranges = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+            extract_jobs.append((filename, [pool.submit(extract_page_range, path, start, end) for start, end in ranges]))
+
+        # 2) 抽出が揃った文書から順にチャンク化して流す（その間も残りの文書はワーカーで抽出が進む）
+        for filename, futures in extract_jobs:
+            print(f"\n--- ファイル '{filename}' を処理中... ---")
+            try:
+                full_text = "".join(f.result() for f in futures)
+            except Exception as e:
+                print(f"  PDF読み込みエラー: {e}")
+                if failed is not None: failed.add(filename)
+                continue
+            yield from chunk_document(full_text, filename)
@@ -0,0 +1,88 @@
+# embedding_cache.py (Embeddingの2段キャッシュ: インプロセスLRU + Redis)
+
+import base64
+import hashlib
+import struct
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+def cache_key(model: str, task_type: str, text: str) -> str:
+    """(モデル名, task_type, テキスト) から内容アドレスのキーを作る"""
+    digest = hashlib.sha256(f"{model}\x00{task_type}\x00{text}".encode("utf-8")).hexdigest()
+    return f"emb:{digest}"
+
+def pack_vector(vector: list[float]) -> str:
+    """float32にパックしてbase64化する（JSONのリストの約1/4のサイズ）"""
+    return base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode("ascii")
+
+def unpack_vector(data: str) -> list[float]:
+    raw = base64.b64decode(data)
+    return list(struct.unpack(f"<{len(raw) // 4}f", raw))
+
+
+class EmbeddingCache:
+    """小さなLRUを前段に、Redis（任意）を後段に置いたEmbeddingキャッシュ"""
+
+    def __init__(self, redis_client=None, max_local_entries: int = 2048, ttl_seconds: int = 30 * 24 * 3600):
+        self.redis_client = redis_client
+        self.max_local_entries = max_local_entries
+        self.ttl_seconds = ttl_seconds
+        self.stats = {"hits_local": 0, "hits_redis": 0, "misses": 0, "errors": 0}
+        self._local: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: list[str]) -> list[Optional[list[float]]]:
+        """キーに対応するベクトルを返す。見つからなければNone"""
+        results: list[Optional[list[float]]] = [None] * len(keys)
+        remote_idx = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._local:
+                    self._local.move_to_end(key)
+                    results[i] = self._local[key]; self.stats["hits_local"] += 1
+                else:
+                    remote_idx.append(i)
+
+        if remote_idx and self.redis_client is not None:
+            try:
+                values = self.redis_client.mget([keys[i] for i in remote_idx])
+            except Exception as e:
+                print(f"Embeddingキャッシュ(Redis)の読み込みでエラー: {e}")
+                values = [None] * len(remote_idx); self._incr("errors")
+            for i, value in zip(remote_idx, values):
+                if value is None: continue
+                results[i] = unpack_vector(value)
+                self._remember(keys[i], results[i]); self._incr("hits_redis")
+
+        self._incr("misses", sum(1 for r in results if r is None))
+        return results
+
+    def set_many(self, items: dict[str, list[float]]):
+        items = {k: v for k, v in items.items() if v}
+        if not items: return
+        for key, vector in items.items(): self._remember(key, vector)
+        if self.redis_client is None: return
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for key, vector in items.items(): pipe.set(key, pack_vector(vector), ex=self.ttl_seconds)
+            pipe.execute()
+        except Exception as e:
+            print(f"Embeddingキャッシュ(Redis)の書き込みでエラー: {e}"); self._incr("errors")
+
+    def metrics(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats); stats["local_entries"] = len(self._local)
+        lookups = stats["hits_local"] + stats["hits_redis"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits_local"] + stats["hits_redis"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+    def _remember(self, key: str, vector: list[float]):
+        with self._lock:
+            self._local[key] = vector
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_local_entries: self._local.popitem(last=False)
+
+    def _incr(self, key: str, n: int = 1):
+        with self._lock: self.stats[key] += n
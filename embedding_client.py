@@ -0,0 +1,89 @@
+# embedding_client.py (Vertex AI Embedding API の共通クライアント - app.py / index_documents.py 共用)
+
+from typing import Callable, Optional
+
+from embedding_cache import EmbeddingCache, cache_key
+from http_client import Upstream, get_upstream
+
+# text-multilingual-embedding-002 の1リクエストあたりの上限（インスタンス数250・合計20,000トークン）に余裕を持たせた値
+MAX_BATCH_SIZE   = 250
+MAX_BATCH_TOKENS = 15000
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の控えめな見積もり（日本語は概ね1文字1トークン以下なので文字数で近似する）"""
+    return len(text)
+
+
+class VertexEmbeddingClient:
+    """複数テキストをまとめて:predictに送り、入力順のベクトルを返すクライアント"""
+
+    def __init__(self, project_id: str, location: str, model: str, token_provider: Callable[[], str],
+                 max_batch_size: int = MAX_BATCH_SIZE, max_batch_tokens: int = MAX_BATCH_TOKENS,
+                 max_retries: int = 2, timeout: float = 30.0, cache: Optional[EmbeddingCache] = None,
+                 upstream: Optional[Upstream] = None, api_base: Optional[str] = None):
+        self.project_id = project_id
+        self.location = location
+        self.model = model
+        self.token_provider = token_provider
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.cache = cache
+        self.upstream = upstream or get_upstream("vertex")
+        self.api_base = api_base or f"https://{location}-aiplatform.googleapis.com"
+
+    @property
+    def endpoint_url(self) -> str:
+        return (f"{self.api_base}/v1/projects/{self.project_id}"
+                f"/locations/{self.location}/publishers/google/models/{self.model}:predict")
+
+    def embed(self, texts: list[str], task_type: str, timeout: Optional[float] = None) -> list[list[float]]:
+        """textsをベクトル化する。失敗したテキスト・空文字列の位置には空リストが入る"""
+        results: list[list[float]] = [[] for _ in texts]
+        pending = [i for i, text in enumerate(texts) if text]
+        keys = {i: cache_key(self.model, task_type, texts[i]) for i in pending}
+        if self.cache is not None and pending:
+            cached = self.cache.get_many([keys[i] for i in pending])
+            for i, vector in zip(pending, cached):
+                if vector is not None: results[i] = vector
+            pending = [i for i, vector in zip(pending, cached) if vector is None]
+
+        fresh = {}
+        for batch in self._make_batches(texts, pending):
+            vectors = self._predict_with_retry([texts[i] for i in batch], task_type, timeout or self.timeout)
+            for i, vector in zip(batch, vectors):
+                results[i] = vector
+                if vector: fresh[keys[i]] = vector
+        if self.cache is not None: self.cache.set_many(fresh)
+        return results
+
+    def _make_batches(self, texts: list[str], indices: list[int]) -> list[list[int]]:
+        """件数とトークン数の上限を超えないように、テキストの添字をサブバッチに分ける"""
+        batches, current, current_tokens = [], [], 0
+        for i in indices:
+            tokens = estimate_tokens(texts[i])
+            if current and (len(current) >= self.max_batch_size or current_tokens + tokens > self.max_batch_tokens):
+                batches.append(current); current, current_tokens = [], 0
+            current.append(i); current_tokens += tokens
+        if current: batches.append(current)
+        return batches
+
+    def _predict_with_retry(self, texts: list[str], task_type: str, timeout: float) -> list[list[float]]:
+        """1サブバッチを送信する。429/5xx・通信エラーはこのサブバッチだけを共通HTTPレイヤーがジッター付きバックオフで再試行する"""
+        try:
+            return self._predict(texts, task_type, timeout)
+        except Exception as e:
+            print(f"Vertex AI ベクトル化エラー ({len(texts)}件): {e}")
+            return [[] for _ in texts]
+
+    def _predict(self, texts: list[str], task_type: str, timeout: float) -> list[list[float]]:
+        headers = {"Authorization": f"Bearer {self.token_provider()}", "Content-Type": "application/json; charset=utf-8"}
+        data = {"instances": [{"content": text, "task_type": task_type} for text in texts]}
+        response = self.upstream.post(self.endpoint_url, headers=headers, json=data, timeout=timeout, max_retries=self.max_retries)
+        response.raise_for_status()
+        predictions = response.json().get("predictions") or []
+        if len(predictions) != len(texts):
+            raise ValueError(f"Vertex AIから返されたembeddingの数が一致しません: {len(predictions)}/{len(texts)}")
+        return [p["embeddings"]["values"] for p in predictions]
@@ -0,0 +1,296 @@
+# eval_retrieval.py (company-docs の検索精度と検索レイテンシのオフライン評価)
+#
+# 使い方: python eval_retrieval.py [--corpus chunks|pdf] [--chunk-size 800] [--embedder hashed|replay] [--record]
+#                                  [--per-query-top-k 3] [--merge-top-k 5] [--threshold 0.55] [--k 1,3,5] [--details]
+# ラベル付きの質問（eval_questions.jsonl: 正解を 文書/章/条/本文の一部 で指定）に対して、検索方式ごとに
+# recall@k・MRR と1問あたりの検索レイテンシ（p50/p95）を表示する。正解はチャンクIDではなく文書・章・条で指定するので、
+# CHUNK_SIZE や process_section を変えてチャンクを作り直しても同じ質問セットで比べられる。
+#
+# 既定の --embedder hashed は文字バイグラムを特徴量ハッシュした代用ベクトルで、フィクスチャもGCPも無しで一通り動かせるが、
+# スコアの尺度が本物と違うので --threshold の評価には使わないこと。本物で比べるときは --embedder replay で
+# 記録済みのフィクスチャ（eval_embeddings.npy/.json、キーはEmbeddingキャッシュと同じ (モデル, task_type, テキスト) のハッシュ）から再生する。
+# フィクスチャはリポジトリに含めていないので、最初に --embedder replay --record でapp.pyと同じVertex AIのクライアントから取得して記録する。
+#
+# 検索方式（Retriever）は retrieve(質問, 拡張クエリ) → 順位付きのMatch のリストを返せば何でもよく、既定では
+#   vector  : 拡張クエリごとに top_k 件ずつベクトル検索して統合（app.py の _handle_qa_request と同じ）
+#   lexical : BM25の語彙検索
+#   hybrid  : 両者をRRFで統合し、しきい値を超えたもの・用語が完全一致したものだけを残す（実際にGeminiに渡るチャンク）
+# を比べる。質問の "expansions" に記録したクエリ拡張の結果があれば、それも使う（無ければ元の質問だけで検索する）。
+
+import argparse
+import json
+import os
+import re
+import statistics
+import time
+import zlib
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+
+import document_chunker
+from document_chunker import chunk_id, embedding_text, iter_document_chunks
+from embedding_cache import cache_key
+from lexical_index import BigramBM25Index, bigrams, can_skip_expansion, extract_key_terms, fuse_vector_and_lexical, is_context_match, normalize
+from local_index import LocalVectorIndex, Match, snapshot_exists, write_snapshot
+
+EMBEDDING_MODEL = "text-multilingual-embedding-002"
+CHUNK_HEADER_RE = re.compile(r'^--- チャンク \d+ \(Source: (.*?), Chapter: (.*?), Title: (.*)\) ---$')
+
+
+# --- コーパス ---
+def load_chunks_output(path: str = "chunks_output.txt") -> list[dict]:
+    """index_documents.py が書き出した chunks_output.txt からチャンクを読み戻す"""
+    chunks, lines = [], []
+    def flush():
+        if chunks and lines: chunks[-1]["text"] = "\n".join(lines).strip()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            header = CHUNK_HEADER_RE.match(line)
+            if header:
+                flush(); lines = []
+                source, chapter, title = header.groups()
+                chunks.append({"source": source, "chapter": chapter, "title": title, "text": ""})
+            elif chunks:
+                lines.append(line)
+    flush()
+    return chunks
+
+def load_corpus(kind: str, chunks_path: str, documents_dir: str, chunk_size: Optional[int], workers: Optional[int]) -> list[dict]:
+    if kind == "pdf":
+        if chunk_size: document_chunker.CHUNK_SIZE = chunk_size  # チャンク化はこのプロセスで行われるので差し替えが効く
+        chunks = list(iter_document_chunks(documents_dir, workers=workers))
+    else:
+        chunks = load_chunks_output(chunks_path)
+    for chunk in chunks: chunk["id"] = chunk_id(chunk)
+    return list({chunk["id"]: chunk for chunk in chunks}.values())  # 全く同じチャンクは1件にまとめる（index_documents.py と同じ）
+
+
+# --- Embedding ---
+class HashedBigramEmbedder:
+    """文字バイグラムを dim 次元に特徴量ハッシュした代用ベクトル（フィクスチャが無い環境で評価の流れを確かめる用）"""
+
+    def __init__(self, dim: int = 1024):
+        self.dim = dim
+
+    def embed(self, texts: list[str], task_type: str) -> list[list[float]]:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for gram, tf in Counter(bigrams(text)).items():
+                h = zlib.crc32(gram.encode("utf-8"))
+                vectors[row, h % self.dim] += (1.0 if h & 0x80000000 else -1.0) * (1 + np.log(tf))
+        return vectors.tolist()
+
+
+class RecordedEmbeddings:
+    """記録済みのEmbeddingを再生する。live（VertexEmbeddingClient）を渡すと、足りない分を取得して追記する"""
+
+    def __init__(self, prefix: str, model: str = EMBEDDING_MODEL, live=None):
+        self.prefix, self.model, self.live = prefix, model, live
+        self.vectors: dict[str, list[float]] = {}
+        self.task_types: dict[str, str] = {}
+        self.stats = {"replayed": 0, "recorded": 0, "missing": 0}
+        if snapshot_exists(prefix):
+            fixture = LocalVectorIndex.load(prefix, mmap=False)
+            for key, row, metadata in zip(fixture.ids, fixture.matrix, fixture.metadatas):
+                self.vectors[key] = row.tolist(); self.task_types[key] = metadata.get("task_type", "")
+
+    def embed(self, texts: list[str], task_type: str) -> list[list[float]]:
+        keys = [cache_key(self.model, task_type, text) for text in texts]
+        missing = [i for i, key in enumerate(keys) if key not in self.vectors]
+        fetched_at = set(missing) if self.live is not None else set()
+        if missing and self.live is not None:
+            fetched = self.live.embed([texts[i] for i in missing], task_type)
+            for i, vector in zip(missing, fetched):
+                if vector: self.vectors[keys[i]] = vector; self.task_types[keys[i]] = task_type; self.stats["recorded"] += 1
+        results = [self.vectors.get(key, []) for key in keys]
+        self.stats["replayed"] += sum(1 for i, v in enumerate(results) if v and i not in fetched_at)
+        self.stats["missing"] += sum(1 for v in results if not v)
+        return results
+
+    def save(self):
+        if not self.vectors: return
+        keys = sorted(self.vectors)
+        write_snapshot(self.prefix, keys, [self.vectors[k] for k in keys], [{"task_type": self.task_types[k]} for k in keys])
+
+
+def create_embedder(kind: str, fixture: str, record: bool):
+    if kind == "hashed": return HashedBigramEmbedder()
+    live = None
+    if record:
+        from app import embedding_client  # app.py と同じ認証情報・モデル・Embeddingキャッシュで取得する
+        live = embedding_client
+    return RecordedEmbeddings(fixture, live=live)
+
+
+# --- 検索方式 ---
+class Retriever:
+    """評価する検索方式。retrieve は順位の高い順のMatchを返す"""
+    name = "retriever"
+
+    def retrieve(self, question: str, expansions: list[str]) -> list[Match]:
+        raise NotImplementedError
+
+
+class VectorRetriever(Retriever):
+    name = "vector"
+
+    def __init__(self, index: LocalVectorIndex, embedder, per_query_top_k: int = 3, merge_top_k: int = 5):
+        self.index, self.embedder, self.per_query_top_k, self.merge_top_k = index, embedder, per_query_top_k, merge_top_k
+
+    def search(self, queries: list[str]) -> list[dict]:
+        vectors = [v for v in self.embedder.embed(queries, "RETRIEVAL_QUERY") if v]
+        return self.index.query_many(vectors, top_k=self.per_query_top_k)
+
+    def retrieve(self, question: str, expansions: list[str]) -> list[Match]:
+        return [m for m, _, _ in fuse_vector_and_lexical(self.search([question] + expansions), [], limit=self.merge_top_k)]
+
+
+class LexicalRetriever(Retriever):
+    name = "lexical"
+
+    def __init__(self, index: BigramBM25Index, top_k: int = 5):
+        self.index, self.top_k = index, top_k
+
+    def retrieve(self, question: str, expansions: list[str]) -> list[Match]:
+        return self.index.search(question, top_k=self.top_k)
+
+
+class HybridRetriever(Retriever):
+    """_handle_qa_request と同じ判定（lexical_index の can_skip_expansion → RRF → is_context_match）で、Geminiに渡るチャンクを返す"""
+    name = "hybrid"
+
+    def __init__(self, vector: VectorRetriever, lexical: LexicalRetriever, threshold: float):
+        self.vector, self.lexical, self.threshold = vector, lexical, threshold
+
+    def retrieve(self, question: str, expansions: list[str]) -> list[Match]:
+        key_terms = extract_key_terms(question)
+        lexical_hits = self.lexical.retrieve(question, expansions)
+        strong = {m.id for m in lexical_hits if self.lexical.index.contains_all(m.id, key_terms)}
+        if can_skip_expansion(question, key_terms, lexical_hits, strong): expansions = []
+        fused = fuse_vector_and_lexical(self.vector.search([question] + expansions), lexical_hits, limit=self.vector.merge_top_k)
+        return [m for m, vector_score, _ in fused if is_context_match(m, vector_score, strong, self.threshold)]
+
+
+# --- 評価 ---
+def is_relevant(metadata: dict, label: dict) -> bool:
+    """正解ラベル（source は完全一致、chapter / article は前方一致、contains は本文の部分一致。いずれも正規化して比べる）に合うか"""
+    if metadata.get("source") != label["source"]: return False
+    if "chapter" in label and not normalize(metadata.get("chapter", "")).startswith(normalize(label["chapter"])): return False
+    if "article" in label and not normalize(metadata.get("title", "")).startswith(normalize(label["article"])): return False
+    return "contains" not in label or normalize(label["contains"]) in normalize(metadata.get("text", ""))
+
+def load_questions(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def percentile(values: list[float], p: float) -> float:
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def evaluate(retriever: Retriever, questions: list[dict], ks: list[int]) -> dict:
+    """質問ごとに、正解ラベルのうち上位k件に見つかった割合（recall@k）と、最初の正解の順位の逆数（MRR）を測る"""
+    recalls = {k: [] for k in ks}
+    reciprocal_ranks, latencies, details = [], [], []
+    for q in questions:
+        started = time.perf_counter()
+        matches = retriever.retrieve(q["question"], q.get("expansions", []))
+        latencies.append((time.perf_counter() - started) * 1000)
+        hits = [[i for i, m in enumerate(matches) if is_relevant(m.metadata, label)] for label in q["relevant"]]
+        for k in ks: recalls[k].append(sum(1 for ranks in hits if ranks and ranks[0] < k) / len(hits))
+        first = min((ranks[0] for ranks in hits if ranks), default=None)
+        reciprocal_ranks.append(1.0 / (first + 1) if first is not None else 0.0)
+        details.append({"id": q["id"], "rank": None if first is None else first + 1, "returned": len(matches),
+                        "top": [f"{m.metadata['source']} / {m.metadata.get('title', '')[:24]}" for m in matches[:3]]})
+    return {"retriever": retriever.name, "questions": len(questions),
+            "recall": {k: round(statistics.mean(v), 4) for k, v in recalls.items()},
+            "mrr": round(statistics.mean(reciprocal_ranks), 4),
+            "latency_ms": {"mean": round(statistics.mean(latencies), 3), "p50": round(percentile(latencies, 50), 3),
+                           "p95": round(percentile(latencies, 95), 3), "max": round(max(latencies), 3)},
+            "details": details}
+
+def check_labels(questions: list[dict], chunks: list[dict]):
+    """どのチャンクにも合わない正解ラベルを知らせる（チャンク分割を変えて条の見出しが変わった場合など）"""
+    for q in questions:
+        for label in q["relevant"]:
+            count = sum(1 for c in chunks if is_relevant(c, label))
+            if not count: print(f"  [注意] {q['id']}: 正解ラベル {label} に合うチャンクがありません。")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ラベル付きの質問セットで company-docs の検索を評価します。")
+    parser.add_argument("--corpus", choices=["chunks", "pdf"], default="chunks", help="chunks_output.txt から読むか、documents/ のPDFをチャンク化し直すか")
+    parser.add_argument("--chunks-path", default="chunks_output.txt")
+    parser.add_argument("--documents-dir", default="documents")
+    parser.add_argument("--chunk-size", type=int, default=None, help="--corpus pdf のときの CHUNK_SIZE（既定は document_chunker.py の値）")
+    parser.add_argument("--workers", type=int, default=None, help="PDF抽出のプロセス数")
+    parser.add_argument("--questions", default="eval_questions.jsonl")
+    parser.add_argument("--embedder", choices=["replay", "hashed"], default="hashed", help="代用ベクトルを使うか、記録済みのEmbeddingを再生するか")
+    parser.add_argument("--fixture", default="eval_embeddings", help="記録済みEmbeddingの接頭辞（<prefix>.npy / <prefix>.json）")
+    parser.add_argument("--record", action="store_true", help="フィクスチャに無いEmbeddingをVertex AIで取得して追記する")
+    parser.add_argument("--per-query-top-k", type=int, default=3, help="拡張クエリ1件あたりのベクトル検索件数（app.py は3）")
+    parser.add_argument("--merge-top-k", type=int, default=5, help="統合後に残す件数（app.py は5）")
+    parser.add_argument("--lexical-top-k", type=int, default=int(os.getenv("LEXICAL_TOP_K", 5)))
+    parser.add_argument("--threshold", type=float, default=float(os.getenv("RAG_SCORE_THRESHOLD", 0.55)), help="hybrid でGeminiに渡すベクトルスコアのしきい値")
+    parser.add_argument("--k", default="1,3,5", help="recall@k の k（カンマ区切り）")
+    parser.add_argument("--details", action="store_true", help="質問ごとの最初の正解の順位と上位の結果を表示する")
+    parser.add_argument("--json", default=None, help="結果をJSONで保存する（変更前後の比較用）")
+    args = parser.parse_args()
+    ks = [int(k) for k in args.k.split(",")]
+
+    embedder = create_embedder(args.embedder, args.fixture, args.record)
+    if isinstance(embedder, RecordedEmbeddings) and not args.record and not embedder.vectors:
+        parser.error(f"記録済みのEmbedding '{args.fixture}.npy/.json' が無いか空です。--embedder hashed でオフラインの代用ベクトルを使うか、"
+                     f"--record でフィクスチャを記録してください。")
+
+    started = time.perf_counter()
+    chunks = load_corpus(args.corpus, args.chunks_path, args.documents_dir, args.chunk_size, args.workers)
+    questions = load_questions(args.questions)
+    print(f"コーパス: {len(chunks)}チャンク ({args.corpus}, CHUNK_SIZE={document_chunker.CHUNK_SIZE}), 質問: {len(questions)}件")
+    check_labels(questions, chunks)
+
+    metadatas = [{k: c[k] for k in ("source", "chapter", "title", "text")} for c in chunks]
+    vectors = embedder.embed([embedding_text(c) for c in chunks], "RETRIEVAL_DOCUMENT")
+    embedded = [i for i, v in enumerate(vectors) if v]
+    if len(embedded) < len(chunks):
+        print(f"  [注意] {len(chunks) - len(embedded)}チャンクのEmbeddingがフィクスチャにありません（--record で取得するか --embedder hashed を使ってください）。")
+    if not embedded:
+        raise SystemExit(f"フィクスチャ '{args.fixture}' にこのコーパスのEmbeddingが1件もありません（チャンク分割を変えた場合は --record で記録し直してください）。")
+    ids = [chunks[i]["id"] for i in embedded]
+    matrix = np.asarray([vectors[i] for i in embedded], dtype=np.float32).reshape(len(ids), -1)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    vector_index = LocalVectorIndex(matrix, ids, [metadatas[i] for i in embedded], "")
+    lexical_index = BigramBM25Index.build([c["id"] for c in chunks], metadatas)
+    print(f"インデックス構築: {time.perf_counter() - started:.1f}秒 (embedder: {args.embedder})")
+
+    vector = VectorRetriever(vector_index, embedder, args.per_query_top_k, args.merge_top_k)
+    lexical = LexicalRetriever(lexical_index, args.lexical_top_k)
+    retrievers: list[Retriever] = [vector, lexical, HybridRetriever(vector, lexical, args.threshold)]
+    results = [evaluate(r, questions, ks) for r in retrievers]
+    if isinstance(embedder, RecordedEmbeddings):
+        if args.record: embedder.save(); print(f"フィクスチャ '{args.fixture}.npy/.json' を保存しました: {len(embedder.vectors)}件")
+        print(f"Embedding: {embedder.stats}")
+
+    print(f"\n{'方式':<8} " + " ".join(f"{'R@' + str(k):>7}" for k in ks) + f" {'MRR':>7} {'p50':>9} {'p95':>9}")
+    for result in results:
+        latency = result["latency_ms"]
+        print(f"{result['retriever']:<8} " + " ".join(f"{result['recall'][k]:7.3f}" for k in ks)
+              + f" {result['mrr']:7.3f} {latency['p50']:7.2f}ms {latency['p95']:7.2f}ms")
+    print(f"(per-query top_k={args.per_query_top_k}, merge top={args.merge_top_k}, lexical top_k={args.lexical_top_k}, "
+          f"threshold={args.threshold}; Embeddingは{args.embedder}なのでAPIの待ち時間は含まない)")
+
+    if args.details:
+        for result in results:
+            print(f"\n--- {result['retriever']} ---")
+            for d in result["details"]:
+                print(f"  {d['id']:<24} 順位: {d['rank'] or '-':>2} / {d['returned']}件  {d['top']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "corpus_chunks": len(chunks), "results": results}, f, ensure_ascii=False, indent=1)
+        print(f"\n結果を '{args.json}' に保存しました。")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# event_dedup.py (Webhookイベントの重複排除)
+#
+# LINEは応答がタイムアウトするなどすると同じイベントを再送してくる（deliveryContext.isRedelivery が true になる）。
+# そのまま処理するとGeminiの返信・会話履歴・長期記憶が二重になるので、webhookEventId を
+# Redisに SET NX EX で記録し、窓の間に2回目以降に届いたものは処理せずに捨てる。
+# 記録は最初は関数の実行時間ほどの短い期限で付け、処理が終わってから窓いっぱいに延ばす。
+# 処理の途中でサーバーレスの関数がタイムアウト・強制終了されても、記録が切れたあとの再送は処理し直される。
+
+import threading
+
+from tracing import log_event
+
+
+class EventDeduplicator:
+    """webhookEventIdごとに最初の1回だけ処理を許可する（Redisに障害があるときは通す）"""
+
+    def __init__(self, redis_client, ttl_seconds: int = 24 * 3600, processing_ttl_seconds: int = 60, prefix: str = "line_event"):
+        self.redis_client = redis_client
+        self.ttl_seconds = ttl_seconds
+        self.processing_ttl_seconds = processing_ttl_seconds
+        self.prefix = prefix
+        self.stats = {"claimed": 0, "completed": 0, "duplicates": 0, "redelivered": 0, "redelivered_duplicates": 0,
+                      "released": 0, "missing_id": 0, "errors": 0}
+        self._lock = threading.Lock()
+
+    def claim(self, event) -> bool:
+        """このイベントを処理してよければTrue（初めて届いたか、前の処理が終わらないまま期限が切れた）、重複ならFalse
+
+        記録の期限は processing_ttl_seconds で、処理が終わったら complete で ttl_seconds に延ばす。
+        """
+        event_id = getattr(event, "webhook_event_id", None)
+        context = getattr(event, "delivery_context", None)
+        redelivery = bool(getattr(context, "is_redelivery", False))
+        if redelivery: self._incr("redelivered")
+        if not event_id:
+            self._incr("missing_id"); return True
+        try:
+            first = self.redis_client.set(f"{self.prefix}:{event_id}", "1", nx=True, ex=self.processing_ttl_seconds)
+        except Exception as e:
+            print(f"イベントの重複確認でエラーが発生したため処理を続けます: {e}"); self._incr("errors")
+            return True
+        if first:
+            self._incr("claimed")
+            if redelivery: log_event("event_redelivered", webhook_event_id=event_id, duplicate=False)
+            return True
+        self._incr("duplicates")
+        if redelivery: self._incr("redelivered_duplicates")
+        log_event("event_duplicate", webhook_event_id=event_id, redelivery=redelivery)
+        return False
+
+    def complete(self, event):
+        """処理が終わったイベントの記録を ttl_seconds まで延ばし、以降の再送を重複として捨てる"""
+        event_id = getattr(event, "webhook_event_id", None)
+        if not event_id: return
+        try:
+            self.redis_client.set(f"{self.prefix}:{event_id}", "1", ex=self.ttl_seconds); self._incr("completed")
+        except Exception as e:
+            print(f"イベントの重複記録の延長でエラー: {e}"); self._incr("errors")
+
+    def release(self, event):
+        """処理に失敗したイベントの記録を消し、再送されたら処理し直せるようにする"""
+        event_id = getattr(event, "webhook_event_id", None)
+        if not event_id: return
+        try:
+            self.redis_client.delete(f"{self.prefix}:{event_id}"); self._incr("released")
+        except Exception as e:
+            print(f"イベントの重複記録の削除でエラー: {e}"); self._incr("errors")
+
+    def metrics(self) -> dict:
+        with self._lock: return dict(self.stats)
+
+    def _incr(self, key: str, n: int = 1):
+        with self._lock: self.stats[key] += n
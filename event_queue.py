@@ -0,0 +1,113 @@
+# event_queue.py (Webhookイベントの非同期処理用ワーカープール)
+#
+# キューはワーカーの数だけシャードに分け、shard_key（ユーザーIDなど）が同じイベントは必ず同じワーカーが順番に処理する。
+# 別のユーザーのイベントは並行して処理されるが、同じユーザーの発言の順序が入れ替わることはない。
+
+import queue
+import threading
+import time
+import zlib
+from typing import Callable, Optional
+
+
+class EventQueue:
+    """有界なインプロセスキューに積んだイベントを、ワーカースレッドで処理する"""
+
+    def __init__(self, handler: Callable, max_size: int = 100, workers: int = 4, put_timeout: float = 1.0,
+                 shard_key: Optional[Callable] = None):
+        self.handler = handler
+        self.max_size = max_size
+        self.put_timeout = put_timeout
+        self.shard_key = shard_key
+        self.stats = {"enqueued": 0, "processed": 0, "failed": 0, "rejected": 0, "busy_workers": 0}
+        self._lock = threading.Lock()
+        self._queues = [queue.Queue(maxsize=max(1, max_size // workers)) for _ in range(workers)]
+        self._workers = [threading.Thread(target=self._worker_loop, args=(i,), name=f"event-worker-{i}", daemon=True) for i in range(workers)]
+        for worker in self._workers: worker.start()
+
+    def submit(self, event) -> bool:
+        """イベントをキューに積む。満杯ならput_timeout秒だけ待ち、それでも空かなければFalseを返す"""
+        try:
+            self._put(event, self._shard(event))
+        except queue.Full:
+            self._incr("rejected")
+            return False
+        self._incr("enqueued")
+        return True
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def _shard(self, event) -> int:
+        """shard_keyのCRC32でシャードを決める（hash()と違ってプロセスをまたいでも同じ値になる）"""
+        key = self.shard_key(event) if self.shard_key else None
+        if not key: return 0
+        return zlib.crc32(str(key).encode("utf-8")) % len(self._workers)
+
+    def metrics(self) -> dict:
+        with self._lock: stats = dict(self.stats)
+        stats.update({"depth": self.depth(), "max_size": self.max_size, "workers": len(self._workers)})
+        return stats
+
+    # --- バックエンド依存部分（RedisEventQueueで上書き） ---
+    def _put(self, event, shard: int):
+        self._queues[shard].put(event, timeout=self.put_timeout)
+
+    def _get(self, shard: int):
+        return self._queues[shard].get()
+
+    def _incr(self, key: str, n: int = 1):
+        with self._lock: self.stats[key] += n
+
+    def _worker_loop(self, shard: int):
+        while True:
+            event = self._get(shard)
+            if event is None: continue
+            self._incr("busy_workers")
+            try:
+                self.handler(event)
+                self._incr("processed")
+            except Exception as e:
+                self._incr("failed")
+                print(f"イベント処理ワーカーでエラー: {e}")
+            finally:
+                self._incr("busy_workers", -1)
+
+
+class RedisEventQueue(EventQueue):
+    """Redisのリストをキューとして使う版。複数プロセス・インスタンスでワーカーを共有できる"""
+
+    def __init__(self, handler: Callable, redis_client, encode: Callable, decode: Callable,
+                 key: str = "line_event_queue", max_size: int = 100, workers: int = 4, put_timeout: float = 1.0,
+                 shard_key: Optional[Callable] = None):
+        self.redis_client = redis_client
+        self.encode, self.decode = encode, decode
+        self.key = key
+        super().__init__(handler, max_size=max_size, workers=workers, put_timeout=put_timeout, shard_key=shard_key)
+
+    def _shard_keys(self, shard: int) -> list[str]:
+        # シャード分けする前のキーに残っているイベントは0番のワーカーが引き取る
+        return [f"{self.key}:{shard}", self.key] if shard == 0 else [f"{self.key}:{shard}"]
+
+    def depth(self) -> int:
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for shard in range(len(self._workers)): pipe.llen(f"{self.key}:{shard}")
+            pipe.llen(self.key)
+            return int(sum(pipe.execute()))
+        except Exception as e: print(f"キュー長の取得でエラー: {e}"); return -1
+
+    def _put(self, event, shard: int):
+        deadline = time.time() + self.put_timeout
+        while self.depth() >= self.max_size:
+            if time.time() >= deadline: raise queue.Full
+            time.sleep(0.05)
+        self.redis_client.lpush(f"{self.key}:{shard}", self.encode(event))
+
+    def _get(self, shard: int) -> Optional[object]:
+        try:
+            item = self.redis_client.brpop(self._shard_keys(shard), timeout=1)
+        except Exception as e:
+            print(f"Redisキューからの取得でエラー: {e}"); time.sleep(1)
+            return None
+        return self.decode(item[1]) if item else None
@@ -0,0 +1,40 @@
+# gcp_auth.py (サービスアカウントのJSONからGCPのアクセストークンを取得する - app.py・index_documents.py・compact_memory.py で共有)
+
+import json
+import threading
+import time
+from typing import Optional
+
+CLOUD_PLATFORM_SCOPE = "https://www.googleapis.com/auth/cloud-platform"
+TOKEN_LIFETIME_SECONDS = 3300  # トークンの有効期限（1時間）より少し前に取り直す
+
+
+class GcpTokenProvider:
+    """呼び出すとアクセストークンを返す（期限まではキャッシュを返し、認証情報のオブジェクトも使い回す）
+
+    google-authのimportは重いので、最初にトークンが必要になったときに読み込む（app.py のコールドスタート対策）。
+    """
+
+    def __init__(self, credentials_json: Optional[str], scopes: tuple[str, ...] = (CLOUD_PLATFORM_SCOPE,)):
+        self.credentials_json = credentials_json
+        self.scopes = scopes
+        self.token: Optional[str] = None
+        self.expires_at = 0.0
+        self._credentials = None
+        self._lock = threading.Lock()
+
+    def __call__(self) -> str:
+        if self.token and time.time() < self.expires_at: return self.token
+        if not self.credentials_json: raise ValueError("GCP_CREDENTIALS_JSON 環境変数が設定されていません。")
+        with self._lock:
+            if self.token and time.time() < self.expires_at: return self.token  # 待っている間に他のスレッドが取得済み
+            try:
+                from google.oauth2 import service_account
+                from google.auth.transport.requests import Request
+                if self._credentials is None:
+                    self._credentials = service_account.Credentials.from_service_account_info(json.loads(self.credentials_json), scopes=list(self.scopes))
+                self._credentials.refresh(Request())
+                if not self._credentials.token: raise ValueError("トークンの取得に失敗しました。")
+                self.token, self.expires_at = self._credentials.token, time.time() + TOKEN_LIFETIME_SECONDS
+                return self.token
+            except Exception as e: print(f"GCPのトークン取得でエラー: {e}"); raise
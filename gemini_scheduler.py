@@ -0,0 +1,135 @@
+# gemini_scheduler.py (Gemini呼び出しの優先度付きスケジューラ)
+#
+# 通常会話は返信と記憶の要約、Q&Aはクエリ拡張と回答でそれぞれ2回Geminiを呼ぶので、混み合うとクォータ超過（429）になる。
+# すべての generate_content をここに通し、モデルごとのトークンバケットで流量を抑える。
+#   - INTERACTIVE: ユーザーへの返信そのもの。空くまで待つ（max_waitを超えたら諦める）
+#   - OPTIONAL   : クエリ拡張など省いても回答できる処理。すぐ通せなければ GeminiOverloadedError で打ち切り、呼び出し側が劣化版で続ける
+#   - BACKGROUND : 記憶の要約や画像のお題の翻訳。返信用の枠を残して、空くまで後回しにする
+# 429が返ってきたらそのモデルのバケットをしばらく空にして、再開を待つ。
+
+import threading
+import time
+
+INTERACTIVE, OPTIONAL, BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", OPTIONAL: "optional", BACKGROUND: "background"}
+RESERVE_FRACTIONS = {INTERACTIVE: 0.0, OPTIONAL: 0.25, BACKGROUND: 0.5}  # この割合のトークンは上の優先度のために残す
+_DEFAULT = object()
+
+
+class GeminiOverloadedError(Exception):
+    """混雑のため呼び出しを行わなかった（待ち時間の上限を超えた）"""
+
+
+class TokenBucket:
+    """rate_per_second で補充され、capacity まで貯まるトークンバケット"""
+
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, n: float = 1, reserve: float = 0.0) -> float:
+        """reserve を残してn個取れれば取って0を、取れなければ取れるようになるまでの秒数を返す"""
+        with self._lock:
+            self._refill()
+            if self.tokens - n >= reserve - 1e-9:
+                self.tokens -= n; return 0.0
+            if self.rate <= 0: return float("inf")
+            return (reserve + n - self.tokens) / self.rate
+
+    def penalize(self, seconds: float):
+        """相手側の制限に引っかかったので、seconds秒は取れないようにする"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+    def available(self) -> float:
+        with self._lock:
+            self._refill(); return self.tokens
+
+
+def is_quota_error(e: Exception) -> bool:
+    return getattr(e, "code", None) == 429 or type(e).__name__ in ("ResourceExhausted", "TooManyRequests") \
+        or "429" in str(e) or "quota" in str(e).lower()
+
+
+class GeminiScheduler:
+    """モデルごとのトークンバケットと優先度でGeminiの呼び出しを順番待ちさせる"""
+
+    def __init__(self, requests_per_minute: float = 60, burst: int = 10, max_wait: float = 10.0, cooldown_seconds: float = 10.0):
+        self.requests_per_minute = requests_per_minute
+        self.burst = burst
+        self.max_wait = max_wait
+        self.cooldown_seconds = cooldown_seconds
+        self.stats = {"quota_errors": 0, "wait_seconds": 0.0}
+        for name in PRIORITY_NAMES.values(): self.stats.update({f"granted_{name}": 0, f"shed_{name}": 0})
+        self._buckets: dict[str, TokenBucket] = {}
+        self._waiting = {p: 0 for p in PRIORITY_NAMES}
+        self._cond = threading.Condition()
+
+    def bucket(self, model_name: str) -> TokenBucket:
+        with self._cond:
+            if model_name not in self._buckets:
+                self._buckets[model_name] = TokenBucket(self.requests_per_minute / 60.0, self.burst)
+            return self._buckets[model_name]
+
+    def acquire(self, model_name: str, priority: int = INTERACTIVE, max_wait=_DEFAULT):
+        """呼び出し枠を1つ取る。上の優先度が待っている間は譲り、max_wait秒（Noneなら無制限）で取れなければ送出する"""
+        if max_wait is _DEFAULT: max_wait = 0.0 if priority == OPTIONAL else None if priority == BACKGROUND else self.max_wait
+        bucket = self.bucket(model_name)
+        reserve = RESERVE_FRACTIONS[priority] * bucket.capacity
+        started = time.monotonic()
+        deadline = None if max_wait is None else started + max_wait
+        with self._cond:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    yielding = any(self._waiting[p] for p in PRIORITY_NAMES if p < priority)
+                    wait = 0.05 if yielding else bucket.try_acquire(1, reserve)
+                    if wait == 0: break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and (remaining <= 0 or wait > remaining):
+                        self.stats[f"shed_{PRIORITY_NAMES[priority]}"] += 1
+                        raise GeminiOverloadedError(f"Geminiが混み合っているため {PRIORITY_NAMES[priority]} の呼び出しを見送りました（待ち {wait:.1f}秒）")
+                    self._cond.wait(min(wait, 1.0))
+            finally:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+            self.stats[f"granted_{PRIORITY_NAMES[priority]}"] += 1
+            self.stats["wait_seconds"] += time.monotonic() - started
+
+    def generate(self, model, contents, priority: int = INTERACTIVE, max_wait=_DEFAULT, **kwargs):
+        """model.generate_content(contents, **kwargs) を枠が取れてから呼ぶ。429ならしばらく同じモデルの呼び出しを止める"""
+        model_name = getattr(model, "model_name", "default")
+        self.acquire(model_name, priority, max_wait)
+        try:
+            response = model.generate_content(contents, **kwargs)
+        except Exception as e:
+            self._on_error(model_name, e); raise
+        return self._watch_stream(model_name, response) if kwargs.get("stream") else response
+
+    def metrics(self) -> dict:
+        with self._cond:
+            stats = dict(self.stats); stats["wait_seconds"] = round(stats["wait_seconds"], 3)
+            for p, name in PRIORITY_NAMES.items(): stats[f"waiting_{name}"] = self._waiting[p]
+        return stats
+
+    def _watch_stream(self, model_name: str, chunks):
+        """ストリーミングでは受信中に429が出ることもあるので、イテレータ越しにも見張る"""
+        try:
+            yield from chunks
+        except Exception as e:
+            self._on_error(model_name, e); raise
+
+    def _on_error(self, model_name: str, e: Exception):
+        if not is_quota_error(e): return
+        print(f"Geminiのクォータ超過を検知しました。{self.cooldown_seconds:.0f}秒間 {model_name} の呼び出しを止めます: {e}")
+        self.bucket(model_name).penalize(self.cooldown_seconds)
+        with self._cond: self.stats["quota_errors"] += 1
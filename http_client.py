@@ -0,0 +1,187 @@
+# http_client.py (外部API呼び出しの共通HTTPレイヤー)
+#
+# 呼び出し先（Vertex AI / Imgur / LINE）ごとに requests.Session を1つずつ持ち、コネクションを使い回す（毎回のTLSハンドシェイクを省く）。
+# 接続・読み込みタイムアウト、429/5xx・通信エラー時のジッター付き指数バックオフ再試行（冪等でないメソッドは相手に届く前の接続エラーだけ）、
+# 連続失敗時のサーキットブレーカー、
+# 呼び出し先ごとのレイテンシのヒストグラムもここでまとめて扱う。
+
+import atexit
+import random
+import threading
+import time
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いている間の呼び出し（相手に送らずすぐ失敗させる）"""
+
+
+def is_connect_error(e: requests.exceptions.RequestException) -> bool:
+    """リクエストが相手に届く前の失敗（接続できない・名前解決できない・接続タイムアウト）か"""
+    if isinstance(e, requests.exceptions.ConnectTimeout): return True
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(e, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+class LatencyHistogram:
+    """累積バケット方式のレイテンシのヒストグラム（Prometheusのhistogramと同じ形）"""
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)  # 最後は +Inf
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound: self._counts[i] += 1; break
+            else: self._counts[-1] += 1
+            self._sum += seconds
+
+    def snapshot(self) -> dict:
+        with self._lock: counts, total = list(self._counts), self._sum
+        cumulative, running = {}, 0
+        for bound, count in zip([*map(str, self.buckets), "+Inf"], counts):
+            running += count; cumulative[bound] = running
+        return {"buckets": cumulative, "count": running, "sum": round(total, 6)}
+
+
+class CircuitBreaker:
+    """failure_threshold回続けて失敗したらreset_seconds秒は呼び出しを止め、その後1回だけ試して様子を見る"""
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed": return True
+            if self.state == "open" and time.time() - self._opened_at >= self.reset_seconds:
+                self.state = "half_open"; return True  # 試しの1回だけ通す
+            return False
+
+    def record_success(self):
+        with self._lock: self.state, self._failures = "closed", 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == "half_open" or self._failures >= self.failure_threshold:
+                if self.state != "open": print(f"サーキットブレーカーを開きます（連続失敗 {self._failures}回）")
+                self.state, self._opened_at = "open", time.time()
+
+
+class Upstream:
+    """1つの呼び出し先のコネクションプール・再試行・サーキットブレーカー・メトリクス"""
+
+    def __init__(self, name: str, connect_timeout: float = 3.05, read_timeout: float = 30.0, max_retries: int = 2,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0, pool_size: int = 16,
+                 retry_methods: Optional[set[str]] = None, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_methods = retry_methods  # Noneならすべてのメソッドを再試行する。含まれないメソッドは接続エラーだけ再試行する
+        self.breaker = CircuitBreaker(failure_threshold, reset_seconds)
+        self.latency = LatencyHistogram()
+        self.stats = {"requests": 0, "retries": 0, "errors": 0, "circuit_rejected": 0}
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter); self.session.mount("http://", adapter)
+
+    def request(self, method: str, url: str, timeout=None, max_retries: Optional[int] = None, **kwargs) -> requests.Response:
+        """リクエストを送り、レスポンスを返す（ステータスの確認は呼び出し側でraise_for_statusする）
+
+        timeoutは読み込みタイムアウトの秒数か (接続, 読み込み) のタプル。429/5xx・通信エラーは再試行し、
+        最後まで失敗したら最後のレスポンスを返すか例外を送出する。retry_methodsに含まれないメソッド（Imgurへのアップロードなど）は
+        二重に処理されないよう、相手に届く前の接続エラーだけ再試行する。サーキットブレーカーには再試行を含めた1回の呼び出しの結果だけを数える。
+        """
+        if not self.breaker.allow():
+            self._incr("circuit_rejected")
+            raise CircuitOpenError(f"{self.name} へのリクエストはサーキットブレーカーにより停止中です")
+        if timeout is None: timeout = (self.connect_timeout, self.read_timeout)
+        elif not isinstance(timeout, tuple): timeout = (min(self.connect_timeout, timeout), timeout)
+        retries = self.max_retries if max_retries is None else max_retries
+        idempotent = self.retry_methods is None or method.upper() in self.retry_methods
+
+        for attempt in range(retries + 1):
+            self._incr("requests")
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except requests.exceptions.RequestException as e:
+                self.latency.observe(time.perf_counter() - started)
+                self._incr("errors")
+                if attempt >= retries or not (idempotent or is_connect_error(e)):
+                    self.breaker.record_failure(); raise
+                print(f"{self.name} への通信エラー（試行{attempt + 1}回目）: {e}")
+                self._sleep_before_retry(attempt, None)
+                continue
+            self.latency.observe(time.perf_counter() - started)
+            if response.status_code >= 500: self._incr("errors")
+            if response.status_code not in RETRY_STATUSES or attempt >= retries or not idempotent:
+                if response.status_code >= 500: self.breaker.record_failure()
+                else: self.breaker.record_success()
+                return response
+            print(f"{self.name} がステータス {response.status_code} を返しました（試行{attempt + 1}回目）")
+            self._sleep_before_retry(attempt, response.headers.get("Retry-After"))
+            response.close()
+
+    def get(self, url: str, **kwargs) -> requests.Response: return self.request("GET", url, **kwargs)
+    def post(self, url: str, **kwargs) -> requests.Response: return self.request("POST", url, **kwargs)
+
+    def _sleep_before_retry(self, attempt: int, retry_after: Optional[str]):
+        """Retry-Afterがあればそれに従い、無ければフルジッター付きの指数バックオフで待つ"""
+        self._incr("retries")
+        try: delay = float(retry_after) if retry_after else None
+        except ValueError: delay = None
+        if delay is None: delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        time.sleep(min(delay, self.backoff_max))
+
+    def metrics(self) -> dict:
+        with self._lock: stats = dict(self.stats)
+        stats["circuit_state"] = self.breaker.state
+        stats["latency"] = self.latency.snapshot()
+        return stats
+
+    def close(self):
+        self.session.close()
+
+    def _incr(self, key: str, n: int = 1):
+        with self._lock: self.stats[key] += n
+
+
+# --- 呼び出し先ごとの共有インスタンス ---
+_upstreams: dict[str, Upstream] = {}
+_upstreams_lock = threading.Lock()
+
+def get_upstream(name: str, **config) -> Upstream:
+    """名前ごとに1つのUpstreamを返す（configは最初に作るときだけ使われる）"""
+    with _upstreams_lock:
+        if name not in _upstreams: _upstreams[name] = Upstream(name, **config)
+        return _upstreams[name]
+
+def upstream_metrics() -> dict:
+    with _upstreams_lock: upstreams = dict(_upstreams)
+    return {name: u.metrics() for name, u in upstreams.items()}
+
+@atexit.register
+def close_all():
+    with _upstreams_lock:
+        for u in _upstreams.values(): u.close()
+
@@ -0,0 +1,166 @@
+# image_jobs.py (画像生成のジョブキュー)
+#
+# 翻訳（Gemini）→ Vertex AIの画像生成 → Imgurへのアップロードは数十秒かかる。常駐プロセスで動かすとき（background=True）は
+# Webhookの処理の中では行わず、有界なワーカープールに積んで終わったらpush_messageで届ける。
+# サーバーレス（Vercel）では応答を返した後のスレッドは止められることがあるので、既定（background=False）では
+# これまでどおり受け付けたリクエストの中で生成して届ける（同時に処理する件数の上限・相乗り・キャッシュはどちらでも効く）。
+#   - ユーザーごとのレート制限（Redisの固定ウィンドウ。複数インスタンスで共有される）
+#   - 正規化したお題が同じ依頼が処理中なら、新しく生成せずに同じ結果を一緒に届ける
+#   - 正規化したお題 → ImgurのURL をRedisにキャッシュし、同じ依頼にはすぐ返す
+
+import hashlib
+import itertools
+import re
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from tracing import submit_with_context
+
+FILLER_WORDS = ["ください", "お願いします", "おねがいします", "お願い", "おねがい"]
+_STRIP_CHARS = re.compile(r"[\s、。,.!！?？~〜「」『』()（）…・]+")
+
+
+def normalize_prompt(text: str, strip_words: tuple[str, ...] = ()) -> str:
+    """表記ゆれ（全角半角・大文字小文字・空白・句読点）と依頼の定型句を取り除いたお題"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    for word in sorted({*strip_words, *FILLER_WORDS}, key=len, reverse=True):
+        text = text.replace(unicodedata.normalize("NFKC", word).lower(), "")
+    return _STRIP_CHARS.sub("", text)
+
+
+class ImageJobQueue:
+    """画像生成の依頼を受け付け、ワーカーで生成して deliver(宛先, URL, 例外) で届ける
+
+    submit() の戻り値は "queued"（新しく生成する）/ "joined"（処理中の同じお題に相乗り）/
+    "rate_limited"（ユーザーの上限超過）/ "busy"（キューが満杯）のいずれか。レート制限の回数は "queued" のときだけ数える。
+    """
+
+    def __init__(self, generate: Callable[[str], str], deliver: Callable[[str, Optional[str], Optional[Exception]], None],
+                 redis_client, workers: int = 2, max_pending: int = 10, rate_limit: int = 3, rate_window_seconds: int = 600,
+                 cache_ttl_seconds: int = 7 * 24 * 3600, strip_words: tuple[str, ...] = (), key_prefix: str = "image_job",
+                 background: bool = False):
+        self.generate = generate
+        self.deliver = deliver
+        self.redis_client = redis_client
+        self.max_pending = max_pending
+        self.rate_limit = rate_limit
+        self.rate_window_seconds = rate_window_seconds
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self.strip_words = tuple(strip_words)
+        self.key_prefix = key_prefix
+        self.stats = {"submitted": 0, "cache_hits": 0, "coalesced": 0, "rate_limited": 0, "rejected": 0,
+                      "completed": 0, "failed": 0, "delivered": 0}
+        self._lock = threading.Lock()
+        self._in_flight: dict[str, list[str]] = {}  # 正規化したお題 → 結果を待っている宛先
+        self._unnamed = itertools.count()
+        self.background = background
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-job") if background else None
+        self.workers = workers if background else 0
+
+    def _cache_key(self, normalized: str) -> str:
+        return f"{self.key_prefix}:url:{hashlib.sha256(normalized.encode('utf-8')).hexdigest()[:32]}"
+
+    def _job_key(self, prompt: str) -> str:
+        """相乗り・キャッシュに使うキー。定型句を除くと何も残らないお題（「画像ください」など）は毎回別のキーにする"""
+        return normalize_prompt(prompt, self.strip_words) or f"\x00{next(self._unnamed)}"
+
+    def cached_url(self, prompt: str) -> Optional[str]:
+        """同じお題の画像が生成済みならそのURLを返す"""
+        normalized = normalize_prompt(prompt, self.strip_words)
+        if not normalized: return None
+        try:
+            url = self.redis_client.get(self._cache_key(normalized))
+        except Exception as e:
+            print(f"画像キャッシュの取得でエラー: {e}"); return None
+        if url: self._incr("cache_hits")
+        return url
+
+    def submit(self, user_id: str, target: str, prompt: str, acknowledge: Optional[Callable[[str], None]] = None) -> str:
+        """依頼を受け付けて状態を返す。acknowledge(状態) は生成を始める前に呼ばれる（受付メッセージの返信用）
+
+        background=False で "queued" なら、acknowledge の後にこのスレッドで生成して届けてから戻る。
+        """
+        normalized = self._job_key(prompt)
+        status = self._join_or_reject(normalized, target)
+        if not status:
+            rate_key = self._rate_key(user_id)
+            if not self._allow(rate_key):
+                self._incr("rate_limited"); status = "rate_limited"
+            else:
+                with self._lock:
+                    status = self._join_or_reject(normalized, target, locked=True)
+                    if not status:
+                        self._in_flight[normalized] = [target]
+                        self.stats["submitted"] += 1; status = "queued"
+                if status != "queued": self._refund(rate_key)  # レート制限を確認している間に同じお題の依頼が入った・満杯になった
+        if status == "queued" and self._executor is not None: submit_with_context(self._executor, self._run, normalized, prompt)
+        if acknowledge is not None:
+            try: acknowledge(status)
+            except Exception as e: print(f"画像生成の受付メッセージの送信でエラー: {e}")
+        if status == "queued" and self._executor is None: self._run(normalized, prompt)
+        return status
+
+    def metrics(self) -> dict:
+        with self._lock: stats = dict(self.stats); stats["in_flight"] = len(self._in_flight)
+        stats.update({"max_pending": self.max_pending, "workers": self.workers})
+        return stats
+
+    def _join_or_reject(self, normalized: str, target: str, locked: bool = False) -> Optional[str]:
+        """処理中の同じお題があれば相乗りして "joined"、上限に達していれば "busy"、新しく受け付けられるならNone"""
+        if not locked:
+            with self._lock: return self._join_or_reject(normalized, target, locked=True)
+        waiters = self._in_flight.get(normalized)
+        if waiters is not None:
+            if target not in waiters: waiters.append(target)
+            self.stats["coalesced"] += 1
+            return "joined"
+        if len(self._in_flight) >= self.max_pending:
+            self.stats["rejected"] += 1
+            return "busy"
+        return None
+
+    def _rate_key(self, user_id: str) -> str:
+        return f"{self.key_prefix}:rate:{user_id}:{int(time.time() // self.rate_window_seconds)}"
+
+    def _allow(self, rate_key: str) -> bool:
+        """rate_window_seconds秒ごとのウィンドウでrate_limit回まで（1回分を消費する）。Redisが使えないときは制限しない"""
+        if self.rate_limit <= 0: return True
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.incr(rate_key); pipe.expire(rate_key, self.rate_window_seconds)
+            count, _ = pipe.execute()
+        except Exception as e:
+            print(f"画像生成のレート制限の確認でエラー: {e}"); return True
+        if int(count) <= self.rate_limit: return True
+        self._refund(rate_key)  # 断った依頼は回数に数えない
+        return False
+
+    def _refund(self, rate_key: str):
+        if self.rate_limit <= 0: return
+        try: self.redis_client.decr(rate_key)
+        except Exception as e: print(f"画像生成のレート制限の戻しでエラー: {e}")
+
+    def _run(self, normalized: str, prompt: str):
+        url, error = None, None
+        try:
+            url = self.generate(prompt)
+            self._incr("completed")
+        except Exception as e:
+            print(f"画像生成ジョブでエラー: {e}"); error = e
+            self._incr("failed")
+        if url and not normalized.startswith("\x00"):
+            try: self.redis_client.set(self._cache_key(normalized), url, ex=self.cache_ttl_seconds)
+            except Exception as e: print(f"画像キャッシュの保存でエラー: {e}")
+        with self._lock: targets = self._in_flight.pop(normalized, [])
+        for target in targets:
+            try:
+                self.deliver(target, url, error)
+                self._incr("delivered")
+            except Exception as e:
+                print(f"[{target}] 画像の送信でエラー: {e}")
+
+    def _incr(self, key: str, n: int = 1):
+        with self._lock: self.stats[key] += n
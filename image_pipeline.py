@@ -0,0 +1,143 @@
+# image_pipeline.py (画像メッセージへのリアクション用の前処理とキャッシュ)
+#
+# LINEから受け取った画像は、写真なら数MBある上に形式もJPEGとは限らない。そのままGeminiに送るとアップロードに時間がかかるので、
+#   1. iter_content で少しずつ受け取り（上限を超えたら打ち切る）
+#   2. 先頭のバイト列で実際の形式を判定し
+#   3. 長辺 max_side 以下に縮小したJPEGにしてから送る
+# 転送されたスクショやミームは何度も送られてくるので、縮小画像のdHash（知覚ハッシュ）をキーにリアクションをRedisにキャッシュし、
+# 同じ画像ならマルチモーダルの呼び出しを省く。Pillowは重いので使うときに読み込む。
+
+import io
+import threading
+from typing import Iterable, Optional
+
+MAGIC_NUMBERS = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+
+class ImageTooLargeError(Exception):
+    """受け取った画像がサイズの上限を超えた"""
+
+
+def read_stream(chunks: Iterable[bytes], max_bytes: int) -> bytes:
+    """チャンクを連結する。max_bytesを超えた時点で受信をやめて送出する"""
+    buffer, total = bytearray(), 0
+    for chunk in chunks:
+        total += len(chunk)
+        if total > max_bytes: raise ImageTooLargeError(f"画像が大きすぎます（{max_bytes // 1024 // 1024}MB超）")
+        buffer += chunk
+    return bytes(buffer)
+
+def sniff_mime_type(data: bytes) -> Optional[str]:
+    """先頭のマジックナンバーから画像の形式を判定する（分からなければNone）"""
+    for magic, mime_type in MAGIC_NUMBERS:
+        if data.startswith(magic): return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP": return "image/webp"
+    if data[4:8] == b"ftyp" and data[8:12] in (b"heic", b"heix", b"mif1", b"msf1", b"hevc"): return "image/heic"
+    return None
+
+def dhash(image, hash_size: int = 8) -> str:
+    """差分ハッシュ（グレースケールで横に隣り合う画素の明暗）。再圧縮や縮小をされても同じ画像ならほぼ同じ値になる"""
+    from PIL import Image
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left, right = pixels[row * (hash_size + 1) + col], pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+def is_low_information(phash: str) -> bool:
+    """単色・なめらかなグラデーションなど、ほとんどのビットが同じハッシュ（別の画像と衝突しやすいのでキャッシュに使わない）"""
+    ones, total = bin(int(phash, 16)).count("1"), len(phash) * 4
+    return min(ones, total - ones) < total // 16
+
+
+class PreparedImage:
+    """モデルに送る画像（縮小後のバイト列・形式・知覚ハッシュ）"""
+
+    def __init__(self, data: bytes, mime_type: str, phash: Optional[str], original_bytes: int, size: Optional[tuple[int, int]] = None):
+        self.data = data
+        self.mime_type = mime_type
+        self.phash = phash
+        self.original_bytes = original_bytes
+        self.size = size
+
+    def __repr__(self) -> str:
+        return f"PreparedImage({self.mime_type}, {len(self.data)}B <- {self.original_bytes}B, size={self.size}, phash={self.phash})"
+
+
+def prepare_image(data: bytes, max_side: int = 768, quality: int = 85, fallback_mime_type: str = "image/jpeg") -> PreparedImage:
+    """長辺max_side以下のJPEGに変換し、dHashを計算する
+
+    Pillowで開けない形式（HEICなど）や、ハッシュが衝突しやすい単調な画像にはハッシュを付けない（キャッシュしない）。
+    もともと長辺max_side以下で、再エンコードしても小さくならないJPEG/PNG/WebPは元のバイト列を使う（大きい画像は必ず縮小して送る）。
+    """
+    mime_type = sniff_mime_type(data) or fallback_mime_type
+    try:
+        from PIL import Image, ImageOps
+        image = Image.open(io.BytesIO(data))
+        image.seek(0)  # GIFアニメは最初のフレームだけ使う
+        image = ImageOps.exif_transpose(image)
+    except Exception as e:
+        print(f"画像を開けなかったため元のデータのまま送ります ({mime_type}): {e}")
+        return PreparedImage(data, mime_type, None, len(data))
+
+    phash = dhash(image)
+    if is_low_information(phash): phash = None
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255)); background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    resized = max(image.size) > max_side
+    if resized: image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    encoded = buffer.getvalue()
+    if not resized and len(encoded) >= len(data) and mime_type in ("image/jpeg", "image/png", "image/webp"):
+        return PreparedImage(data, mime_type, phash, len(data), image.size)
+    return PreparedImage(encoded, "image/jpeg", phash, len(data), image.size)
+
+
+class ReactionCache:
+    """画像の知覚ハッシュ → まこTのリアクション（Redis、TTL付き）"""
+
+    def __init__(self, redis_client, ttl_seconds: int = 7 * 24 * 3600, prefix: str = "image_reaction"):
+        self.redis_client = redis_client
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "errors": 0}
+        self._lock = threading.Lock()
+
+    def get(self, phash: Optional[str]) -> Optional[str]:
+        if not phash: return None
+        try:
+            reply = self.redis_client.get(f"{self.prefix}:{phash}")
+        except Exception as e:
+            print(f"画像リアクションのキャッシュ取得でエラー: {e}"); self._incr("errors")
+            return None
+        self._incr("hits" if reply else "misses")
+        return reply
+
+    def put(self, phash: Optional[str], reply: str):
+        if not phash or not reply: return
+        try:
+            self.redis_client.set(f"{self.prefix}:{phash}", reply, ex=self.ttl_seconds); self._incr("stores")
+        except Exception as e:
+            print(f"画像リアクションのキャッシュ保存でエラー: {e}"); self._incr("errors")
+
+    def metrics(self) -> dict:
+        with self._lock: stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+    def _incr(self, key: str, n: int = 1):
+        with self._lock: self.stats[key] += n
@@ -1,16 +1,21 @@
 import os
-import fitz  # PyMuPDF
+import argparse
+import hashlib
+import shutil
 import google.generativeai as genai
 import pinecone
 from tqdm import tqdm
-import uuid
-import time
-import re
 import json
-import requests
-from google.oauth2 import service_account
-from google.auth.transport.requests import Request
 from dotenv import load_dotenv
+from typing import Optional
+
+import document_chunker
+from embedding_client import VertexEmbeddingClient
+from gcp_auth import GcpTokenProvider
+from embedding_cache import EmbeddingCache
+from local_index import LocalVectorIndex, snapshot_exists, write_snapshot
+from lexical_index import BigramBM25Index
+from document_chunker import chunk_id, embedding_text, iter_document_chunks, list_pdfs
 
 load_dotenv('.env.development.local')
 
@@ -22,6 +27,7 @@ PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME")
 GCP_PROJECT_ID           = os.getenv("GCP_PROJECT_ID")
 GCP_LOCATION             = os.getenv("GCP_LOCATION", "us-central1")
 GCP_CREDENTIALS_JSON_STR = os.getenv("GCP_CREDENTIALS_JSON")
+REDIS_URL                = os.getenv("REDIS_URL")  # 任意: 設定されていればEmbeddingキャッシュをRedisに永続化する
 
 if not all([GEMINI_API_KEY, PINECONE_API_KEY, PINECONE_INDEX_NAME, GCP_PROJECT_ID, GCP_CREDENTIALS_JSON_STR]):
     raise ValueError("必要な環境変数(GEMINI, PINECONE, GCP)が設定されていません。")
@@ -31,183 +37,243 @@ genai.configure(api_key=GEMINI_API_KEY)
 embedding_model = "text-multilingual-embedding-002"
 pc = pinecone.Pinecone(api_key=PINECONE_API_KEY)
 pinecone_index = pc.Index(PINECONE_INDEX_NAME)
-gcp_token_cache = {"token": None, "expires_at": 0}
 
 # --- 定数設定 ---
 DOCUMENTS_DIR = "documents"
-CHUNK_SIZE = 800  # チャンクの最大文字数
+UPSERT_BATCH_SIZE = 100
 NAMESPACE = "company-docs"
+MANIFEST_PATH = "index_manifest.json"  # インデックス済みの文書・チャンクIDの記録（差分更新・再開用）
+SNAPSHOT_PREFIX = "company_docs_index"  # app.py のローカル検索（LOCAL_DOCS_INDEX）用スナップショット
+LEXICAL_INDEX_PATH = "company_docs_lexical.json"  # app.py の語彙検索（LEXICAL_DOCS_INDEX）用転置インデックス
+DOCS_VERSION_KEY = "company_docs:version"
+
+get_gcp_token = GcpTokenProvider(GCP_CREDENTIALS_JSON_STR)
+
+def create_redis_client():
+    if not REDIS_URL: return None
+    import redis
+    return redis.from_url(REDIS_URL, decode_responses=True)
+
+redis_client = create_redis_client()
+embedding_cache = EmbeddingCache(redis_client, max_local_entries=4096)
+embedding_client = VertexEmbeddingClient(GCP_PROJECT_ID, GCP_LOCATION, embedding_model, token_provider=get_gcp_token, cache=embedding_cache)
+
+def get_embeddings(texts: list[str], task_type="RETRIEVAL_DOCUMENT") -> list[list[float]]:
+    """複数テキストをまとめてベクトルに変換する（失敗したテキストは空リスト）"""
+    return embedding_client.embed(texts, task_type)
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""): h.update(block)
+    return h.hexdigest()
+
+def load_manifest(path: str = MANIFEST_PATH) -> Optional[dict]:
+    """インデックス済みの文書・チャンクを記録したマニフェストを読み込む（無ければNone）"""
+    if not os.path.exists(path): return None
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    manifest["indexed_ids"] = set(manifest.get("indexed_ids", []))
+    return manifest
+
+def save_manifest(manifest: dict, path: str = MANIFEST_PATH):
+    """途中で落ちても壊れないように、一時ファイルに書いてから置き換える"""
+    data = dict(manifest, indexed_ids=sorted(manifest["indexed_ids"]))
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+class ChunksOutputWriter:
+    """チャンクを届いた順に `chunks_output.txt` へ書き出す（合計数のヘッダーは最後に付ける）"""
+
+    def __init__(self, path: str = "chunks_output.txt"):
+        self.path, self.count = path, 0
+        self._body = open(f"{path}.body.tmp", "w", encoding="utf-8")
+
+    def write(self, chunk: dict):
+        self.count += 1
+        self._body.write(f"--- チャンク {self.count} (Source: {chunk['source']}, Chapter: {chunk['chapter']}, Title: {chunk['title']}) ---\n")
+        self._body.write(chunk['text'])
+        self._body.write("\n\n")
+
+    def close(self):
+        self._body.close()
+        with open(self.path, "w", encoding="utf-8") as f, open(self._body.name, encoding="utf-8") as body:
+            f.write(f"合計チャンク数: {self.count}\n\n")
+            shutil.copyfileobj(body, f)
+        os.remove(self._body.name)
+
+def upsert_batch(batch: list[dict], manifest: dict) -> dict[str, list[float]]:
+    """チャンクをベクトル化してupsertし、マニフェストへ記録する（中断しても再開できる）。upsertしたベクトルをIDごとに返す"""
+    vectors_to_upsert = []
+    texts_for_embedding = [embedding_text(chunk) for chunk in batch]
+    vectors = get_embeddings(texts_for_embedding)
+    for chunk, vector in zip(batch, vectors):
+        if not vector: continue
+
+        # メタデータには元のテキストと構造化情報を保存
+        vectors_to_upsert.append({
+            "id": chunk['id'],
+            "values": vector,
+            "metadata": {
+                "source": chunk['source'],
+                "chapter": chunk['chapter'],
+                "title": chunk['title'],
+                "text": chunk['text']
+            }
+        })
 
-# ★★★★★ GCP認証トークン取得関数を追加 (app.pyからコピー) ★★★★★
-def get_gcp_token() -> str:
-    if gcp_token_cache["token"] and time.time() < gcp_token_cache["expires_at"]: return gcp_token_cache["token"]
-    if not GCP_CREDENTIALS_JSON_STR: raise ValueError("GCP_CREDENTIALS_JSON 環境変数が設定されていません。")
-    try:
-        credentials_info = json.loads(GCP_CREDENTIALS_JSON_STR); creds = service_account.Credentials.from_service_account_info(credentials_info, scopes=["https://www.googleapis.com/auth/cloud-platform"])
-        creds.refresh(Request());
-        if not creds.token: raise ValueError("トークンの取得に失敗しました。")
-        gcp_token_cache["token"] = creds.token; gcp_token_cache["expires_at"] = time.time() + 3300
-        return creds.token
-    except Exception as e: print(f"get_gcp_tokenでエラー: {e}"); raise
-
-# ★★★★★ Vertex AI の text-multilingual-embedding-002 を使うように関数を修正 ★★★★★
-def get_embedding(text: str, task_type="RETRIEVAL_DOCUMENT") -> list[float]:
-    """テキストをベクトルに変換する"""
-    try:
-        token = get_gcp_token()
-        endpoint_url = (f"https://{GCP_LOCATION}-aiplatform.googleapis.com/v1/projects/{GCP_PROJECT_ID}"
-                        f"/locations/{GCP_LOCATION}/publishers/google/models/{embedding_model}:predict")
-        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json; charset=utf-8"}
-        data = {"instances": [{"content": text, "task_type": task_type}]}
-        response = requests.post(endpoint_url, headers=headers, json=data)
-        response.raise_for_status()
-        embedding = response.json()["predictions"][0]["embeddings"]["values"]
-        return embedding
-    except Exception as e:
-        print(f"ベクトル化エラー: {e}")
-        return []
-
-def preprocess_text(text: str) -> str:
-    """OCRテキストからノイズを除去し、整形する関数"""
-    text = re.sub(r'－\s*\d+\s*－', '', text) # ヘッダー/フッター除去
-    text = re.sub(r'^\s*\d+\s*$', '', text, flags=re.MULTILINE) # ページ番号除去
-    text = re.sub(r'(?<!\n)\n(?!\n)', ' ', text) # 文中の不要な改行をスペースに
-    text = re.sub(r'\s+', ' ', text) # 連続するスペースを一つに
-    return text.strip()
-
-def chunk_and_append(content: str, title: str, chapter: str, filename: str, all_chunks: list):
-    """テキストを前処理し、チャンク化してリストに追加するヘルパー関数"""
-    cleaned_content = preprocess_text(content)
-    if len(cleaned_content) < 30: return
-
-    if len(cleaned_content) > CHUNK_SIZE:
-        parts = cleaned_content.split('。')
-        current_chunk = ""
-        for part in parts:
-            if not part: continue
-            # チャンクサイズを超える場合は現在のチャンクを確定し、新しいチャンクを開始
-            if len(current_chunk) + len(part) + 1 > CHUNK_SIZE:
-                if current_chunk:
-                    all_chunks.append({"text": current_chunk.strip() + "。", "source": filename, "title": title, "chapter": chapter})
-                current_chunk = part.strip()
-            else:
-                current_chunk += ("" if not current_chunk else " ") + part.strip() + "。"
-        # 最後のチャンクを追加
-        if current_chunk:
-             all_chunks.append({"text": current_chunk, "source": filename, "title": title, "chapter": chapter})
-    else:
-        all_chunks.append({"text": cleaned_content, "source": filename, "title": title, "chapter": chapter})
-
-def process_section(section_text: str, chapter: str, filename: str, all_chunks: list):
-    """章の内容を条文ごとに分割してチャンク化する"""
-    # 条文で分割。「第X条 (...)」または「(...)」形式の見出しをキャプチャ
-    articles = re.split(r'((?:^第\s*[\d百数十]+条.*?$)|(?:^（.*?）$))', section_text, flags=re.MULTILINE)
-    
-    # 条文がない部分（章の導入部など）を処理
-    if articles and articles[0].strip():
-        chunk_and_append(articles[0], chapter, chapter, filename, all_chunks)
-
-    # 条文ごとの処理
-    for i in range(1, len(articles), 2):
-        article_title = articles[i].strip().replace('\n', ' ')
-        article_content = articles[i+1]
-        chunk_and_append(article_content, article_title, chapter, filename, all_chunks)
-
-def load_and_chunk_documents(directory: str) -> list[dict]:
-    """文書を読み込み、章・条を考慮してチャンクに分割する賢い関数（改善版）"""
-    all_chunks = []
-    print(f"'{directory}'フォルダ内のドキュメントを読み込みます...")
-    if not os.path.exists(directory):
-        print(f"エラー: '{directory}' フォルダが見つかりません。")
-        return []
-
-    for filename in os.listdir(directory):
-        path = os.path.join(directory, filename)
-        if not os.path.isfile(path) or not filename.endswith(".pdf"):
-            continue
-
-        print(f"\n--- ファイル '{filename}' を処理中... ---")
-        full_text = ""
-        try:
-            with fitz.open(path) as doc:
-                full_text = "".join(page.get_text("text", sort=True) for page in doc)
-        except Exception as e:
-            print(f"  PDF読み込みエラー: {e}")
-            continue
-
-        # 章、附則、別表などで文書を大きなセクションに分割
-        # PDFの構造に合わせて正規表現を調整
-        section_pattern = r'((?:^第\s*[\d一二三四五六七八九十百]+章.*?$)|(?:^附\s*則.*?$)|(?:^別\s*表.*?$)|(?:^Ⅰ\s+総\s*則)|(?:^Ⅱ\s+.*?要件)|(?:^Ⅲ\s+.*?要件)|(?:^Ⅳ\s+.*?基準))'
-        sections = re.split(section_pattern, full_text, flags=re.MULTILINE)
-
-        # 最初のセクション（序文など）を処理
-        if sections and sections[0].strip():
-            process_section(sections[0], "序文", filename, all_chunks)
-        
-        # 章ごとの処理
-        for i in range(1, len(sections), 2):
-            chapter_title = sections[i].strip().replace('\n', ' ')
-            chapter_text = sections[i+1]
-            process_section(chapter_text, chapter_title, filename, all_chunks)
-    
-    return all_chunks
+    if vectors_to_upsert:
+        pinecone_index.upsert(vectors=vectors_to_upsert, namespace=NAMESPACE)
+        manifest["indexed_ids"].update(v["id"] for v in vectors_to_upsert)
+        save_manifest(manifest)
+    return {v["id"]: v["values"] for v in vectors_to_upsert}
+
+def delete_stale_chunks(stale_ids: list[str], manifest: dict, batch_size: int = 1000):
+    for i in range(0, len(stale_ids), batch_size):
+        batch = stale_ids[i:i + batch_size]
+        pinecone_index.delete(ids=batch, namespace=NAMESPACE)
+        manifest["indexed_ids"].difference_update(batch)
+        save_manifest(manifest)
+
+def load_retained_chunks(chunk_ids: list[str]) -> dict[str, dict]:
+    """読み込みに失敗した文書の前回のチャンク（メタデータは前回のスナップショットから、無ければPineconeからfetchする）"""
+    previous = LocalVectorIndex.load(SNAPSHOT_PREFIX) if snapshot_exists(SNAPSHOT_PREFIX) else None
+    chunks, missing = {}, []
+    for cid in chunk_ids:
+        if previous is not None and (found := previous.get(cid)) is not None: chunks[cid] = dict(found[1], id=cid)
+        else: missing.append(cid)
+    for i in range(0, len(missing), 100):
+        response = pinecone_index.fetch(ids=missing[i:i + 100], namespace=NAMESPACE)
+        for cid, vector in response.vectors.items(): chunks[cid] = dict(vector.metadata or {}, id=cid)
+    return chunks
+
+def write_local_snapshot(current: dict[str, dict], fresh_vectors: dict[str, list[float]], manifest: dict, fetch_batch_size: int = 100):
+    """Pineconeと同じ内容のローカルスナップショットを書き出す
+
+    今回upsertしたベクトルはそのまま使い、変更のないチャンクは前回のスナップショットから、
+    それにも無いものだけPineconeからfetchして補う。
+    """
+    previous = LocalVectorIndex.load(SNAPSHOT_PREFIX) if snapshot_exists(SNAPSHOT_PREFIX) else None
+    ids = [cid for cid in current if cid in manifest["indexed_ids"]]
+    vectors, missing = {}, []
+    for cid in ids:
+        if cid in fresh_vectors: vectors[cid] = fresh_vectors[cid]
+        elif previous is not None and (found := previous.get(cid)) is not None: vectors[cid] = found[0]
+        else: missing.append(cid)
+
+    for i in range(0, len(missing), fetch_batch_size):
+        response = pinecone_index.fetch(ids=missing[i:i + fetch_batch_size], namespace=NAMESPACE)
+        for cid, vector in response.vectors.items(): vectors[cid] = vector.values
+
+    ids = [cid for cid in ids if cid in vectors]
+    metadatas = [{k: current[cid][k] for k in ("source", "chapter", "title", "text")} for cid in ids]
+    version = write_snapshot(SNAPSHOT_PREFIX, ids, [vectors[cid] for cid in ids], metadatas)
+    print(f"ローカル検索用スナップショット '{SNAPSHOT_PREFIX}.npy/.json' を書き出しました: {len(ids)}件 (version: {version})")
+    BigramBM25Index.build(ids, metadatas, version=version).save(LEXICAL_INDEX_PATH)
+    print(f"語彙検索用の転置インデックス '{LEXICAL_INDEX_PATH}' を書き出しました。")
+    if redis_client is not None:
+        # app.py の回答キャッシュはこのバージョンが変わると古い回答を使わなくなる
+        redis_client.set(DOCS_VERSION_KEY, version)
+        print(f"インデックスのバージョンをRedisの '{DOCS_VERSION_KEY}' に保存しました。")
 
 def main():
-    try:
-        print(f"既存の名前空間 '{NAMESPACE}' のデータをクリアします...")
-        pinecone_index.delete(delete_all=True, namespace=NAMESPACE)
-        print("クリア完了。")
-    except Exception as e:
-        print(f"名前空間のクリア中にエラーが発生しました（初回実行の場合は問題ありません）: {e}")
-
-    chunks = load_and_chunk_documents(DOCUMENTS_DIR)
-    if not chunks:
+    parser = argparse.ArgumentParser(description=f"documents/ のPDFを名前空間 '{NAMESPACE}' に差分インデックスします。")
+    parser.add_argument("--rebuild", action="store_true", help="名前空間を全削除して最初から作り直す")
+    parser.add_argument("--yes", action="store_true", help="確認プロンプトを省略する")
+    parser.add_argument("--dry-run", action="store_true", help="chunks_output.txt と差分の確認だけ行い、Pineconeは更新しない")
+    parser.add_argument("--workers", type=int, default=None, help="PDF抽出・チャンク化のプロセス数（1で逐次処理）")
+    args = parser.parse_args()
+
+    if not args.yes and not args.dry_run:
+        user_confirm = input("インデックス作成を続行しますか？（事前確認は --dry-run） (y/n): ")
+        if user_confirm.lower() != 'y':
+            print("処理を中断しました。")
+            return
+
+    manifest = None if args.rebuild else load_manifest()
+    if manifest is None:
+        manifest = {"namespace": NAMESPACE, "documents": {}, "indexed_ids": set()}
+        if not args.dry_run:
+            # マニフェストが無い＝旧方式（ランダムID）のベクトルが残っている可能性があるので一度だけ全削除する
+            try:
+                print(f"既存の名前空間 '{NAMESPACE}' のデータをクリアします...")
+                pinecone_index.delete(delete_all=True, namespace=NAMESPACE)
+                print("クリア完了。")
+            except Exception as e:
+                print(f"名前空間のクリア中にエラーが発生しました（初回実行の場合は問題ありません）: {e}")
+            save_manifest(manifest)
+
+    # 前回と同じチャンク分割で、内容も変わらず全チャンクをインデックス済みのPDFは、抽出し直さずに前回のチャンクIDを使う
+    hashes = {filename: file_sha256(path) for filename, path in list_pdfs(DOCUMENTS_DIR)}
+    chunker_version = file_sha256(document_chunker.__file__)
+    unchanged = set()
+    if manifest.get("chunker") == chunker_version:
+        unchanged = {filename for filename, sha256 in hashes.items()
+                     if (previous := manifest["documents"].get(filename)) and previous.get("sha256") == sha256
+                     and manifest["indexed_ids"].issuperset(previous["chunk_ids"])}
+
+    # 抽出・チャンク化されたものから順に、新規チャンクだけをベクトル化してupsertしていく
+    writer = ChunksOutputWriter()
+    documents, current, fresh_vectors, pending, new_count, failed = {}, {}, {}, [], 0, set()
+    for chunk in tqdm(iter_document_chunks(DOCUMENTS_DIR, workers=args.workers, failed=failed, skip=unchanged), unit="chunk"):
+        writer.write(chunk)
+        chunk['id'] = chunk_id(chunk)
+        if chunk['id'] in current: continue  # 同一内容のチャンクは同じIDなので1つにまとめる
+        current[chunk['id']] = chunk
+        documents.setdefault(chunk['source'], {"chunk_ids": []})["chunk_ids"].append(chunk['id'])
+        if chunk['id'] in manifest["indexed_ids"]: continue
+        new_count += 1
+        pending.append(chunk)
+        if len(pending) >= UPSERT_BATCH_SIZE and not args.dry_run:
+            fresh_vectors.update(upsert_batch(pending, manifest)); pending = []
+    if unchanged:
+        retained = load_retained_chunks(sorted({cid for f in unchanged for cid in manifest["documents"][f]["chunk_ids"]} - current.keys()))
+        for filename in sorted(unchanged):
+            documents[filename] = manifest["documents"][filename]
+            for cid in documents[filename]["chunk_ids"]:
+                if cid in retained: writer.write(retained[cid]); current.setdefault(cid, retained[cid])
+    writer.close()
+    print("\n★ `chunks_output.txt` に分割されたチャンクを出力しました。中身を確認してください。")
+
+    if not current:
         print("処理対象のドキュメントが見つかりませんでした。")
         return
+    if pending and not args.dry_run:
+        fresh_vectors.update(upsert_batch(pending, manifest))
 
-    with open("chunks_output.txt", "w", encoding="utf-8") as f:
-        f.write(f"合計チャンク数: {len(chunks)}\n\n")
-        for i, chunk in enumerate(chunks):
-            f.write(f"--- チャンク {i+1} (Source: {chunk['source']}, Chapter: {chunk['chapter']}, Title: {chunk['title']}) ---\n")
-            f.write(chunk['text'])
-            f.write("\n\n")
-    print("\n★ `chunks_output.txt` に分割されたチャンクを出力しました。中身を確認してください。")
+    for filename, doc in documents.items():
+        doc["sha256"] = hashes[filename]
+        previous = manifest["documents"].get(filename)
+        if filename in unchanged: status = "変更なし・抽出を省略"
+        else: status = "新規" if previous is None else ("変更なし" if previous.get("sha256") == doc["sha256"] else "変更あり")
+        print(f"  [{status}] {filename}")
+    # 一時的に読み込めなかった文書は削除扱いにせず、前回インデックスしたチャンクをそのまま残す
+    retained_ids = set()
+    for filename in sorted(failed & manifest["documents"].keys()):
+        documents[filename] = manifest["documents"][filename]
+        retained_ids.update(documents[filename]["chunk_ids"])
+        print(f"  [読み込み失敗・前回のまま] {filename}")
+    for filename in manifest["documents"].keys() - documents.keys():
+        print(f"  [削除] {filename}")
 
-    user_confirm = input("インデックス作成を続行しますか？ (y/n): ")
-    if user_confirm.lower() != 'y':
-        print("処理を中断しました。")
+    stale_ids = sorted(manifest["indexed_ids"] - current.keys() - retained_ids)
+    print(f"\n追加・更新: {new_count}件 / 削除: {len(stale_ids)}件 / 変更なし: {len(current) - new_count}件")
+    if args.dry_run:
+        print("--dry-run のためPineconeは更新していません。")
         return
 
-    print("ベクトル化とPineconeへの保存を開始します...")
-    batch_size = 100
-    for i in tqdm(range(0, len(chunks), batch_size)):
-        batch = chunks[i:i + batch_size]
-        vectors_to_upsert = []
-        for chunk in batch:
-            # 検索時の関連性を高めるため、階層的なメタデータもテキストに含めてベクトル化
-            text_for_embedding = f"文書: {chunk['source']}, 章: {chunk['chapter']}, 見出し: {chunk['title']}\n内容: {chunk['text']}"
-            vector = get_embedding(text_for_embedding)
-            if not vector: continue
-            
-            # メタデータには元のテキストと構造化情報を保存
-            vectors_to_upsert.append({
-                "id": str(uuid.uuid4()),
-                "values": vector,
-                "metadata": {
-                    "source": chunk['source'], 
-                    "chapter": chunk['chapter'], 
-                    "title": chunk['title'], 
-                    "text": chunk['text']
-                }
-            })
-        
-        if vectors_to_upsert:
-            pinecone_index.upsert(vectors=vectors_to_upsert, namespace=NAMESPACE)
-        time.sleep(1) # APIレート制限対策
+    delete_stale_chunks(stale_ids, manifest)
+    current.update(load_retained_chunks(sorted(retained_ids - current.keys())))
+    manifest["documents"], manifest["chunker"] = documents, chunker_version
+    save_manifest(manifest)
+    write_local_snapshot(current, fresh_vectors, manifest)
 
     print("\nすべてのドキュメントのインデックス作成が完了しました！")
+    print(f"Embeddingキャッシュ: {embedding_cache.metrics()}")
     stats = pinecone_index.describe_index_stats()
     print(f"名前空間 '{NAMESPACE}' に {stats.get('namespaces', {}).get(NAMESPACE, {}).get('vector_count', 0)} 件のベクトルが保存されています。")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
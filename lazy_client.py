@@ -0,0 +1,43 @@
+# lazy_client.py (外部サービスのクライアントを最初に使うときまで作らないための薄いプロキシ)
+#
+# Vercelのサーバーレス関数はコールドスタートのたびにapp.pyをimportし直すので、
+# Gemini / Redis / Pinecone のimportと接続はヘルスチェック（/）などでは行わず、実際に使う処理で初めて行う。
+# 一度作ったクライアントはモジュール変数に残るので、ウォームなコンテナでは次のリクエストからそのまま使い回される。
+
+import threading
+import time
+from typing import Any, Callable
+
+
+class LazyClient:
+    """factory() の結果に属性アクセスを委譲する。factoryは最初の属性アクセス時に一度だけ呼ばれる
+
+    クライアント側の属性（redisのget など）を隠さないよう、プロキシ自身の属性はすべて _ で始める。
+    """
+
+    def __init__(self, factory: Callable[[], Any], name: str):
+        self._factory = factory
+        self._name = name
+        self._client = None
+        self._lock = threading.Lock()
+        self._init_seconds = None
+
+    def _get_client(self) -> Any:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    started = time.perf_counter()
+                    self._client = self._factory()
+                    self._init_seconds = time.perf_counter() - started
+                    print(f"{self._name} のクライアントを初期化しました ({self._init_seconds * 1000:.0f}ms)")
+        return self._client
+
+    @property
+    def _initialized(self) -> bool:
+        return self._client is not None
+
+    def __getattr__(self, attr: str):
+        return getattr(self._get_client(), attr)
+
+    def __repr__(self) -> str:
+        return f"LazyClient({self._name}, initialized={self._initialized})"
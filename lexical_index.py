@@ -0,0 +1,136 @@
+# lexical_index.py (company-docs の文字バイグラム転置インデックス + BM25)
+#
+# 条番号（第12条）や「託送」「系統連系」「出力抑制」のような完全一致させたい用語は、
+# 埋め込み検索だけだと取りこぼしやすい。index_documents.py がチャンクから転置インデックスを作って保存し、
+# app.py はベクトル検索の結果とReciprocal Rank Fusionで統合する。
+
+import heapq
+import json
+import math
+import os
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+from local_index import Match
+
+RRF_K = 60
+# 質問文には入るが、それだけでは何も絞り込めない語（Q&Aトリガーなど）
+STOP_TERMS = {"規定", "ルール", "方法", "条件", "説明", "内容", "場合", "手続", "手続き", "について", "とは"}
+KEY_TERM_RE = re.compile(r'第\d+[条章項号節]|別表\d*|[一-龥々〆ヵヶ]{2,}|[ァ-ヴー]{2,}|[A-Za-z0-9][A-Za-z0-9.\-]+')
+ARTICLE_RE = re.compile(r'第\d+[条章項号節]|別表\d+')
+
+
+def normalize(text: str) -> str:
+    """全角英数字などをNFKCで揃え、空白を除いて小文字化する（「第１２条」と「第 12 条」を同じにする）"""
+    return re.sub(r'\s+', '', unicodedata.normalize("NFKC", text)).lower()
+
+def bigrams(text: str) -> list[str]:
+    text = normalize(text)
+    if len(text) == 1: return [text]
+    return [text[i:i + 2] for i in range(len(text) - 1)]
+
+def extract_key_terms(question: str) -> list[str]:
+    """質問から完全一致で探すべき用語（条番号、漢字・カタカナの連なり、英数字）を取り出す"""
+    text = unicodedata.normalize("NFKC", question)
+    terms = [normalize(t) for t in KEY_TERM_RE.findall(text)]
+    return [t for t in dict.fromkeys(terms) if t not in STOP_TERMS]
+
+def has_article_reference(question: str) -> bool:
+    return bool(ARTICLE_RE.search(unicodedata.normalize("NFKC", question)))
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = RRF_K) -> list[tuple[str, float]]:
+    """複数のIDランキングを 1/(k + 順位) の和で統合し、スコアの高い順に返す"""
+    scores: dict[str, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1): scores[doc_id] += 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+
+def fuse_vector_and_lexical(responses: list[dict], lexical_hits: list[Match], limit: int = 5) -> list[tuple[Match, float, float]]:
+    """拡張クエリごとのベクトル検索結果（同じチャンクは最高スコアを残す）と語彙検索の結果をRRFで統合し、
+    上位limit件を (Match, ベクトルのスコア（語彙検索だけで見つかったら0）, RRFスコア) で返す"""
+    vector_matches: dict[str, Match] = {}
+    for response in responses:
+        for match in response['matches']:
+            if match.id not in vector_matches or match.score > vector_matches[match.id].score: vector_matches[match.id] = match
+    ranked = sorted(vector_matches.values(), key=lambda m: m.score, reverse=True)
+    fused = reciprocal_rank_fusion([[m.id for m in ranked], [m.id for m in lexical_hits]])
+    matches_by_id = {m.id: m for m in lexical_hits}; matches_by_id.update(vector_matches)
+    return [(matches_by_id[doc_id], vector_matches[doc_id].score if doc_id in vector_matches else 0.0, score) for doc_id, score in fused[:limit]]
+
+def can_skip_expansion(question: str, key_terms: list[str], lexical_hits: list[Match], strong_ids: set[str]) -> bool:
+    """語彙検索の1位が質問の用語をすべてそのまま含み、条番号か十分な長さの用語があれば、LLMのクエリ拡張を省いてよい"""
+    return bool(lexical_hits) and lexical_hits[0].id in strong_ids and (has_article_reference(question) or sum(map(len, key_terms)) >= 4)
+
+def is_context_match(match: Match, vector_score: float, strong_ids: set[str], threshold: float) -> bool:
+    """統合後の検索結果のうち、Geminiに渡すチャンクか（ベクトルのスコアがしきい値を超えるか、用語が完全一致した）"""
+    return vector_score > threshold or match.id in strong_ids
+
+
+class BigramBM25Index:
+    """文字バイグラムの転置インデックスとBM25スコアリング"""
+
+    def __init__(self, ids: list[str], metadatas: list[dict], postings: dict[str, list[int]], doc_lengths: list[int],
+                 version: str = "", k1: float = 1.2, b: float = 0.75):
+        self.ids, self.metadatas, self.postings, self.doc_lengths = ids, metadatas, postings, doc_lengths
+        self.version, self.k1, self.b = version, k1, b
+        self.avg_length = (sum(doc_lengths) / len(doc_lengths)) if doc_lengths else 0.0
+        self._normalized = [normalize(self._searchable_text(m)) for m in metadatas]
+        self._positions = {doc_id: i for i, doc_id in enumerate(ids)}
+
+    @staticmethod
+    def _searchable_text(metadata: dict) -> str:
+        return f"{metadata.get('chapter', '')} {metadata.get('title', '')} {metadata.get('text', '')}"
+
+    @classmethod
+    def build(cls, ids: list[str], metadatas: list[dict], version: str = "") -> "BigramBM25Index":
+        postings: dict[str, list[int]] = defaultdict(list)
+        doc_lengths = []
+        for doc, metadata in enumerate(metadatas):
+            grams = bigrams(cls._searchable_text(metadata))
+            doc_lengths.append(len(grams))
+            for gram, tf in Counter(grams).items(): postings[gram].extend((doc, tf))  # [doc, tf, doc, tf, ...] の平坦なリスト
+        return cls(ids, metadatas, dict(postings), doc_lengths, version)
+
+    def save(self, path: str):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": self.version, "ids": self.ids, "metadata": self.metadatas,
+                       "doc_lengths": self.doc_lengths, "postings": self.postings}, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BigramBM25Index":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["ids"], data["metadata"], data["postings"], data["doc_lengths"], data.get("version", ""))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query: str, top_k: int = 5) -> list[Match]:
+        """BM25スコアの高い順にMatchを返す（scoreはBM25の値）
+
+        質問の用語（条番号など）をすべてそのまま含むチャンクは、BM25の上位候補の中で優先して前に出す。
+        """
+        n = len(self.ids)
+        scores: dict[int, float] = defaultdict(float)
+        for gram, qtf in Counter(bigrams(query)).items():
+            posting = self.postings.get(gram)
+            if not posting: continue
+            df = len(posting) // 2
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for i in range(0, len(posting), 2):
+                doc, tf = posting[i], posting[i + 1]
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc] / self.avg_length)
+                scores[doc] += qtf * idf * tf * (self.k1 + 1) / (tf + norm)
+        candidates = heapq.nlargest(top_k * 4, scores.items(), key=lambda x: x[1])
+        terms = extract_key_terms(query)
+        if terms:
+            candidates.sort(key=lambda x: not all(t in self._normalized[x[0]] for t in terms))  # 安定ソートなのでBM25順は保たれる
+        return [Match(self.ids[doc], score, self.metadatas[doc]) for doc, score in candidates[:top_k]]
+
+    def contains_all(self, doc_id: str, terms: list[str]) -> bool:
+        """チャンクが（正規化後の）用語をすべてそのまま含むか"""
+        i = self._positions.get(doc_id)
+        return i is not None and bool(terms) and all(t in self._normalized[i] for t in terms)
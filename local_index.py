@@ -0,0 +1,94 @@
+# local_index.py (company-docs 名前空間のローカル検索用インデックス)
+#
+# index_documents.py が書き出すスナップショット（<prefix>.npy の正規化済みfloat32行列 + <prefix>.json のID・メタデータ）を
+# 読み込み、Pineconeへの往復なしでコサイン類似度のtop-k検索を行う。行列はmmapで開くので、同じホスト上のワーカー間でページを共有できる。
+
+import hashlib
+import json
+import os
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    import numpy as np  # numpyのimportは重いので、Matchだけを使う語彙検索（lexical_index.py）のimport時には読み込まない
+
+
+class Match:
+    """Pineconeの検索結果と同じく id / score / metadata を属性でも添字でも参照できる検索結果"""
+    __slots__ = ("id", "score", "metadata")
+
+    def __init__(self, id: str, score: float, metadata: dict):
+        self.id, self.score, self.metadata = id, score, metadata
+
+    def __getitem__(self, key: str):
+        return getattr(self, key)
+
+    def __repr__(self) -> str:
+        return f"Match(id={self.id!r}, score={self.score:.4f})"
+
+
+def snapshot_version(ids: list[str]) -> str:
+    """チャンクIDは内容から決まるので、ID集合のハッシュをインデックスのバージョンとして使う"""
+    return hashlib.sha256("\n".join(sorted(ids)).encode("utf-8")).hexdigest()[:16]
+
+def snapshot_exists(prefix: str) -> bool:
+    return os.path.exists(f"{prefix}.npy") and os.path.exists(f"{prefix}.json")
+
+def write_snapshot(prefix: str, ids: list[str], vectors: list[list[float]], metadatas: list[dict]) -> str:
+    """スナップショットを書き出してバージョンを返す。読み込み途中のプロセスがあっても壊れないよう一時ファイル経由で置き換える"""
+    import numpy as np
+    matrix = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1, norms)
+    version = snapshot_version(ids)
+
+    with open(f"{prefix}.npy.tmp", "wb") as f: np.save(f, matrix)
+    with open(f"{prefix}.json.tmp", "w", encoding="utf-8") as f:
+        json.dump({"version": version, "ids": ids, "metadata": metadatas}, f, ensure_ascii=False)
+    os.replace(f"{prefix}.npy.tmp", f"{prefix}.npy")
+    os.replace(f"{prefix}.json.tmp", f"{prefix}.json")
+    return version
+
+
+class LocalVectorIndex:
+    """正規化済みベクトル行列に対する総当たりのコサイン類似度検索（数千件規模なら行列積1回で十分速い）"""
+
+    def __init__(self, matrix: "np.ndarray", ids: list[str], metadatas: list[dict], version: str):
+        self.matrix, self.ids, self.metadatas, self.version = matrix, ids, metadatas, version
+        self._positions = {cid: i for i, cid in enumerate(ids)}
+
+    @classmethod
+    def load(cls, prefix: str, mmap: bool = True) -> "LocalVectorIndex":
+        import numpy as np
+        with open(f"{prefix}.json", encoding="utf-8") as f:
+            meta = json.load(f)
+        matrix = np.load(f"{prefix}.npy", mmap_mode="r" if mmap else None)
+        if matrix.shape[0] != len(meta["ids"]):
+            raise ValueError(f"スナップショットの行数とID数が一致しません: {matrix.shape[0]}/{len(meta['ids'])}")
+        return cls(matrix, meta["ids"], meta["metadata"], meta.get("version", ""))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def get(self, chunk_id: str) -> Optional[tuple[list[float], dict]]:
+        """IDに対応する（正規化済み）ベクトルとメタデータを返す"""
+        i = self._positions.get(chunk_id)
+        if i is None: return None
+        return self.matrix[i].tolist(), self.metadatas[i]
+
+    def query_many(self, vectors: list[list[float]], top_k: int = 3) -> list[dict]:
+        """複数クエリをまとめて行列積で検索し、クエリごとに {"matches": [Match, ...]} を返す"""
+        import numpy as np
+        if not vectors or not len(self): return [{"matches": []} for _ in vectors]
+        queries = np.asarray(vectors, dtype=np.float32)
+        queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        scores = queries @ self.matrix.T
+        k = min(top_k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row, candidates in zip(scores, top):
+            ordered = candidates[np.argsort(-row[candidates])]
+            results.append({"matches": [Match(self.ids[i], float(row[i]), self.metadatas[i]) for i in ordered]})
+        return results
+
+    def query(self, vector: list[float], top_k: int = 3) -> dict:
+        return self.query_many([vector], top_k=top_k)[0]
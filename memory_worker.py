@@ -0,0 +1,110 @@
+# memory_worker.py (長期記憶の要約・保存を返信の後にまとめて行うワーカー)
+
+import atexit
+import threading
+import time
+from typing import Callable, Optional
+
+
+class MemoryConsolidator:
+    """ユーザーごとに新しい会話ターンを溜め、一定数たまるか一定時間発言が途切れたら要約して長期記憶に保存する
+
+    要約（LLM）はユーザーごとに行うが、ベクトル化とPineconeへのupsertは複数ユーザー分をまとめて1回で行う。
+    ターンを消すのは保存に成功したとき（または要約する情報が無かったとき）だけで、要約・保存に失敗したら間を空けてやり直す。
+    合計min_chars文字に満たない会話は、要約できる長さになるまで（最長pending_ttl_seconds秒）溜めておく。
+    background=Falseなら監視スレッドを持たず、呼び出し側が返信を送った後にflushする（Vercelのように応答後の処理が保証されない環境用）。
+    このとき要約できる長さになった会話は溜めずにすぐ要約する。
+    """
+
+    def __init__(self, summarize: Callable[[list[str]], Optional[str]], store: Callable[[list[tuple[str, str]]], None],
+                 turns_threshold: int = 4, idle_seconds: float = 300.0, poll_seconds: float = 5.0, min_chars: int = 0,
+                 pending_ttl_seconds: float = 24 * 3600, max_pending_turns: int = 50, background: bool = False):
+        self.summarize = summarize
+        self.store = store
+        self.turns_threshold = turns_threshold
+        self.idle_seconds = idle_seconds
+        self.poll_seconds = poll_seconds
+        self.min_chars = min_chars
+        self.pending_ttl_seconds = pending_ttl_seconds
+        self.max_pending_turns = max_pending_turns
+        self.background = background
+        self.stats = {"turns": 0, "summarized": 0, "skipped": 0, "stored": 0, "batches": 0, "errors": 0, "retried": 0, "expired": 0}
+        self._pending: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        if background:
+            threading.Thread(target=self._loop, name="memory-consolidator", daemon=True).start()
+            atexit.register(self.flush, force=True)
+
+    def add_turns(self, user_id: str, turns: list[str]):
+        """返信を作った直後に呼ばれる。ここではキューに積むだけなので返信のレイテンシには影響しない"""
+        with self._lock:
+            entry = self._pending.setdefault(user_id, {"turns": [], "last_at": 0.0})
+            entry["turns"].extend(turns); entry["last_at"] = time.time()
+            del entry["turns"][:-self.max_pending_turns]
+            self.stats["turns"] += len(turns)
+
+    def pending_users(self) -> int:
+        with self._lock: return len(self._pending)
+
+    def metrics(self) -> dict:
+        with self._lock: stats = dict(self.stats); stats["pending_users"] = len(self._pending)
+        return stats
+
+    def flush(self, force: bool = False):
+        """しきい値に達した（force時は全）ユーザーの会話を要約し、まとめて保存する"""
+        now = time.time()
+        with self._lock:
+            for uid in [uid for uid, e in self._pending.items() if self._too_short(e) and now - e["last_at"] >= self.pending_ttl_seconds]:
+                del self._pending[uid]; self.stats["expired"] += 1  # 長い間要約できる長さにならなかった会話は捨てる
+            ready = [uid for uid, e in self._pending.items() if force or self._ready(e, now)]
+            batch = {uid: self._pending.pop(uid) for uid in ready}
+        if not batch: return
+
+        summaries, failed = [], {}
+        for user_id, entry in batch.items():
+            try:
+                summary = self.summarize(entry["turns"])
+            except Exception as e:
+                print(f"[{user_id}] 記憶の要約でエラー: {e}"); self._incr("errors")
+                failed[user_id] = entry
+                continue
+            if summary: summaries.append((user_id, summary)); self._incr("summarized")
+            else: self._incr("skipped")
+
+        if summaries:
+            try:
+                self.store(summaries)
+                self._incr("stored", len(summaries)); self._incr("batches")
+            except Exception as e:
+                print(f"記憶の一括保存でエラー: {e}"); self._incr("errors")
+                failed.update((user_id, batch[user_id]) for user_id, _ in summaries)
+        if failed: self._requeue(failed)
+
+    def _too_short(self, entry: dict) -> bool:
+        return sum(len(t) + 1 for t in entry["turns"]) - 1 < self.min_chars
+
+    def _ready(self, entry: dict, now: float) -> bool:
+        if now < entry.get("retry_at", 0.0) or self._too_short(entry): return False
+        if not self.background: return True  # 次のリクエストまでプロセスが残る保証が無いので、発言が途切れるのを待たない
+        return len(entry["turns"]) >= self.turns_threshold or now - entry["last_at"] >= self.idle_seconds
+
+    def _requeue(self, failed: dict[str, dict]):
+        """要約・保存に失敗した会話を、その間に届いたターンの前に戻す（失敗が続くほど間を空けてやり直す）"""
+        now = time.time()
+        with self._lock:
+            for user_id, entry in failed.items():
+                current = self._pending.get(user_id)
+                failures = entry.get("failures", 0) + 1
+                self._pending[user_id] = {"turns": (entry["turns"] + (current["turns"] if current else []))[-self.max_pending_turns:],
+                                          "last_at": current["last_at"] if current else entry["last_at"], "failures": failures,
+                                          "retry_at": now + min(self.idle_seconds, self.poll_seconds * 2 ** failures)}
+                self.stats["retried"] += 1
+
+    def _loop(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            try: self.flush()
+            except Exception as e: print(f"記憶の統合ワーカーでエラー: {e}")
+
+    def _incr(self, key: str, n: int = 1):
+        with self._lock: self.stats[key] += n
@@ -0,0 +1,127 @@
+# prompt_builder.py (トークン予算つきのプロンプト組み立てと、静的な接頭辞のコンテキストキャッシュ)
+#
+# ペルソナ・振る舞いルール・参考対話やQ&Aのルールのように毎回同じ部分は system_instruction（接頭辞）として
+# モデル側に持たせ、会話ごとに変わる部分（記憶・会話履歴・検索したチャンク・質問）だけを予算内に収めて送る。
+# 接頭辞はGeminiのコンテキストキャッシュに載せられれば、毎回送り直して課金されることもなくなる。
+
+import datetime
+import threading
+import time
+
+from tracing import log_event
+
+
+def estimate_tokens(text: str) -> int:
+    """Geminiのトークン数のおおよその見積もり（日本語などは1文字≒1トークン、英数字は4文字≒1トークン）"""
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """見積もりがmax_tokensに収まるよう末尾を切り詰める"""
+    if estimate_tokens(text) <= max_tokens: return text
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) + 1 <= max_tokens: low = mid
+        else: high = mid - 1
+    return text[:low] + "…" if low else ""
+
+
+class PromptBudget:
+    """優先度の高いセクションから順に追加し、予算を超える分を落とす。セクションごとのトークン数を記録する"""
+
+    def __init__(self, max_tokens: int):
+        self.max_tokens = max_tokens
+        self.used = 0
+        self.sections: dict[str, int] = {}
+        self.dropped: dict[str, int] = {}
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.max_tokens - self.used)
+
+    def add(self, name: str, text: str, required: bool = False, truncate: bool = True) -> str:
+        """textを追加して返す。required以外で入りきらなければ末尾を切り詰める（truncate=Falseなら丸ごと落として空文字を返す）"""
+        if not required and estimate_tokens(text) > self.remaining:
+            self.dropped[name] = self.dropped.get(name, 0) + (estimate_tokens(text) - self.remaining if truncate else 1)
+            text = truncate_to_tokens(text, self.remaining) if truncate else ""
+        self._record(name, estimate_tokens(text))
+        return text
+
+    def add_items(self, name: str, items: list[str], newest_last: bool = False, truncate_first: bool = False) -> list[str]:
+        """優先度順のitems（newest_lastなら末尾が最優先）を、入りきらない最初の1件の手前まで選んで元の順序で返す
+
+        結果は常にitemsの先頭（newest_lastなら末尾）からの連続した範囲になる。truncate_firstなら最優先の1件だけは切り詰めてでも入れる。
+        """
+        ordered = list(reversed(items)) if newest_last else list(items)
+        kept, tokens = [], 0
+        for item in ordered:
+            cost = estimate_tokens(item) + 1  # 区切りの改行の分
+            if tokens + cost > self.remaining:
+                if not kept and truncate_first and self.remaining > 1:
+                    item = truncate_to_tokens(item, self.remaining - 1); kept.append(item); tokens += estimate_tokens(item) + 1
+                break
+            kept.append(item); tokens += cost
+        if len(kept) < len(items): self.dropped[name] = self.dropped.get(name, 0) + len(items) - len(kept)
+        self._record(name, tokens)
+        return list(reversed(kept)) if newest_last else kept
+
+    def log(self, kind: str, **fields):
+        log_event("prompt", kind=kind, budget=self.max_tokens, used=self.used, sections=self.sections, dropped=self.dropped, **fields)
+
+    def _record(self, name: str, tokens: int):
+        self.sections[name] = self.sections.get(name, 0) + tokens
+        self.used += tokens
+
+
+class CachedPrefixModel:
+    """静的な接頭辞をsystem_instructionに持つGeminiのモデル。cache_ttl_secondsを指定するとコンテキストキャッシュに載せて使い回す
+
+    キャッシュを作れなかったとき（接頭辞がキャッシュの最小トークン数に満たない・未対応のモデルなど）は、
+    cache_ttl_seconds の間は通常の system_instruction 付きの呼び出しで代用し、その後もう一度作成を試す。
+    """
+
+    def __init__(self, model_name: str, system_instruction: str, cache_ttl_seconds: int = 0, display_name: str = "makot-prefix"):
+        import google.generativeai as genai
+        self._genai = genai
+        self.base = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+        self.model_name = self.base.model_name  # GeminiSchedulerは同じモデルの呼び出しを同じ枠で数える
+        self.system_instruction = system_instruction
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self.display_name = display_name
+        self.prefix_tokens = estimate_tokens(system_instruction)
+        self._cached_model = None
+        self._expires_at = 0.0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def generate_content(self, contents, **kwargs):
+        model = self._current()
+        if model is self.base: return model.generate_content(contents, **kwargs)
+        try:
+            return model.generate_content(contents, **kwargs)
+        except Exception as e:
+            if "cachedcontent" not in str(e).lower() and getattr(e, "code", None) != 404: raise
+            print(f"コンテキストキャッシュが使えなくなったため作り直します: {e}")
+            with self._lock: self._cached_model = None
+            return self.base.generate_content(contents, **kwargs)
+
+    def _current(self):
+        if self.cache_ttl_seconds <= 0: return self.base
+        now = time.time()
+        with self._lock:
+            if self._cached_model is not None and now < self._expires_at - 60: return self._cached_model
+            if now < self._retry_at: return self.base
+            try:
+                from google.generativeai import caching
+                cache = caching.CachedContent.create(model=self.model_name, display_name=self.display_name,
+                                                     system_instruction=self.system_instruction,
+                                                     ttl=datetime.timedelta(seconds=self.cache_ttl_seconds))
+                self._cached_model = self._genai.GenerativeModel.from_cached_content(cache)
+                self._expires_at = now + self.cache_ttl_seconds
+                print(f"接頭辞をコンテキストキャッシュに載せました: {self.display_name} (約{self.prefix_tokens}トークン)")
+                return self._cached_model
+            except Exception as e:
+                print(f"コンテキストキャッシュを作成できなかったため通常の呼び出しを使います ({self.display_name}): {e}")
+                self._cached_model, self._retry_at = None, now + self.cache_ttl_seconds
+                return self.base
@@ -0,0 +1,85 @@
+# room_coalescer.py (グループ・トークルームでの呼びかけをまとめて1回で返事するための窓)
+#
+# グループで「まこち」と立て続けに呼ばれると、1件ごとにGeminiまでの処理が走る。ルームごとに短い窓を設け、
+# 最初の呼びかけ（リーダー）が窓を開いたら、窓が閉じるまでに来た呼びかけ（フォロワー）は同じまとまりに加えるだけにして、
+# 窓が閉じたらまとめて1回だけ process(ルームID, イベントのリスト, throttled) を呼ぶ。
+# ルームごとのトークンバケットが空なら窓を延ばして（その間の呼びかけもまとめる）待ち、max_wait秒待っても空かなければ
+# throttled=True で呼ぶ（呼び出し側はLLMを使わない短い返事にする）。
+# process はWebhookの応答を返した後にタイマースレッドから呼ばれるので、応答後にプロセスが止められることのある
+# サーバーレス（Vercel）では使わず、常駐プロセスで動かすときだけ有効にすること。
+
+import contextvars
+import threading
+import time
+from typing import Callable
+
+from gemini_scheduler import TokenBucket
+
+
+class RoomCoalescer:
+    """ルームIDごとにwindow_seconds秒の窓で呼びかけをまとめ、毎分rate_per_minute回（最大burst回連続）まで処理する"""
+
+    def __init__(self, process: Callable[[str, list, bool], None], window_seconds: float = 2.0, rate_per_minute: float = 6.0,
+                 burst: int = 3, max_wait: float = 20.0, max_rooms: int = 1000):
+        self.process = process
+        self.window_seconds = window_seconds
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.max_wait = max_wait
+        self.max_rooms = max_rooms
+        self.stats = {"mentions": 0, "batches": 0, "coalesced": 0, "delayed": 0, "throttled": 0, "errors": 0}
+        self._batches: dict[str, dict] = {}
+        self._buckets: dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def add(self, room_id: str, item) -> bool:
+        """呼びかけを追加する。新しい窓を開いた（リーダーになった）ならTrue"""
+        with self._lock:
+            self.stats["mentions"] += 1
+            batch = self._batches.get(room_id)
+            if batch is not None:
+                batch["items"].append(item); self.stats["coalesced"] += 1
+                return False
+            self._batches[room_id] = {"items": [item], "opened_at": time.monotonic()}
+        self._schedule(room_id, self.window_seconds)
+        return True
+
+    def pending_rooms(self) -> int:
+        with self._lock: return len(self._batches)
+
+    def metrics(self) -> dict:
+        with self._lock: stats = dict(self.stats); stats.update(pending_rooms=len(self._batches), rooms=len(self._buckets))
+        return stats
+
+    def _schedule(self, room_id: str, delay: float):
+        timer = threading.Timer(delay, contextvars.copy_context().run, args=(self._flush, room_id))  # リーダーのリクエストIDのまま記録する
+        timer.daemon = True
+        timer.start()
+
+    def _bucket(self, room_id: str) -> TokenBucket:
+        with self._lock:
+            if room_id not in self._buckets:
+                if len(self._buckets) >= self.max_rooms:  # 満タンに戻った（しばらく静かな）ルームのバケットは捨てる
+                    for idle in [r for r, b in self._buckets.items() if b.available() >= b.capacity]: del self._buckets[idle]
+                self._buckets[room_id] = TokenBucket(self.rate_per_minute / 60.0, self.burst)
+            return self._buckets[room_id]
+
+    def _flush(self, room_id: str):
+        wait = self._bucket(room_id).try_acquire()
+        with self._lock:
+            batch = self._batches[room_id]
+            delay = wait > 0 and time.monotonic() - batch["opened_at"] - self.window_seconds + wait <= self.max_wait
+            if delay:
+                self.stats["delayed"] += 1
+            else:
+                del self._batches[room_id]
+                self.stats["batches"] += 1
+                if wait > 0: self.stats["throttled"] += 1
+        if delay:
+            self._schedule(room_id, wait)  # 窓を延ばし、その間の呼びかけもまとめる
+            return
+        try:
+            self.process(room_id, batch["items"], wait > 0)
+        except Exception as e:
+            print(f"[{room_id}] まとめた呼びかけの処理でエラー: {e}")
+            with self._lock: self.stats["errors"] += 1
@@ -0,0 +1,120 @@
+# tracing.py (リクエスト処理の段階ごとの計測・構造化ログ・Prometheus形式のメトリクス)
+#
+# with span("qa.expand_query"): ... のように処理の段階を囲むと、所要時間をヒストグラムに記録し、
+# リクエストID付きのJSONログを1行出力する。リクエストIDはcontextvarsで持つので、スレッドプールに渡す処理は
+# submit_with_context() を通すと同じIDのまま記録される。
+
+import contextvars
+import functools
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from http_client import LatencyHistogram
+
+METRIC_PREFIX = "makot"
+request_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+
+def new_request_id(request_id: Optional[str] = None) -> str:
+    request_id = request_id or uuid.uuid4().hex[:16]
+    request_id_var.set(request_id)
+    return request_id
+
+def get_request_id() -> str:
+    return request_id_var.get()
+
+def log_event(event: str, **fields):
+    """リクエストID付きのJSONを1行で出力する"""
+    record = {"ts": round(time.time(), 3), "request_id": get_request_id(), "event": event, **fields}
+    print(json.dumps(record, ensure_ascii=False, default=str))
+
+def submit_with_context(executor, fn: Callable, *args, **kwargs):
+    """現在のリクエストIDを引き継いだままスレッドプールで実行する"""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class MetricsRegistry:
+    """ラベル付きのカウンターとレイテンシのヒストグラム"""
+
+    def __init__(self):
+        self._counters: dict[tuple, float] = {}
+        self._histograms: dict[tuple, LatencyHistogram] = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, n: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock: self._counters[key] = self._counters.get(key, 0) + n
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock: histogram = self._histograms.setdefault(key, LatencyHistogram())
+        histogram.observe(seconds)
+
+    def render(self) -> list[str]:
+        with self._lock: counters, histograms = dict(self._counters), dict(self._histograms)
+        lines = []
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(format_sample(f"{name}_total", value, dict(labels)))
+        for (name, labels), histogram in sorted(histograms.items(), key=lambda x: x[0]):
+            lines += format_histogram(f"{name}_seconds", histogram.snapshot(), dict(labels))
+        return lines
+
+metrics = MetricsRegistry()
+
+
+@contextmanager
+def span(stage: str, **attrs):
+    """処理の段階を計測する。例外はそのまま送出し、エラー数として数える"""
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield attrs  # 呼び出し側で attrs["hits"] = 3 のように結果を書き足せる
+    except Exception as e:
+        status = "error"; attrs["error"] = str(e)
+        metrics.incr("stage_errors", stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe("stage_duration", elapsed, stage=stage)
+        log_event("span", stage=stage, status=status, duration_ms=round(elapsed * 1000, 1), **attrs)
+
+def traced_handler(name: str):
+    """Webhookのイベントハンドラに付けるデコレータ。webhookEventIdをリクエストIDにして全体を1つのspanで囲む"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(event):  # WebhookHandlerは引数の数を見て呼び方を変えるので、引数はeventだけにする
+            new_request_id(getattr(event, "webhook_event_id", None))
+            metrics.incr("events", handler=name)
+            with span(f"handler.{name}", user_id=getattr(event.source, "user_id", None)):
+                return func(event)
+        return wrapper
+    return decorator
+
+
+# --- Prometheusのテキスト形式 ---
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_sample(name: str, value: float, labels: Optional[dict] = None) -> str:
+    name = f"{METRIC_PREFIX}_{name}"
+    if labels:
+        label_str = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+        return f"{name}{{{label_str}}} {value}"
+    return f"{name} {value}"
+
+def format_histogram(name: str, snapshot: dict, labels: Optional[dict] = None) -> list[str]:
+    """LatencyHistogram.snapshot() の累積バケットを _bucket / _sum / _count の行にする"""
+    labels = labels or {}
+    lines = [format_sample(f"{name}_bucket", count, {**labels, "le": bound}) for bound, count in snapshot["buckets"].items()]
+    lines.append(format_sample(f"{name}_sum", snapshot["sum"], labels))
+    lines.append(format_sample(f"{name}_count", snapshot["count"], labels))
+    return lines
+
+def format_stats(name: str, stats: dict, labels: Optional[dict] = None) -> list[str]:
+    """各コンポーネントの metrics() の辞書のうち数値の項目を {name}_{key} のサンプルにする"""
+    return [format_sample(f"{name}_{key}", float(value), labels) for key, value in stats.items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)]
@@ -0,0 +1,60 @@
+# triggers.py (メッセージの振り分け用キーワードを1回の走査で判定するマッチャー)
+#
+# 画像生成・Q&A・話題・感情・ニックネーム・あいまい表現のキーワードを、import時に1つの正規表現にまとめておく。
+# 先読み (?=(...)) で全位置を調べるので、「厚切り牛タン」の中の「牛タン」のような重なったキーワードも取りこぼさない。
+
+import re
+from functools import lru_cache
+
+from character_makot import MAKOT
+
+IMAGE        = "image"
+QA           = "qa"
+HOBBY        = "hobby"
+WORK         = "work"
+EMOTION_HIGH = "emotion_high"
+EMOTION_LOW  = "emotion_low"
+NICKNAME     = "nickname"
+UNCERTAIN    = "uncertain"
+
+TRIGGER_KEYWORDS: dict[str, list[str]] = {
+    IMAGE:        ["画像", "イラスト", "描いて", "絵を"],
+    QA:           ["教えて", "説明して", "規定", "ルール", "方法", "って何", "とは", "について", "の条件"],
+    HOBBY:        ["趣味", "休日", "ハマって", "コストコ", "ポケポケ"],
+    WORK:         ["仕事", "業務", "残業", "請求書", "統計"],
+    EMOTION_HIGH: MAKOT["emotion_triggers"]["high"],
+    EMOTION_LOW:  MAKOT["emotion_triggers"]["low"],
+    NICKNAME:     [MAKOT["name"]] + MAKOT["nicknames"],
+    UNCERTAIN:    ["かも", "かもしれ", "たぶん", "多分", "かな", "と思う", "気がする"],
+}
+
+
+class TriggerMatcher:
+    """キーワード → カテゴリの表から、テキスト中に現れるカテゴリの集合を返す"""
+
+    def __init__(self, keywords: dict[str, list[str]]):
+        categories: dict[str, set[str]] = {}
+        for category, words in keywords.items():
+            for word in words: categories.setdefault(word, set()).add(category)
+        # 同じ位置からは最長のキーワードしか取れないので、その接頭辞になっているキーワードのカテゴリも持たせる
+        # （例: 「かもしれ」にマッチしたら「かも」のカテゴリも立てる）
+        self._categories = {
+            word: frozenset().union(*(cats for other, cats in categories.items() if word.startswith(other)))
+            for word in categories
+        }
+        alternation = "|".join(re.escape(w) for w in sorted(categories, key=len, reverse=True))
+        self._pattern = re.compile(f"(?=({alternation}))")
+
+    def classify(self, text: str) -> frozenset[str]:
+        """テキストに含まれるキーワードのカテゴリをすべて返す（テキストは1回だけ走査する）"""
+        found: set[str] = set()
+        for match in self._pattern.finditer(text): found |= self._categories[match.group(1)]
+        return frozenset(found)
+
+
+matcher = TriggerMatcher(TRIGGER_KEYWORDS)
+
+@lru_cache(maxsize=1024)
+def classify(text: str) -> frozenset[str]:
+    """1つのメッセージは振り分け・話題推定・後処理で何度も判定されるので、結果をキャッシュする"""
+    return matcher.classify(text)